@@ -1,4 +1,56 @@
+import os
+import threading
+
 from pymongo import MongoClient, version
+from pymongo.write_concern import WriteConcern
+
+# Client settings that can be set with GEOLIFE_MONGO_<NAME> environment
+# variables (e.g. GEOLIFE_MONGO_MAXPOOLSIZE=200) or passed to DbConnector.
+CLIENT_SETTINGS = {
+    "maxPoolSize": int,
+    "minPoolSize": int,
+    "maxIdleTimeMS": int,
+    "compressors": str,  # e.g. "zstd,snappy,zlib"; zstd and snappy need their optional packages
+    "zlibCompressionLevel": int,
+    "readPreference": str,  # e.g. "secondaryPreferred"
+    "socketTimeoutMS": int,
+    "connectTimeoutMS": int,
+    "serverSelectionTimeoutMS": int,
+}
+
+# Write concern used by the ingest: acknowledged by the primary, no journal wait
+BULK_LOAD_WRITE_CONCERN = {"w": 1, "journal": False}
+
+ENV_PREFIX = "GEOLIFE_MONGO_"
+
+# One pooled client per process and server/settings, shared by all connectors
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _env(name):
+    return os.environ.get(ENV_PREFIX + name.upper())
+
+
+def _parse_w(value):
+    return int(value) if str(value).isdigit() else value
+
+
+def _parse_bool(value):
+    return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes")
+
+
+def client_settings(**overrides):
+    """Client settings from the environment, overridden by keyword arguments."""
+    unknown = sorted(set(overrides) - set(CLIENT_SETTINGS))
+    if unknown:
+        raise TypeError(f"Unknown client settings {unknown}; expected some of {list(CLIENT_SETTINGS)}")
+    settings = {}
+    for name, cast in CLIENT_SETTINGS.items():
+        value = overrides.get(name, _env(name))
+        if value is not None:
+            settings[name] = cast(value)
+    return settings
 
 
 class DbConnector:
@@ -10,18 +62,53 @@ class DbConnector:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
     USER = "testuser" // This is the user you created and added privileges for
     PASSWORD = "test123" // The password you set for said user
+
+    Each of them can also be set with the GEOLIFE_MONGO_DATABASE, _HOST, _USER
+    and _PASSWORD environment variables, or a complete connection string
+    (e.g. for a local mongod without authentication) with URI or
+    GEOLIFE_MONGO_URI. Connectors in the same process share
+    one pooled MongoClient per server and client settings (see
+    CLIENT_SETTINGS). w and journal set the write concern of this connector's
+    database; bulk_load=True uses BULK_LOAD_WRITE_CONCERN unless they are given
+    (or set with GEOLIFE_MONGO_W / GEOLIFE_MONGO_JOURNAL).
     """
 
     def __init__(self,
-                 DATABASE='assignment2',
-                 HOST="tdt4225-35.idi.ntnu.no",
-                 USER="mac",
-                 PASSWORD="passord123"):
-        uri = "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+                 DATABASE=None,
+                 HOST=None,
+                 USER=None,
+                 PASSWORD=None,
+                 URI=None,
+                 bulk_load=False,
+                 w=None,
+                 journal=None,
+                 **settings):
+        DATABASE = DATABASE or _env("DATABASE") or 'assignment2'
+        HOST = HOST or _env("HOST") or "tdt4225-35.idi.ntnu.no"
+        USER = USER or _env("USER") or "mac"
+        PASSWORD = PASSWORD or _env("PASSWORD") or "passord123"
+        uri = URI or _env("URI") or "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+
+        self.settings = client_settings(**settings)
+        self.key = (os.getpid(), uri, tuple(sorted(self.settings.items())))
+
+        write_concern = dict(BULK_LOAD_WRITE_CONCERN) if bulk_load else {}
+        w = w if w is not None else _env("W")
+        journal = journal if journal is not None else _env("JOURNAL")
+        if w is not None:
+            write_concern["w"] = _parse_w(w)
+        if journal is not None:
+            write_concern["journal"] = _parse_bool(journal)
+
         # Connect to the databases
         try:
-            self.client = MongoClient(uri)
-            self.db = self.client[DATABASE]
+            self.client = self._acquire_client(uri)
+            # Without w or journal the write concern of the URI applies
+            self.db = self.client.get_database(
+                DATABASE,
+                write_concern=WriteConcern(w=write_concern.get("w"), j=write_concern.get("journal"))
+                if write_concern else None
+            )
         except Exception as e:
             print("ERROR: Failed to connect to db:", e)
 
@@ -29,9 +116,23 @@ class DbConnector:
         print("You are connected to the database:", self.db.name)
         print("-----------------------------------------------\n")
 
+    def _acquire_client(self, uri):
+        with _clients_lock:
+            entry = _clients.get(self.key)
+            if entry is None:
+                entry = _clients[self.key] = [MongoClient(uri, **self.settings), 0]
+            entry[1] += 1
+            return entry[0]
+
     def close_connection(self):
         # close the cursor
-        # close the DB connection
-        self.client.close()
+        # close the DB connection once no connector in this process uses it
+        with _clients_lock:
+            entry = _clients.get(self.key)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del _clients[self.key]
+                    self.client.close()
         print("\n-----------------------------------------------")
         print("Connection to %s-db is closed" % self.db.name)
@@ -0,0 +1,174 @@
+"""
+End-to-end benchmark on synthetic data: generates a Geolife-format dataset at
+several scale factors, loads each into a local mongod and times the ingest and
+every Queries task. Each scale runs in its own process, so its peak RSS is
+measured on its own.
+
+Scale factor 1 is --users users with --files-per-user files of
+--points-per-file trackpoints each; a scale factor multiplies the users.
+With several --layouts, every scale is loaded once per trackpoint layout and
+the size of the trackpoint collection is recorded as well.
+
+Run:
+    python benchmark.py [--scales 1 2 4] [--layouts documents timeseries]
+                        [--uri mongodb://localhost:27017] [--workers N] [--out benchmark.json]
+"""
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from tabulate import tabulate
+
+import synthetic
+from datahandling import DEFAULT_WRITERS, GeolifeMongoDBProgram
+from layouts import LAYOUT_DOCUMENTS, LAYOUTS
+from queries import TASKS, Queries
+from runner import run_task
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers the parallel ingest processes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def ingest(dataset, database, layout, workers, writers):
+    program = GeolifeMongoDBProgram(data_path=dataset.data_path, labels_path=dataset.labels_path,
+                                    database=database, layout=layout)
+    try:
+        start = time.perf_counter()
+        program.drop_collections()
+        program.insert_users()
+        if workers > 1:
+            program.insert_activities_and_trackpoints_parallel(workers, writers)
+        else:
+            program.insert_activities_and_trackpoints()
+        program.finish()
+        return time.perf_counter() - start, program.instrumentation.summary(per_user=False)["stages"]
+    finally:
+        program.close_connection()
+
+
+def storage_mb(program):
+    stats = program.db.command("collStats", program.trackpoint_collection.name)
+    return {"storage_mb": stats["storageSize"] / 1024 / 1024, "index_mb": stats["totalIndexSize"] / 1024 / 1024}
+
+
+def run_scale_worker(config, layout, scale, results):
+    """Runs one layout and scale factor; the result (or the error) is put on the results queue."""
+    try:
+        results.put(run_scale(config, layout, scale))
+    except Exception as e:
+        results.put({"layout": layout, "scale": scale, "error": f"{type(e).__name__}: {e}"})
+        raise
+
+
+def run_scale(config, layout, scale):
+    with tempfile.TemporaryDirectory() as root:
+        dataset = synthetic.generate(root, config["users"] * scale, config["files_per_user"],
+                                     config["points_per_file"], config["label_density"], config["seed"])
+        database = f"{config['database_prefix']}_{layout}_{scale}"
+        ingest_seconds, ingest_stages = ingest(dataset, database, layout, config["workers"], config["writers"])
+        ingest_rss = peak_rss_mb()
+
+    program = Queries(database=database, verbose=False)
+    try:
+        storage = storage_mb(program)
+        tasks = {}
+        for task in config["tasks"]:
+            task_result = run_task(program, task)
+            tasks[task] = {"seconds": task_result.seconds, "error": task_result.error}
+        if not config["keep"]:
+            program.connection.client.drop_database(database)
+    finally:
+        program.close_connection()
+
+    return {
+        "layout": layout,
+        "scale": scale,
+        "users": dataset.users,
+        "files": dataset.files,
+        "points": dataset.points,
+        "ingest_seconds": ingest_seconds,
+        "points_per_second": dataset.points / ingest_seconds,
+        "ingest_peak_rss_mb": ingest_rss,
+        "ingest_stages": ingest_stages,
+        **storage,
+        "peak_rss_mb": peak_rss_mb(),
+        "tasks": tasks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and queries on synthetic Geolife data.")
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=[LAYOUT_DOCUMENTS])
+    parser.add_argument('--users', type=int, default=10, help="users at scale factor 1")
+    parser.add_argument('--files-per-user', type=int, default=20)
+    parser.add_argument('--points-per-file', type=int, default=1000,
+                        help="keep this below datahandling.MAX_POINTS, or the files are skipped")
+    parser.add_argument('--label-density', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--uri', default="mongodb://localhost:27017", help="mongod to load into")
+    parser.add_argument('--database-prefix', default="geolife_bench")
+    parser.add_argument('--workers', type=int, default=1, help="parse processes for the ingest (1 = serial)")
+    parser.add_argument('--writers', type=int, default=DEFAULT_WRITERS)
+    parser.add_argument('--tasks', nargs='+', default=TASKS, choices=TASKS, metavar='TASK')
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark databases")
+    parser.add_argument('--out', default="benchmark.json")
+    args = parser.parse_args()
+
+    # Inherited by the spawned processes, which connect through DbConnector
+    os.environ["GEOLIFE_MONGO_URI"] = args.uri
+
+    config = {
+        "users": args.users,
+        "files_per_user": args.files_per_user,
+        "points_per_file": args.points_per_file,
+        "label_density": args.label_density,
+        "seed": args.seed,
+        "database_prefix": args.database_prefix,
+        "workers": args.workers,
+        "writers": args.writers,
+        "tasks": args.tasks,
+        "keep": args.keep,
+    }
+
+    started = datetime.now().isoformat(timespec="seconds")
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    for layout in args.layouts:
+        for scale in args.scales:
+            results = ctx.Queue()
+            process = ctx.Process(target=run_scale_worker, args=(config, layout, scale, results))
+            process.start()
+            run = results.get()
+            process.join()
+            if "error" in run:
+                raise SystemExit(f"{layout} at scale {scale} failed: {run['error']}")
+            runs.append(run)
+
+    with open(args.out, 'w') as f:
+        json.dump({"started": started, "config": config, "runs": runs},
+                  f, indent=2)
+
+    print(tabulate([[run["layout"], run["scale"], run["points"], f"{run['ingest_seconds']:.1f}",
+                     f"{run['points_per_second']:.0f}", f"{run['storage_mb']:.1f}", f"{run['index_mb']:.1f}",
+                     f"{run['peak_rss_mb']:.0f}"] for run in runs],
+                   headers=["layout", "scale", "points", "ingest s", "points/s", "storage MB", "index MB",
+                            "peak RSS MB"]))
+    print()
+    print(tabulate([[task] + [f"{run['tasks'][task]['seconds']:.3f}" if run['tasks'][task]['error'] is None
+                              else "error" for run in runs] for task in args.tasks],
+                   headers=["task"] + [f"{run['layout']} x{run['scale']} s" for run in runs]))
+    print(f"\nResults written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
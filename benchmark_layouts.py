@@ -0,0 +1,82 @@
+"""
+Compares storage size and query times of the trackpoint storage layouts.
+
+Load the same dataset once per layout into separate databases, e.g.
+    python datahandling.py --database geolife_documents --layout documents
+    python datahandling.py --database geolife_buckets --layout buckets
+    python datahandling.py --database geolife_timeseries --layout timeseries
+and run
+    python benchmark_layouts.py geolife_documents geolife_buckets geolife_timeseries
+
+Ingest rates per layout are measured on synthetic data by
+    python benchmark.py --layouts documents buckets timeseries
+"""
+import argparse
+import time
+
+from tabulate import tabulate
+
+from queries import Queries
+
+TASKS = [
+    "count_entries",
+    "total_distance_walked_2008",
+    "top_20_altitude_gains",
+    "find_invalid_activities",
+    "find_users_in_forbidden_city",
+]
+
+
+def storage_stats(program):
+    stats = program.db.command("collStats", program.trackpoint_collection.name)
+    # Time-series collections do not report a count; counting is a full scan, so only then
+    documents = stats["count"] if "count" in stats else program.trackpoint_collection.count_documents({})
+    return {
+        "collection": program.trackpoint_collection.name,
+        "documents": documents,
+        "data_mb": stats["size"] / 1024 / 1024,
+        "storage_mb": stats["storageSize"] / 1024 / 1024,
+        "index_mb": stats["totalIndexSize"] / 1024 / 1024,
+    }
+
+
+def time_task(program, task, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        getattr(program, task)()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare trackpoint storage layouts.")
+    parser.add_argument('databases', nargs='+', help="databases loaded with different layouts")
+    parser.add_argument('--tasks', nargs='+', default=TASKS, help="Queries methods to time")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size_rows = []
+    time_rows = {task: [task] for task in args.tasks}
+    headers = ["task"]
+    for database in args.databases:
+        program = Queries(database=database, verbose=False)
+        try:
+            stats = storage_stats(program)
+            size_rows.append([database, program.layout, stats["collection"], stats["documents"],
+                              f"{stats['data_mb']:.1f}", f"{stats['storage_mb']:.1f}", f"{stats['index_mb']:.1f}"])
+            headers.append(f"{database} ({program.layout}) s")
+            for task in args.tasks:
+                time_rows[task].append(f"{time_task(program, task, args.repeat):.3f}")
+        finally:
+            program.close_connection()
+
+    print(tabulate(size_rows, headers=["database", "layout", "collection", "documents",
+                                       "data MB", "storage MB", "index MB"]))
+    print()
+    print(tabulate(list(time_rows.values()), headers=headers))
+
+
+if __name__ == '__main__':
+    main()
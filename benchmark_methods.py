@@ -0,0 +1,75 @@
+"""
+Times the alternative implementations of a Queries task and checks that they
+return the same results.
+
+Run:
+    python benchmark_methods.py [--tasks top_20_altitude_gains] [--repeat N]
+"""
+import argparse
+import time
+
+from tabulate import tabulate
+
+from queries import Queries
+
+# Queries task -> implementations selectable with its method argument
+METHODS = {
+    "average_activities_per_user": ["aggregate", "rollup"],
+    "top_20_users_with_highest_activities": ["aggregate", "rollup"],
+    "count_transportation_modes": ["aggregate", "rollup"],
+    "year_with_most_activities": ["aggregate", "rollup"],
+    "year_with_most_hours": ["aggregate", "rollup"],
+    "total_distance_walked_2008": ["client", "window", "stored"],
+    "top_20_altitude_gains": ["loop", "window", "stored"],
+    "find_invalid_activities": ["lookup", "window", "stored"],
+    "most_used_transport_mode": ["aggregate", "rollup"],
+}
+
+
+def normalize(result):
+    # Round floats so server- and client-side sums compare equal
+    if isinstance(result, float):
+        return round(result, 2)
+    if isinstance(result, (list, tuple)):
+        return [normalize(value) for value in result]
+    if isinstance(result, dict):
+        return {key: normalize(value) for key, value in result.items()}
+    return result
+
+
+def run_method(program, task, method, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = getattr(program, task)(method=method)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, normalize(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark alternative Queries implementations.")
+    parser.add_argument('--tasks', nargs='+', default=list(METHODS), choices=list(METHODS))
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    program = Queries(database=args.database, verbose=False)
+    rows = []
+    try:
+        for task in args.tasks:
+            reference = None
+            for method in METHODS[task]:
+                seconds, result = run_method(program, task, method, args.repeat)
+                if reference is None:
+                    reference = result
+                rows.append([task, method, f"{seconds:.3f}", "yes" if result == reference else "NO"])
+    finally:
+        program.close_connection()
+
+    print(tabulate(rows, headers=["task", "method", "seconds", "same as first method"]))
+
+
+if __name__ == '__main__':
+    main()
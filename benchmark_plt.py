@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of the .plt parsers: the original split/strptime loop against
+pltreader.read_plt and the NumPy bulk reader.
+
+Run:
+    python benchmark_plt.py <file.plt or Trajectory folder> [--repeat N]
+"""
+import argparse
+from datetime import datetime
+import os
+import time
+
+import pltreader
+
+
+def legacy_read_plt(file_path):
+    # The per-line parsing process_plt_file used before pltreader
+    with open(file_path, 'r') as f:
+        lines = f.readlines()[6:]
+    points = []
+    for line in lines:
+        lat, lon, _, altitude, _, date, time_ = line.strip().split(',')
+        date_time = datetime.strptime(f"{date} {time_}", '%Y-%m-%d %H:%M:%S')
+        points.append((float(lat), float(lon), float(altitude), date_time))
+    return points
+
+
+def collect_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names if name.endswith('.plt'))
+    return sorted(files)
+
+
+def time_parser(parser, files, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_path in files:
+            parser(file_path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark .plt parsing.")
+    parser.add_argument('path', help=".plt file or a folder containing .plt files")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    files = collect_files(args.path)
+    points = sum(len(pltreader.read_plt(f)) for f in files)
+    print(f"{len(files)} files, {points} trackpoints, best of {args.repeat}")
+
+    # Sanity check: the fast reader must give the same trackpoints
+    for file_path in files:
+        if legacy_read_plt(file_path) != pltreader.read_plt(file_path):
+            raise SystemExit(f"read_plt differs from the legacy parser on {file_path}")
+
+    parsers = [("legacy split/strptime", legacy_read_plt), ("pltreader.read_plt", pltreader.read_plt)]
+    if pltreader.np is not None:
+        parsers.append(("pltreader.read_plt_arrays", pltreader.read_plt_arrays))
+
+    baseline = None
+    for name, func in parsers:
+        seconds = time_parser(func, files, args.repeat)
+        baseline = baseline or seconds
+        print(f"{name:28} {seconds:8.3f} s  {points / seconds:12.0f} points/s  {baseline / seconds:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
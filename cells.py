@@ -0,0 +1,136 @@
+"""
+Spatio-temporal grid collection maintained at ingest.
+
+CellVisit has one document per activity, geohash cell and time bucket the
+activity has trackpoints in:
+    {cell, time_bucket, user_id, activity_id, n}
+cell is the geohash of the fixes at the precision of the grid, time_bucket the
+start of the bucket_seconds interval they fall in and n the number of fixes.
+Area counts, heatmaps and co-location queries are equality lookups on
+(cell, time_bucket) instead of scans over every trackpoint. An activity that
+was written in several chunks can have more than one document for the same
+cell and time bucket; queries sum n.
+
+The grid (precision and bucket size) is recorded in the Meta collection. The
+collection can be regenerated from the trackpoints with rebuild_cells.
+
+Run:
+    python cells.py --rebuild [--database NAME] [--precision 7] [--bucket-seconds 600]
+"""
+import argparse
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from DbConnector import DbConnector
+from geohash import encode_many
+from geometry import to_epoch
+from layouts import META_COLLECTION, TRACKPOINT_COLLECTIONS, get_layout
+from resultcache import bump_data_version
+from trajcache import FETCH_BATCH, fetch_trajectories
+
+CELL_COLLECTION = "CellVisit"
+
+# Geohash precision 7 cells are about 150 x 150 m
+DEFAULT_PRECISION = 7
+DEFAULT_BUCKET_SECONDS = 10 * 60
+
+Grid = namedtuple('Grid', ['precision', 'bucket_seconds'])
+
+DEFAULT_GRID = Grid(DEFAULT_PRECISION, DEFAULT_BUCKET_SECONDS)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(epoch, bucket_seconds):
+    """Start of the time bucket containing epoch seconds, as a naive datetime."""
+    return _EPOCH + timedelta(seconds=int(epoch) // bucket_seconds * bucket_seconds)
+
+
+def floor_time(date_time, bucket_seconds):
+    """Start of the time bucket containing a datetime."""
+    return bucket_start((date_time - _EPOCH).total_seconds(), bucket_seconds)
+
+
+def cell_visits(activity_id, user_id, lat, lon, epoch, grid=DEFAULT_GRID):
+    """CellVisit documents for the fixes of one activity, given as arrays."""
+    if len(lat) == 0:
+        return []
+    cells = encode_many(lat, lon, grid.precision)
+    buckets = np.asarray(epoch, dtype=np.int64) // grid.bucket_seconds * grid.bucket_seconds
+    return [
+        {"cell": cell, "time_bucket": bucket_start(bucket, grid.bucket_seconds),
+         "user_id": user_id, "activity_id": activity_id, "n": n}
+        for (cell, bucket), n in Counter(zip(cells, buckets.tolist())).items()
+    ]
+
+
+def trackpoint_visits(activity_id, user_id, trackpoints, grid=DEFAULT_GRID):
+    """CellVisit documents for a list of trackpoint dicts."""
+    return cell_visits(activity_id, user_id,
+                       [tp["lat"] for tp in trackpoints], [tp["lon"] for tp in trackpoints],
+                       to_epoch([tp["date_time"] for tp in trackpoints]), grid)
+
+
+def get_grid(db):
+    meta = db[META_COLLECTION].find_one({"_id": "ingest"})
+    grid = meta.get("grid") if meta else None
+    return Grid(**grid) if grid else DEFAULT_GRID
+
+
+def set_grid(db, grid):
+    db[META_COLLECTION].update_one({"_id": "ingest"}, {"$set": {"grid": grid._asdict()}}, upsert=True)
+
+
+def rebuild_cells(db, grid=None, verbose=True):
+    """Regenerates CellVisit from the trackpoints, with the given grid or the recorded one."""
+    grid = grid or get_grid(db)
+    layout = get_layout(db)
+    trackpoint_collection = db[TRACKPOINT_COLLECTIONS[layout]]
+    collection = db[CELL_COLLECTION]
+
+    collection.drop()
+    set_grid(db, grid)
+    activities = list(db["Activity"].find({}, {"user_id": 1}))
+    for start in range(0, len(activities), FETCH_BATCH):
+        batch = activities[start:start + FETCH_BATCH]
+        trajectories = fetch_trajectories(trackpoint_collection, layout, [activity["_id"] for activity in batch])
+        visits = []
+        for activity in batch:
+            trajectory = trajectories[activity["_id"]]
+            visits.extend(cell_visits(activity["_id"], activity["user_id"],
+                                      trajectory.lat, trajectory.lon, trajectory.epoch, grid))
+        if visits:
+            collection.insert_many(visits, ordered=False)
+        if verbose:
+            print(f"{min(start + FETCH_BATCH, len(activities))}/{len(activities)} activities")
+    bump_data_version(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the CellVisit grid collection.")
+    parser.add_argument('--rebuild', action='store_true', help="regenerate CellVisit from the trackpoints")
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--precision', type=int, default=None,
+                        help=f"geohash precision (default: the recorded grid, or {DEFAULT_PRECISION})")
+    parser.add_argument('--bucket-seconds', type=int, default=None,
+                        help=f"time bucket size (default: the recorded grid, or {DEFAULT_BUCKET_SECONDS})")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.print_help()
+        return
+
+    connection = DbConnector(DATABASE=args.database)
+    try:
+        recorded = get_grid(connection.db)
+        grid = Grid(args.precision or recorded.precision, args.bucket_seconds or recorded.bucket_seconds)
+        rebuild_cells(connection.db, grid)
+        print(f"Rebuilt {connection.db[CELL_COLLECTION].count_documents({})} {CELL_COLLECTION} documents.")
+    finally:
+        connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
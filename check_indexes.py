@@ -0,0 +1,150 @@
+"""
+Runs every Queries task, explains each filtered find/aggregate/count/distinct
+it sent and fails if any of them is answered with a collection scan.
+
+Commands without a filter (e.g. grouping the whole Activity collection, or
+the altitude gains of task 2.8 over every trackpoint) have to read every
+document anyway and are not checked.
+
+Run:
+    python check_indexes.py [--database NAME] [--tasks ...]
+"""
+import argparse
+from contextlib import redirect_stdout
+import copy
+import io
+import sys
+import threading
+
+from pymongo import monitoring
+
+from queries import TASKS, Queries
+
+EXPLAINED_COMMANDS = ("find", "aggregate", "count", "distinct")
+
+# Fields added by the driver that explain does not accept
+DRIVER_FIELDS = ("lsid", "$db", "$clusterTime", "$readPreference", "txnNumber",
+                 "apiVersion", "apiStrict", "apiDeprecationErrors")
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Keeps a copy of every command the client sends while enabled."""
+
+    def __init__(self):
+        self.commands = []
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if self.enabled and event.command_name in EXPLAINED_COMMANDS:
+            with self.lock:
+                self.commands.append(copy.deepcopy(dict(event.command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def take(self):
+        with self.lock:
+            commands, self.commands = self.commands, []
+        return commands
+
+
+def command_filter(command):
+    name = next(iter(command))
+    if name == "find":
+        return command.get("filter") or {}
+    if name in ("count", "distinct"):
+        return command.get("query") or {}
+    first_stage = command["pipeline"][0] if command.get("pipeline") else {}
+    if "$match" in first_stage:
+        return first_stage["$match"]
+    return first_stage.get("$geoNear", {})
+
+
+def plan_stages(plan):
+    """All stage names in an explain plan."""
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == "stage" and isinstance(value, str):
+                yield value
+            else:
+                yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def explain(db, command):
+    command = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+    result = db.command({"explain": command, "verbosity": "queryPlanner"})
+    # Only the winning plans matter, not the rejected candidates
+    plans = []
+
+    def collect(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "winningPlan":
+                    plans.append(value)
+                elif key != "rejectedPlans":
+                    collect(value)
+        elif isinstance(node, list):
+            for value in node:
+                collect(value)
+
+    collect(result)
+    return plans
+
+
+def check_task(program, recorder, task):
+    recorder.take()
+    recorder.enabled = True
+    try:
+        with redirect_stdout(io.StringIO()):
+            getattr(program, task)()
+    finally:
+        recorder.enabled = False
+
+    problems = []
+    for command in recorder.take():
+        if not command_filter(command):
+            continue
+        for plan in explain(program.db, command):
+            if "COLLSCAN" in plan_stages(plan):
+                name = next(iter(command))
+                problems.append(f"{name} on {command[name]}: {command_filter(command)}")
+                break
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that no Queries task falls back to a COLLSCAN.")
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--tasks', nargs='+', default=TASKS, choices=TASKS)
+    args = parser.parse_args()
+
+    # The listener has to be registered before the client is created
+    recorder = CommandRecorder()
+    monitoring.register(recorder)
+
+    program = Queries(database=args.database)
+    failures = 0
+    try:
+        for task in args.tasks:
+            problems = check_task(program, recorder, task)
+            print(f"{'COLLSCAN' if problems else 'ok':8} {task}")
+            for problem in problems:
+                print(f"         {problem}")
+            failures += bool(problems)
+    finally:
+        program.close_connection()
+
+    if failures:
+        print(f"{failures} task(s) fall back to a collection scan.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
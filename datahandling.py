@@ -1,149 +1,589 @@
-from datetime import datetime
-from math import atan2, cos, radians, sin, sqrt
+import argparse
+from functools import partial
+from itertools import islice
+import json
+import multiprocessing
 import os
+from queue import Full
+import zlib
+from bson import ObjectId
+from pymongo import ReplaceOne
+from cells import CELL_COLLECTION, DEFAULT_BUCKET_SECONDS, DEFAULT_PRECISION, Grid, get_grid, set_grid
 from DbConnector import DbConnector
+from geometry import TrajectoryAccumulator, geojson_point, to_epoch
+from indexes import create_indexes
+from instrumentation import (NO_INSTRUMENTATION, STAGE_GEOMETRY, STAGE_INDEXES, STAGE_LABELS, STAGE_LIST,
+                             STAGE_MANIFEST, STAGE_PARSE, PROGRESS_INTERVAL, Instrumentation, profiled)
+from labels import LabelIndex
+from layouts import (ACTIVITY_FIELDS, BUCKET_SIZE, LAYOUT_DOCUMENTS, LAYOUTS, META_COLLECTION,
+                     TRACKPOINT_COLLECTIONS, create_trackpoint_collection, get_layout, set_layout)
+from manifest import IngestedFile, Manifest, StreamHash, ingested_file, list_plt_files
+from pltreader import iter_plt_points
+from resultcache import bump_data_version
+from rollups import ROLLUP_COLLECTION, rebuild_rollups
+from simplify import SIMPLIFIED_COLLECTION, Simplification, get_simplification, set_simplification
+from writebuffer import DEFAULT_FLUSH_BYTES, DEFAULT_FLUSH_DOCS, ActivityChunk, WriteBuffer
 
 # Paths to dataset
 DATA_PATH = "/your_data_path"
 LABELS_PATH = "/your_labels_path"
 
+# Number of processes writing to MongoDB when ingesting in parallel
+DEFAULT_WRITERS = 2
+# Seconds between checks that the writer processes are still running
+WRITER_POLL_SECONDS = 1.0
+
+# What to do with files that have more than MAX_POINTS trackpoints
+OVERSIZE_SKIP = "skip"
+OVERSIZE_SPLIT = "split"
+OVERSIZE_KEEP = "keep"
+OVERSIZE_POLICIES = (OVERSIZE_SKIP, OVERSIZE_SPLIT, OVERSIZE_KEEP)
+MAX_POINTS = 2500
+
+# Trackpoints are parsed and written in chunks of this size
+CHUNK_SIZE = 1000
+
+# Options that change what is stored, so an incremental load must use the same ones
+DEFAULT_INGEST_OPTIONS = dict(max_points=MAX_POINTS, oversize=OVERSIZE_SKIP, split_labels=False, cells=True)
+
+
+def get_ingest_options(db):
+    """The options recorded for the loaded data; defaults for databases loaded before they were recorded."""
+    meta = db[META_COLLECTION].find_one({"_id": "ingest"})
+    return (meta.get("options") if meta else None) or DEFAULT_INGEST_OPTIONS
+
+
+def set_ingest_options(db, options):
+    db[META_COLLECTION].update_one({"_id": "ingest"}, {"$set": {"options": options}}, upsert=True)
+
+
+def read_labels_file(labels_file):
+    return LabelIndex.from_file(labels_file)
+
+
+class ActivityBuilder:
+    """
+    Builds one activity from a stream of trackpoints. Trackpoints are handed out
+    in chunks (see chunk), so only the current chunk is kept in memory.
+    """
+
+    def __init__(self, user_id, labels, first_point, source=None, label=None):
+        start_date_time = first_point[3]
+        # A label segment takes the mode of its label; otherwise the mode is
+        # taken from the label that overlaps the activity most, once it is done
+        self.labels = labels
+        self.label = label
+        transportation_mode = labels.modes[label] if label is not None else None
+
+        # The id is assigned here so trackpoint chunks can be written before the activity
+        self.activity = {
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "start_date_time": start_date_time,
+            "end_date_time": start_date_time,
+            "transportation_mode": transportation_mode,
+        }
+        self.source = source
+        self.accumulator = TrajectoryAccumulator()
+        self.pending = []
+        self.count = 0
+        self.offset = 0
+
+    def add(self, point):
+        self.pending.append(point)
+        self.count += 1
+
+    def chunk(self, done):
+        points, self.pending = self.pending, []
+        if points:
+            lat, lon, altitude, date_times = zip(*points)
+            self.accumulator.update(lat, lon, altitude, to_epoch(date_times))
+            self.activity["end_date_time"] = date_times[-1]
+
+        trackpoints = [make_trackpoint(*p) for p in points]
+        chunk = ActivityChunk(self.activity, trackpoints, self.offset, done, self.source)
+        self.offset += len(points)
+
+        if done:
+            if self.label is None:
+                self.activity["transportation_mode"] = self.labels.mode_for(
+                    self.activity["start_date_time"], self.activity["end_date_time"])
+            stats = self.accumulator.stats()
+            self.activity["total_distance"] = stats.total_distance
+            self.activity["altitude_gain"] = stats.altitude_gain
+            self.activity["is_valid"] = stats.is_valid
+        return chunk
+
+
+def iter_plt_chunks(file_path, user_id, labels, max_points=MAX_POINTS,
+                    oversize=OVERSIZE_SKIP, chunk_size=CHUNK_SIZE, source=None, split_labels=False,
+                    instrumentation=NO_INSTRUMENTATION, digest=None):
+    """
+    Streams one .plt file as ActivityChunks of at most chunk_size trackpoints.
+    The activity of a chunk is complete once a chunk with done=True is yielded.
+    labels is the user's LabelIndex.
+
+    Files with more than max_points trackpoints are handled by the oversize
+    policy: skip them, split them into activities of max_points trackpoints,
+    or keep them as one activity.
+
+    With split_labels, a new activity is started whenever the trajectory
+    enters or leaves a label, so each activity is one label segment (or an
+    unlabeled stretch between labels).
+
+    Reading and parsing the file is timed as the parse stage, the trajectory
+    statistics and trackpoint documents of each chunk as the geometry stage.
+    digest is updated with the bytes read; see pltreader.iter_plt_points.
+    """
+    def read(count):
+        with instrumentation.stage(STAGE_PARSE, user_id) as counts:
+            batch = list(islice(points, count))
+            counts["rows"] = len(batch)
+        return batch
+
+    def chunk(builder, done):
+        with instrumentation.stage(STAGE_GEOMETRY, user_id, rows=len(builder.pending)):
+            return builder.chunk(done)
+
+    points = iter_plt_points(file_path, digest)
+    limit = None
+    if oversize == OVERSIZE_SKIP:
+        # At most max_points + 1 points are read to find out if the file is skipped
+        head = read(max_points + 1)
+        if len(head) > max_points:
+            return
+        points = iter(head)
+    elif oversize == OVERSIZE_SPLIT:
+        limit = max_points
+
+    builder = None
+    label = None
+    while True:
+        # The head of a skip-policy file was already read (and timed) above
+        batch = read(chunk_size) if oversize != OVERSIZE_SKIP else list(islice(points, chunk_size))
+        if not batch:
+            break
+        for point in batch:
+            if split_labels and not labels.covers(label, point[3]):
+                label = labels.label_at(point[3])
+                if builder is not None and label != builder.label:
+                    yield chunk(builder, done=True)
+                    builder = None
+            if builder is None:
+                builder = ActivityBuilder(user_id, labels, point, source, label)
+            builder.add(point)
+
+            if limit is not None and builder.count >= limit:
+                yield chunk(builder, done=True)
+                builder = None
+            elif len(builder.pending) >= chunk_size:
+                yield chunk(builder, done=False)
+
+    if builder is not None:
+        yield chunk(builder, done=True)
+
+
+def make_trackpoint(lat, lon, altitude, date_time):
+    trackpoint = {"activity_id": None, "lat": lat, "lon": lon, "altitude": altitude, "date_time": date_time}
+    # GeoJSON copy of the position for the 2dsphere index; left out for invalid coordinates
+    location = geojson_point(lat, lon)
+    if location is not None:
+        trackpoint["location"] = location
+    return trackpoint
+
+
+def iter_user_chunks(data_path, user_id, paths=None, instrumentation=NO_INSTRUMENTATION, **parse_options):
+    """
+    Yields the ActivityChunks of the given .plt files of a user (all by
+    default), each file followed by its IngestedFile manifest record.
+    """
+    labels_file = os.path.join(data_path, user_id, 'labels.txt')
+
+    with instrumentation.stage(STAGE_LABELS, user_id) as counts:
+        labels = read_labels_file(labels_file) if os.path.exists(labels_file) else LabelIndex()
+        counts["rows"] = len(labels)
+
+    if paths is None:
+        with instrumentation.stage(STAGE_LIST, user_id) as counts:
+            paths = list_plt_files(data_path, user_id)
+            counts["rows"] = len(paths)
+    for path in paths:
+        file_path = os.path.join(data_path, path)
+        # The file is hashed for the manifest while it is parsed; only a file the
+        # parser did not read to the end (an oversized file that is skipped) is read again
+        stream_hash = StreamHash()
+        yield from iter_plt_chunks(file_path, user_id, labels, source=path,
+                                   instrumentation=instrumentation, digest=stream_hash, **parse_options)
+        with instrumentation.stage(STAGE_MANIFEST, user_id, rows=1) as counts:
+            record = ingested_file(data_path, path, user_id, stream_hash)
+            counts["bytes"] = record.size
+        instrumentation.record(STAGE_PARSE, nbytes=record.size, user_id=user_id)
+        yield record
+
+
+# Parallel ingest: parse workers push activity chunks onto the queues of a few
+# writer processes, each with its own connection. All chunks of a file go to
+# the same writer, so it sees them in order and can mark the file as done.
+_writer_queues = None
+
+
+def _init_parse_worker(queues):
+    global _writer_queues
+    _writer_queues = queues
+
+
+def _parse_user_worker(data_path, parse_options, job):
+    user_id, paths = job
+    count = 0
+    # Counters of this user only; the main process merges them
+    instrumentation = Instrumentation(verbose=False)
+    for item in iter_user_chunks(data_path, user_id, paths, instrumentation, **parse_options):
+        source = item.path if isinstance(item, IngestedFile) else item.source
+        _writer_queues[zlib.crc32(source.encode()) % len(_writer_queues)].put(item)
+        if isinstance(item, ActivityChunk):
+            count += item.done
+    return user_id, count, instrumentation.snapshot()
+
+
+def _writer_worker(queue, options, results):
+    program = GeolifeMongoDBProgram(**options)
+    program.instrumentation.verbose = False
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            program.write_item(item)
+    finally:
+        program.close_connection()
+        results.put(program.instrumentation.snapshot())
+
+
+def _watch_writers(parsed, writer_processes, poll_seconds=WRITER_POLL_SECONDS):
+    """
+    Yields the results of the parse pool. Writers only exit once they are told
+    to, after parsing; a writer that exits earlier has failed, and nothing
+    reads its queue any more, so the parse workers would block on it forever.
+    """
+    while True:
+        dead = [process for process in writer_processes if process.exitcode is not None]
+        if dead:
+            raise RuntimeError(f"{len(dead)} writer process(es) failed (exit codes "
+                               f"{', '.join(str(process.exitcode) for process in dead)}); "
+                               f"rerun with --incremental to resume")
+        try:
+            yield parsed.next(timeout=poll_seconds)
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            pass
+
+
+def _stop_writer(queue, process, poll_seconds=WRITER_POLL_SECONDS):
+    """Tells a writer to finish; gives up if it exits without draining its full queue."""
+    while process.exitcode is None:
+        try:
+            queue.put(None, timeout=poll_seconds)
+            return
+        except Full:
+            pass
+
+
 class GeolifeMongoDBProgram:
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, data_path=DATA_PATH, labels_path=LABELS_PATH,
+                 flush_docs=DEFAULT_FLUSH_DOCS, flush_bytes=DEFAULT_FLUSH_BYTES,
+                 database=None, layout=LAYOUT_DOCUMENTS, bucket_size=BUCKET_SIZE,
+                 max_points=MAX_POINTS, oversize=OVERSIZE_SKIP, chunk_size=CHUNK_SIZE,
+                 bulk_load=True, split_labels=False, progress_interval=PROGRESS_INTERVAL,
+                 cells=True, cell_precision=DEFAULT_PRECISION, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+                 simplify_tolerance=None, simplified_only=False):
+        if simplified_only and simplify_tolerance is None:
+            raise ValueError("simplified_only needs a simplify_tolerance")
+        # Kept so writer processes can build an identical program
+        self.options = dict(data_path=data_path, labels_path=labels_path,
+                            flush_docs=flush_docs, flush_bytes=flush_bytes,
+                            database=database, layout=layout, bucket_size=bucket_size,
+                            max_points=max_points, oversize=oversize, chunk_size=chunk_size,
+                            bulk_load=bulk_load, split_labels=split_labels,
+                            progress_interval=progress_interval, cells=cells,
+                            cell_precision=cell_precision, bucket_seconds=bucket_seconds,
+                            simplify_tolerance=simplify_tolerance, simplified_only=simplified_only)
+        self.parse_options = dict(max_points=max_points, oversize=oversize, chunk_size=chunk_size,
+                                  split_labels=split_labels)
+        self.ingest_options = dict(max_points=max_points, oversize=oversize, split_labels=split_labels,
+                                   cells=cells)
+        self.data_path = data_path
+        self.labels_path = labels_path
+        self.layout = layout
+        self.grid = Grid(cell_precision, bucket_seconds)
+        self.simplification = (Simplification(simplify_tolerance, not simplified_only)
+                               if simplify_tolerance is not None else None)
+        # bulk_load relaxes the write concern; see DbConnector.BULK_LOAD_WRITE_CONCERN
+        self.connection = DbConnector(DATABASE=database, bulk_load=bulk_load)
         self.db = self.connection.db
         self.user_collection = self.db['User']
         self.activity_collection = self.db['Activity']
-        self.trackpoint_collection = self.db['TrackPoint']
+        self.trackpoint_collection = self.db[TRACKPOINT_COLLECTIONS[layout]]
+        self.instrumentation = Instrumentation(progress_interval=progress_interval)
+        self.buffer = WriteBuffer(self.db, flush_docs, flush_bytes, layout=layout, bucket_size=bucket_size,
+                                  cells=cells, grid=self.grid, simplify_tolerance=simplify_tolerance,
+                                  raw=not simplified_only, instrumentation=self.instrumentation)
+        self.manifest = Manifest(self.db)
+        self.rollups_stale = False
+        # Cleared by an incremental run that finds nothing to load or remove
+        self.data_changed = True
 
     def drop_collections(self):
         self.user_collection.drop()
         self.activity_collection.drop()
-        self.trackpoint_collection.drop()
+        for collection_name in TRACKPOINT_COLLECTIONS.values():
+            self.db[collection_name].drop()
+        self.db[ROLLUP_COLLECTION].drop()
+        self.db[CELL_COLLECTION].drop()
+        self.db[SIMPLIFIED_COLLECTION].drop()
+        self.manifest.collection.drop()
+        self.db[META_COLLECTION].drop()
+        set_layout(self.db, self.layout)
+        set_grid(self.db, self.grid)
+        set_simplification(self.db, self.simplification)
+        set_ingest_options(self.db, self.ingest_options)
+        bump_data_version(self.db)
+        create_trackpoint_collection(self.db, self.layout)
+        self.data_changed = True
         print("Collections dropped.")
 
-    def insert_users(self):
+    def insert_users(self, upsert=False):
         users = []
-        with open(LABELS_PATH, 'r') as f:
+        with open(self.labels_path, 'r') as f:
             labeled_users = set(line.strip() for line in f.readlines())
 
-        for user_id in os.listdir(DATA_PATH):
+        for user_id in os.listdir(self.data_path):
             has_labels = user_id in labeled_users
             users.append({"_id": user_id, "has_labels": has_labels})
-        self.user_collection.insert_many(users)
+        if upsert:
+            self.user_collection.bulk_write([ReplaceOne({"_id": user["_id"]}, user, upsert=True) for user in users])
+        else:
+            self.user_collection.insert_many(users)
         print("Inserted all users.")
 
-    def insert_activities_and_trackpoints(self):
-        for user_id in os.listdir(DATA_PATH):
-            user_folder = os.path.join(DATA_PATH, user_id, 'Trajectory')
-            labels_file = os.path.join(DATA_PATH, user_id, 'labels.txt')
+    def prepare_incremental(self):
+        """
+        Compares the data folder with the ingest manifest and removes the data
+        of changed, deleted and unfinished files. Returns the files to load,
+        as a dict of user_id -> paths.
+        """
+        if (self.manifest.collection.find_one({}, {"_id": 1}) is None
+                and self.activity_collection.find_one({}, {"_id": 1}) is not None):
+            # Without a manifest every file would be loaded a second time
+            raise ValueError("The database was loaded without an ingest manifest; reload it without --incremental")
+        if self.db[META_COLLECTION].find_one({"_id": "ingest"}) is None:
+            set_layout(self.db, self.layout)
+            set_grid(self.db, self.grid)
+            set_simplification(self.db, self.simplification)
+            set_ingest_options(self.db, self.ingest_options)
+            create_trackpoint_collection(self.db, self.layout)
+        elif get_layout(self.db) != self.layout:
+            raise ValueError(f"The database was loaded with the {get_layout(self.db)} layout, not {self.layout}")
+        elif get_grid(self.db) != self.grid:
+            raise ValueError(f"The database was loaded with the grid {get_grid(self.db)}, not {self.grid}")
+        elif get_simplification(self.db) != self.simplification:
+            raise ValueError(f"The database was loaded with the simplification {get_simplification(self.db)}, "
+                             f"not {self.simplification}")
+        elif get_ingest_options(self.db) != self.ingest_options:
+            raise ValueError(f"The database was loaded with the options {get_ingest_options(self.db)}, "
+                             f"not {self.ingest_options}")
+
+        plan = self.manifest.plan(self.data_path, os.listdir(self.data_path))
+        self.manifest.touch(plan.touched)
+        self.data_changed = bool(plan.stale or plan.files)
+        if self.data_changed:
+            # Cached query results must not outlive a partial load either
+            bump_data_version(self.db)
+        if plan.stale:
+            # Deleting by activity_id needs the indexes
+            self.create_indexes()
+            self.rollups_stale = self.manifest.remove(self.db, plan.stale, self.trackpoint_collection,
+                                                      ACTIVITY_FIELDS[self.layout])
+
+        new_files = sum(len(paths) for paths in plan.files.values())
+        print(f"Manifest: {plan.unchanged} unchanged files, {len(plan.stale)} files removed or replaced, "
+              f"{new_files} files to load.")
+        return plan.files
+
+    def insert_activities_and_trackpoints(self, files=None):
+        """Loads the given files (user_id -> paths), or every file of every user."""
+        jobs = files.items() if files is not None else ((user_id, None) for user_id in os.listdir(self.data_path))
+        for user_id, paths in jobs:
+            for item in iter_user_chunks(self.data_path, user_id, paths, self.instrumentation, **self.parse_options):
+                self.write_item(item)
+                self.instrumentation.progress()
+            self.instrumentation.user_done(user_id)
+        self.buffer.flush()
+
+    def insert_activities_and_trackpoints_parallel(self, workers, writers=DEFAULT_WRITERS, files=None):
+        # spawn, so no process inherits a forked MongoClient
+        ctx = multiprocessing.get_context('spawn')
+        queues = [ctx.Queue(maxsize=workers * 4) for _ in range(writers)]
+        # Each writer sends its instrumentation counters here when it exits
+        results = ctx.Queue()
+
+        writer_processes = [
+            ctx.Process(target=_writer_worker, args=(queue, self.options, results))
+            for queue in queues
+        ]
+        for process in writer_processes:
+            process.start()
 
-            labels = self.read_labels_file(labels_file) if os.path.exists(labels_file) else {}
+        jobs = list(files.items()) if files is not None else [(user_id, None) for user_id in os.listdir(self.data_path)]
+        completed = False
+        try:
+            with ctx.Pool(workers, initializer=_init_parse_worker, initargs=(queues,)) as pool:
+                parse_user = partial(_parse_user_worker, self.data_path, self.parse_options)
+                parsed = pool.imap_unordered(parse_user, jobs)
+                for user_id, count, counters in _watch_writers(parsed, writer_processes):
+                    print(f"Parsed user {user_id}: {count} activities")
+                    self.instrumentation.merge(counters)
+                    self.instrumentation.user_done(user_id)
+            completed = True
+        finally:
+            if completed:
+                for queue, process in zip(queues, writer_processes):
+                    _stop_writer(queue, process)
+            else:
+                # The parse workers were killed while writing to the queues, so the
+                # writers may never see a complete item again; their files are
+                # reloaded by the next --incremental run
+                for process in writer_processes:
+                    process.terminate()
+            for process in writer_processes:
+                process.join()
+            while not results.empty():
+                self.instrumentation.merge(results.get())
 
-            if os.path.isdir(user_folder):
-                for plt_file in os.listdir(user_folder):
-                    if plt_file.endswith('.plt'):
-                        file_path = os.path.join(user_folder, plt_file)
-                        self.process_plt_file(file_path, user_id, labels)
+        failed = [p.exitcode for p in writer_processes if p.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"{len(failed)} writer process(es) failed")
 
     def read_labels_file(self, labels_file):
-        labels = {}
-        with open(labels_file, 'r') as f:
-            next(f)
-            for line in f:
-                start_time, end_time, mode = line.strip().split('\t')
-                start_time = datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S')
-                end_time = datetime.strptime(end_time, '%Y/%m/%d %H:%M:%S')
-                labels[start_time] = (end_time, mode)
-        return labels
+        return read_labels_file(labels_file)
 
     def process_plt_file(self, file_path, user_id, labels):
-        with open(file_path, 'r') as f:
-            lines = f.readlines()[6:]  
-            if len(lines) > 2500:
-                return
-
-            start_line = lines[0].strip().split(',')
-            end_line = lines[-1].strip().split(',')
-
-            start_date_time = datetime.strptime(f"{start_line[5]} {start_line[6]}", '%Y-%m-%d %H:%M:%S')
-            end_date_time = datetime.strptime(f"{end_line[5]} {end_line[6]}", '%Y-%m-%d %H:%M:%S')
-
-            label_entry = labels.get(start_date_time, (None, None))
-            transportation_mode = label_entry[1] if label_entry and len(label_entry) > 1 else None
-
-
-            total_distance = 0.0
-            altitude_gain = 0
-            is_valid = True
-            previous_point = None
-
-            trackpoints = []
-            for line in lines:
-                lat, lon, _, altitude, _, date, time = line.strip().split(',')
-                altitude = float(altitude)
-
-                date_time = datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M:%S')
-                current_point = {"lat": float(lat), "lon": float(lon), "altitude": altitude, "date_time": date_time}
-
-                if previous_point:
-                    time_diff = (date_time - previous_point["date_time"]).total_seconds() / 60
-                    if time_diff >= 5:
-                        is_valid = False
-
-                    distance = distance = self.calculate_distance(
-                        previous_point["lat"], previous_point["lon"],
-                        current_point["lat"], current_point["lon"]
-                    )
-                    total_distance += distance
-                    altitude_diff = current_point["altitude"] - previous_point["altitude"]
-                    if altitude_diff > 0:
-                        altitude_gain += altitude_diff
-
-                trackpoints.append({
-                    "activity_id": None,
-                    "lat": current_point["lat"],
-                    "lon": current_point["lon"],
-                    "altitude": current_point["altitude"],
-                    "date_time": current_point["date_time"]
-                })
-                previous_point = current_point
-
-            activity = {
-                "user_id": user_id,
-                "start_date_time": start_date_time,
-                "end_date_time": end_date_time,
-                "transportation_mode": transportation_mode,
-                "total_distance": total_distance,
-                "altitude_gain": altitude_gain,
-                "is_valid": is_valid
-            }
-            activity_id = self.activity_collection.insert_one(activity).inserted_id
-
-            for tp in trackpoints:
-                tp["activity_id"] = activity_id
-            self.trackpoint_collection.insert_many(trackpoints)
-
-    # Define calculate_distance to accept lat/lon pairs:
-    def calculate_distance(self, lat1, lon1, lat2, lon2):
-        R = 6371.0  # Earth radius in kilometers
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        return R * c
+        for chunk in iter_plt_chunks(file_path, user_id, labels, instrumentation=self.instrumentation,
+                                     **self.parse_options):
+            self.write_chunk(chunk)
 
+    def write_chunk(self, chunk):
+        self.buffer.add_chunk(chunk)
+
+    def write_item(self, item):
+        if isinstance(item, IngestedFile):
+            self.buffer.add_file(item)
+        else:
+            self.buffer.add_chunk(item)
+
+    def write_activity(self, activity, trackpoints):
+        return self.buffer.add_activity(activity, trackpoints)
+
+    def create_indexes(self):
+        # Built after the bulk load, so inserts do not pay for index maintenance
+        with self.instrumentation.stage(STAGE_INDEXES):
+            create_indexes(self.db, self.layout)
+
+    def finish(self):
+        self.buffer.flush()
+        if self.rollups_stale:
+            # A crashed run left rollups that no longer match the data
+            rebuild_rollups(self.db)
+            self.rollups_stale = False
+        self.create_indexes()
+        if self.data_changed:
+            # Invalidates the cached query results
+            bump_data_version(self.db)
+        self.instrumentation.progress(force=True)
 
     def close_connection(self):
+        self.buffer.close()
         self.connection.close_connection()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load the Geolife dataset into MongoDB.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes parsing user folders (1 = serial ingest)")
+    parser.add_argument('--writers', type=int, default=DEFAULT_WRITERS,
+                        help="number of processes writing to MongoDB when --workers > 1")
+    parser.add_argument('--flush-docs', type=int, default=DEFAULT_FLUSH_DOCS,
+                        help="flush the write buffer after this many documents")
+    parser.add_argument('--flush-mb', type=float, default=DEFAULT_FLUSH_BYTES / 1024 / 1024,
+                        help="flush the write buffer after this many megabytes of BSON")
+    parser.add_argument('--database', default=None,
+                        help="database to load into (defaults to the DbConnector database)")
+    parser.add_argument('--layout', choices=LAYOUTS, default=LAYOUT_DOCUMENTS,
+                        help="store one document per trackpoint, bucketed trackpoint arrays, "
+                             "or measurements in a time-series collection")
+    parser.add_argument('--bucket-size', type=int, default=BUCKET_SIZE,
+                        help="maximum number of trackpoints per bucket with --layout buckets")
+    parser.add_argument('--no-cells', action='store_true',
+                        help="do not write the CellVisit grid used by the area and co-location queries")
+    parser.add_argument('--cell-precision', type=int, default=DEFAULT_PRECISION,
+                        help="geohash precision of the CellVisit grid")
+    parser.add_argument('--bucket-seconds', type=int, default=DEFAULT_BUCKET_SECONDS,
+                        help="size of the CellVisit time buckets in seconds")
+    parser.add_argument('--simplify', type=float, default=None, metavar='METERS',
+                        help="also store Douglas-Peucker simplified trajectories with this tolerance")
+    parser.add_argument('--simplified-only', action='store_true',
+                        help="store only the simplified trajectories, not the raw trackpoints (needs --simplify)")
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS,
+                        help="files with more trackpoints than this are handled by --oversize")
+    parser.add_argument('--oversize', choices=OVERSIZE_POLICIES, default=OVERSIZE_SKIP,
+                        help="skip oversized files, split them into several activities, or keep them whole")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="number of trackpoints parsed and buffered at a time")
+    parser.add_argument('--split-labels', action='store_true',
+                        help="store one activity per labeled segment of a file instead of one per file")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep the existing data and only load new or changed files (resumes a crashed run)")
+    parser.add_argument('--safe-writes', action='store_true',
+                        help="use the default write concern instead of the faster bulk-load write concern")
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_INTERVAL,
+                        help="seconds between progress lines")
+    parser.add_argument('--stats', default=None,
+                        help="write the per-stage and per-user instrumentation summary to this JSON file")
+    parser.add_argument('--profile', default=None,
+                        help="profile the run with cProfile and write the stats to this file (main process only)")
+    parser.add_argument('--tracemalloc', type=int, default=0, metavar='N',
+                        help="trace allocations and print the N largest allocation sites (main process only)")
+    return parser.parse_args()
+
+
 def main():
-    program = GeolifeMongoDBProgram()
-    program.drop_collections()
-    program.insert_users()
-    program.insert_activities_and_trackpoints()
+    args = parse_args()
+    program = GeolifeMongoDBProgram(flush_docs=args.flush_docs, flush_bytes=int(args.flush_mb * 1024 * 1024),
+                                    database=args.database, layout=args.layout, bucket_size=args.bucket_size,
+                                    max_points=args.max_points, oversize=args.oversize, chunk_size=args.chunk_size,
+                                    bulk_load=not args.safe_writes, split_labels=args.split_labels,
+                                    progress_interval=args.progress_interval, cells=not args.no_cells,
+                                    cell_precision=args.cell_precision, bucket_seconds=args.bucket_seconds,
+                                    simplify_tolerance=args.simplify, simplified_only=args.simplified_only)
+    with profiled(args.profile, args.tracemalloc):
+        if args.incremental:
+            files = program.prepare_incremental()
+        else:
+            program.drop_collections()
+            files = None
+        program.insert_users(upsert=args.incremental)
+        if args.workers > 1:
+            program.insert_activities_and_trackpoints_parallel(args.workers, args.writers, files)
+        else:
+            program.insert_activities_and_trackpoints(files)
+        program.finish()
     program.close_connection()
 
+    print(json.dumps(program.instrumentation.summary(per_user=False), indent=2))
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(program.instrumentation.summary(), f, indent=2)
+
 if __name__ == '__main__':
     main()
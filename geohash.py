@@ -0,0 +1,110 @@
+"""
+Geohash encoding of GPS fixes, vectorized with NumPy.
+
+A geohash of precision p is p base32 characters, 5 * p bits that alternately
+halve the longitude and the latitude range. Every prefix of a geohash is the
+cell containing it, so cells nest: precision 5 is roughly 4.9 x 4.9 km,
+precision 6 1.2 x 0.6 km and precision 7 153 x 153 m.
+"""
+import numpy as np
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+_BASE32_BYTES = np.frombuffer(BASE32.encode(), dtype=np.uint8)
+_BASE32_INDEX = {c: i for i, c in enumerate(BASE32)}
+
+
+def _bits(precision):
+    """(longitude bits, latitude bits) of a geohash; the longitude gets the odd bit."""
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+
+def cell_size(precision):
+    """(height, width) of a cell in degrees."""
+    lon_bits, lat_bits = _bits(precision)
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def cell_indexes(lat, lon, precision):
+    """Row and column of the cells containing the points, as int64 arrays."""
+    lon_bits, lat_bits = _bits(precision)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat_index = np.floor((lat + 90) / 180 * (1 << lat_bits)).astype(np.int64)
+    lon_index = np.floor((lon + 180) / 360 * (1 << lon_bits)).astype(np.int64)
+    # lat 90 and lon 180 belong to the last row and column
+    return np.clip(lat_index, 0, (1 << lat_bits) - 1), np.clip(lon_index, 0, (1 << lon_bits) - 1)
+
+
+def encode_indexes(lat_index, lon_index, precision):
+    """Geohashes of cells given by row and column, as a list of str."""
+    lon_bits, lat_bits = _bits(precision)
+    lat_index = np.asarray(lat_index, dtype=np.int64)
+    lon_index = np.asarray(lon_index, dtype=np.int64)
+    code = np.zeros(lat_index.shape, dtype=np.int64)
+    # Interleave the bits, starting with the most significant longitude bit
+    for k in range(5 * precision):
+        if k % 2 == 0:
+            bit = (lon_index >> (lon_bits - 1 - k // 2)) & 1
+        else:
+            bit = (lat_index >> (lat_bits - 1 - k // 2)) & 1
+        code = (code << 1) | bit
+    shifts = 5 * np.arange(precision - 1, -1, -1, dtype=np.int64)
+    digits = (code.reshape(-1, 1) >> shifts) & 31
+    chars = np.ascontiguousarray(_BASE32_BYTES[digits])
+    return [cell.decode() for cell in chars.view(f"S{precision}").ravel()]
+
+
+def encode_many(lat, lon, precision):
+    """Geohashes of many points, as a list of str."""
+    return encode_indexes(*cell_indexes(lat, lon, precision), precision)
+
+
+def encode(lat, lon, precision):
+    return encode_many([lat], [lon], precision)[0]
+
+
+def decode_indexes(cell):
+    """(row, column) of a geohash."""
+    lon_bits, lat_bits = _bits(len(cell))
+    code = 0
+    for c in cell:
+        code = (code << 5) | _BASE32_INDEX[c]
+    lat_index = lon_index = 0
+    for k in range(5 * len(cell)):
+        bit = (code >> (5 * len(cell) - 1 - k)) & 1
+        if k % 2 == 0:
+            lon_index = (lon_index << 1) | bit
+        else:
+            lat_index = (lat_index << 1) | bit
+    return lat_index, lon_index
+
+
+def bounds(cell):
+    """(south, west, north, east) of a geohash cell."""
+    height, width = cell_size(len(cell))
+    lat_index, lon_index = decode_indexes(cell)
+    south = lat_index * height - 90
+    west = lon_index * width - 180
+    return south, west, south + height, west + width
+
+
+def center(cell):
+    """(lat, lon) of the center of a geohash cell."""
+    south, west, north, east = bounds(cell)
+    return (south + north) / 2, (west + east) / 2
+
+
+def covering(south, west, north, east, precision):
+    """Geohashes of all cells of the given precision that intersect the box."""
+    (south_index, north_index), (west_index, east_index) = cell_indexes([south, north], [west, east], precision)
+    lat_index, lon_index = np.meshgrid(np.arange(south_index, north_index + 1),
+                                       np.arange(west_index, east_index + 1), indexing="ij")
+    return encode_indexes(lat_index.ravel(), lon_index.ravel(), precision)
+
+
+def covering_count(south, west, north, east, precision):
+    """Number of cells covering() would return, without building them."""
+    (south_index, north_index), (west_index, east_index) = cell_indexes([south, north], [west, east], precision)
+    return int(north_index - south_index + 1) * int(east_index - west_index + 1)
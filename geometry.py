@@ -0,0 +1,142 @@
+from collections import namedtuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+# Geolife marks a missing altitude with -777
+MISSING_ALTITUDE = -777
+
+# An activity is invalid if two consecutive trackpoints are this far apart in time
+MAX_GAP_SECONDS = 5 * 60
+
+TrajectoryStats = namedtuple('TrajectoryStats', ['total_distance', 'altitude_gain', 'is_valid'])
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Haversine distance in kilometers. Accepts scalars or NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def segment_distances(lat, lon):
+    """Distance in kilometers between every pair of consecutive points."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    return calculate_distance(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def total_distance(lat, lon):
+    if len(lat) < 2:
+        return 0.0
+    return float(segment_distances(lat, lon).sum())
+
+
+def altitude_gain(alt):
+    """Sum of the positive altitude differences, ignoring missing altitudes."""
+    alt = np.asarray(alt, dtype=np.float64)
+    alt = alt[alt != MISSING_ALTITUDE]
+    if len(alt) < 2:
+        return 0.0
+    diffs = np.diff(alt)
+    return float(diffs[diffs > 0].sum())
+
+
+def time_gaps(epoch):
+    """Seconds between consecutive trackpoints."""
+    return np.diff(np.asarray(epoch, dtype=np.int64))
+
+
+def is_valid(epoch, max_gap=MAX_GAP_SECONDS):
+    return not bool((time_gaps(epoch) >= max_gap).any())
+
+
+def to_epoch(date_times):
+    """Converts a sequence of naive datetimes to int64 epoch seconds."""
+    return np.array(date_times, dtype='datetime64[s]').astype(np.int64)
+
+
+def geojson_point(lat, lon):
+    """GeoJSON Point for a 2dsphere index, or None if the coordinates are out of range."""
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return {"type": "Point", "coordinates": [lon, lat]}
+    return None
+
+
+def haversine_expr(lat1, lon1, lat2, lon2):
+    """
+    Aggregation expression for the haversine distance in kilometers. The
+    arguments are field paths such as "$lat" or numbers.
+    """
+    lat1, lon1, lat2, lon2 = ({"$degreesToRadians": v} for v in (lat1, lon1, lat2, lon2))
+    sin_dlat = {"$sin": {"$divide": [{"$subtract": [lat2, lat1]}, 2]}}
+    sin_dlon = {"$sin": {"$divide": [{"$subtract": [lon2, lon1]}, 2]}}
+    a = {
+        "$add": [
+            {"$multiply": [sin_dlat, sin_dlat]},
+            {"$multiply": [{"$cos": lat1}, {"$cos": lat2}, sin_dlon, sin_dlon]}
+        ]
+    }
+    return {"$multiply": [2 * EARTH_RADIUS_KM, {"$asin": {"$min": [1, {"$sqrt": a}]}}]}
+
+
+def bounding_box(lat, lon, radius_m):
+    """(south, west, north, east) of a box containing the circle around (lat, lon)."""
+    dlat = np.degrees(radius_m / 1000 / EARTH_RADIUS_KM)
+    dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+    return float(lat - dlat), float(lon - dlon), float(lat + dlat), float(lon + dlon)
+
+
+def trajectory_stats(lat, lon, alt, epoch, max_gap=MAX_GAP_SECONDS):
+    """Distance, altitude gain and validity of a whole trajectory."""
+    return TrajectoryStats(
+        total_distance(lat, lon),
+        altitude_gain(alt),
+        is_valid(epoch, max_gap),
+    )
+
+
+class TrajectoryAccumulator:
+    """
+    Trajectory statistics computed chunk by chunk, so a long trajectory never
+    has to be held in memory at once. Gives the same result as trajectory_stats
+    over the concatenated chunks.
+    """
+
+    def __init__(self, max_gap=MAX_GAP_SECONDS):
+        self.max_gap = max_gap
+        self.total_distance = 0.0
+        self.altitude_gain = 0.0
+        self.is_valid = True
+        self._last_point = None  # (lat, lon, epoch) of the last point seen
+        self._last_altitude = None  # last altitude that was not missing
+
+    def update(self, lat, lon, alt, epoch):
+        if len(lat) == 0:
+            return
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        alt = np.asarray(alt, dtype=np.float64)
+        epoch = np.asarray(epoch, dtype=np.int64)
+
+        if self._last_point is not None:
+            last_lat, last_lon, last_epoch = self._last_point
+            lat = np.concatenate(([last_lat], lat))
+            lon = np.concatenate(([last_lon], lon))
+            epoch = np.concatenate(([last_epoch], epoch))
+
+        alt = alt[alt != MISSING_ALTITUDE]
+        if self._last_altitude is not None:
+            alt = np.concatenate(([self._last_altitude], alt))
+
+        self.total_distance += total_distance(lat, lon)
+        self.altitude_gain += altitude_gain(alt)
+        self.is_valid = self.is_valid and is_valid(epoch, self.max_gap)
+
+        self._last_point = (lat[-1], lon[-1], epoch[-1])
+        if len(alt):
+            self._last_altitude = alt[-1]
+
+    def stats(self):
+        return TrajectoryStats(self.total_distance, self.altitude_gain, self.is_valid)
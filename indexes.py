@@ -0,0 +1,63 @@
+"""
+Declared indexes for every collection. They are built once after the bulk
+load (GeolifeMongoDBProgram.create_indexes), not while documents are inserted.
+"""
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+from cells import CELL_COLLECTION
+from layouts import LAYOUT_BUCKETS, LAYOUT_DOCUMENTS, LAYOUT_TIMESERIES, TRACKPOINT_COLLECTIONS
+from simplify import SIMPLIFIED_COLLECTION
+
+INDEXES = {
+    "User": [
+        IndexModel([("has_labels", ASCENDING)], name="has_labels"),
+    ],
+    "Activity": [
+        # user/mode/period filters (2.7) and per-user lookups (2.8, 2.9)
+        IndexModel([("user_id", ASCENDING), ("transportation_mode", ASCENDING), ("start_date_time", ASCENDING)],
+                   name="user_mode_start"),
+        # mode filters without a user (2.4, 2.5, 2.11)
+        IndexModel([("transportation_mode", ASCENDING), ("user_id", ASCENDING)], name="mode_user"),
+    ],
+    CELL_COLLECTION: [
+        # area counts, heatmaps and co-location are lookups on (cell, time_bucket)
+        IndexModel([("cell", ASCENDING), ("time_bucket", ASCENDING), ("user_id", ASCENDING)],
+                   name="cell_time_user"),
+        # the cells a user was in, for co-location with that user
+        IndexModel([("user_id", ASCENDING), ("time_bucket", ASCENDING)], name="user_time"),
+        # removal of the activities of changed files
+        IndexModel([("activity_id", ASCENDING)], name="activity_id"),
+    ],
+    TRACKPOINT_COLLECTIONS[LAYOUT_DOCUMENTS]: [
+        IndexModel([("activity_id", ASCENDING), ("date_time", ASCENDING)], name="activity_time"),
+        IndexModel([("location", GEOSPHERE)], name="location_2dsphere"),
+    ],
+    TRACKPOINT_COLLECTIONS[LAYOUT_BUCKETS]: [
+        IndexModel([("activity_id", ASCENDING), ("seq", ASCENDING)], name="activity_seq"),
+        IndexModel([("bbox.min_lat", ASCENDING), ("bbox.max_lat", ASCENDING),
+                    ("bbox.min_lon", ASCENDING), ("bbox.max_lon", ASCENDING)], name="bbox"),
+    ],
+    # Simplified trajectories are stored in the bucket layout
+    SIMPLIFIED_COLLECTION: [
+        IndexModel([("activity_id", ASCENDING), ("seq", ASCENDING)], name="activity_seq"),
+        IndexModel([("bbox.min_lat", ASCENDING), ("bbox.max_lat", ASCENDING),
+                    ("bbox.min_lon", ASCENDING), ("bbox.max_lon", ASCENDING)], name="bbox"),
+    ],
+    TRACKPOINT_COLLECTIONS[LAYOUT_TIMESERIES]: [
+        IndexModel([("meta.activity_id", ASCENDING), ("date_time", ASCENDING)], name="activity_time"),
+        IndexModel([("location", GEOSPHERE)], name="location_2dsphere"),
+    ],
+}
+
+
+def collections_for_layout(layout):
+    """Collections holding data for the given layout."""
+    trackpoints = TRACKPOINT_COLLECTIONS[layout]
+    return [name for name in INDEXES if name == trackpoints or name not in TRACKPOINT_COLLECTIONS.values()]
+
+
+def create_indexes(db, layout, verbose=True):
+    for collection_name in collections_for_layout(layout):
+        names = db[collection_name].create_indexes(INDEXES[collection_name])
+        if verbose:
+            print(f"Indexes on {collection_name}: {', '.join(names)}")
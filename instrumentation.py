@@ -0,0 +1,164 @@
+"""
+Counters and timers for the ingest stages.
+
+Each stage (listing directories, loading labels, parsing files, trajectory
+math, MongoDB writes, ...) accumulates calls, seconds, rows and bytes, overall
+and per user. Instrumentation prints a progress line every progress_interval
+seconds and produces a JSON-serializable summary at the end. Worker processes
+keep their own Instrumentation and send snapshot() to the main process, which
+merges them.
+
+profiled() turns on cProfile and/or tracemalloc for one run.
+"""
+from contextlib import contextmanager
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+# Stage names used by the ingest
+STAGE_LIST = "list"
+STAGE_LABELS = "labels"
+STAGE_PARSE = "parse"
+STAGE_GEOMETRY = "geometry"
+STAGE_CELLS = "cells"
+STAGE_SIMPLIFY = "simplify"
+STAGE_WRITE = "write"
+STAGE_ROLLUPS = "rollups"
+STAGE_MANIFEST = "manifest"
+STAGE_INDEXES = "indexes"
+
+PROGRESS_INTERVAL = 10.0
+
+
+def _empty_stage():
+    return {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0}
+
+
+def _add_stage(totals, name, calls=0, seconds=0.0, rows=0, nbytes=0):
+    stage = totals.setdefault(name, _empty_stage())
+    stage["calls"] += calls
+    stage["seconds"] += seconds
+    stage["rows"] += rows
+    stage["bytes"] += nbytes
+
+
+def _with_rates(stages):
+    return {
+        name: {
+            **stage,
+            "rows_per_second": stage["rows"] / stage["seconds"] if stage["seconds"] else 0.0,
+            "bytes_per_second": stage["bytes"] / stage["seconds"] if stage["seconds"] else 0.0,
+        }
+        for name, stage in stages.items()
+    }
+
+
+class Instrumentation:
+
+    def __init__(self, enabled=True, verbose=True, progress_interval=PROGRESS_INTERVAL):
+        self.enabled = enabled
+        self.verbose = verbose
+        self.progress_interval = progress_interval
+        self.started = time.perf_counter()
+        self.last_progress = self.started
+        self.stages = {}
+        self.users = {}
+        self.users_done = 0
+
+    @contextmanager
+    def stage(self, name, user_id=None, rows=0, nbytes=0):
+        """Times the block as one call of a stage; rows and bytes can be set on the yielded dict."""
+        if not self.enabled:
+            yield {}
+            return
+        counts = {"rows": rows, "bytes": nbytes}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.record(name, time.perf_counter() - start, counts["rows"], counts["bytes"], user_id, calls=1)
+
+    def record(self, name, seconds=0.0, rows=0, nbytes=0, user_id=None, calls=0):
+        if not self.enabled:
+            return
+        _add_stage(self.stages, name, calls, seconds, rows, nbytes)
+        if user_id is not None:
+            _add_stage(self.users.setdefault(user_id, {}), name, calls, seconds, rows, nbytes)
+
+    def user_done(self, user_id):
+        self.users_done += 1
+        self.progress()
+
+    def snapshot(self):
+        """Raw counters, to be merged into another Instrumentation."""
+        return {"stages": self.stages, "users": self.users, "users_done": self.users_done}
+
+    def merge(self, snapshot):
+        for name, stage in snapshot["stages"].items():
+            _add_stage(self.stages, name, stage["calls"], stage["seconds"], stage["rows"], stage["bytes"])
+        for user_id, stages in snapshot["users"].items():
+            for name, stage in stages.items():
+                _add_stage(self.users.setdefault(user_id, {}), name,
+                           stage["calls"], stage["seconds"], stage["rows"], stage["bytes"])
+        self.users_done += snapshot["users_done"]
+
+    def progress(self, force=False):
+        now = time.perf_counter()
+        if not self.enabled or not self.verbose or (not force and now - self.last_progress < self.progress_interval):
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        parsed = self.stages.get(STAGE_PARSE, _empty_stage())
+        written = self.stages.get(STAGE_WRITE, _empty_stage())
+        print(f"[{elapsed:7.1f} s] {self.users_done} users, "
+              f"{parsed['rows']} points parsed ({parsed['rows'] / elapsed:.0f}/s, "
+              f"{parsed['bytes'] / 1024 / 1024 / elapsed:.1f} MB/s), "
+              f"{written['rows']} documents written ({written['rows'] / elapsed:.0f}/s)")
+
+    def summary(self, per_user=True):
+        summary = {
+            "seconds": time.perf_counter() - self.started,
+            "users_done": self.users_done,
+            "stages": _with_rates(self.stages),
+        }
+        if per_user:
+            summary["users"] = {user_id: _with_rates(stages) for user_id, stages in sorted(self.users.items())}
+        return summary
+
+
+# Used where no instrumentation is passed in
+NO_INSTRUMENTATION = Instrumentation(enabled=False, verbose=False)
+
+
+@contextmanager
+def profiled(profile_path=None, tracemalloc_top=0, top=25):
+    """
+    Profiles the block with cProfile if profile_path is set (the stats are
+    written there and the top functions by cumulative time are printed), and
+    traces allocations if tracemalloc_top > 0 (the peak and the top
+    allocation sites are printed).
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    if tracemalloc_top:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
+            print(out.getvalue())
+            print(f"Profile written to {profile_path}")
+        if tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB")
+            for stat in snapshot.statistics("lineno")[:tracemalloc_top]:
+                print(stat)
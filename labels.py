@@ -0,0 +1,70 @@
+"""
+Transportation mode labels of one user, indexed by time interval.
+
+A labels.txt file lists (start, end, mode) intervals. LabelIndex keeps them
+sorted by start time, so the labels overlapping a trajectory are found with a
+binary search instead of requiring the trajectory to start exactly when a
+label does.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+def read_labels(labels_file):
+    """(start, end, mode) tuples of a Geolife labels.txt file."""
+    labels = []
+    with open(labels_file, 'r') as f:
+        next(f)
+        for line in f:
+            if not line.strip():
+                continue
+            start_time, end_time, mode = line.strip().split('\t')
+            start_time = datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S')
+            end_time = datetime.strptime(end_time, '%Y/%m/%d %H:%M:%S')
+            labels.append((start_time, end_time, mode))
+    return labels
+
+
+class LabelIndex:
+
+    def __init__(self, labels=()):
+        labels = sorted(labels)
+        self.starts = [start for start, _, _ in labels]
+        self.ends = [end for _, end, _ in labels]
+        self.modes = [mode for _, _, mode in labels]
+        # Running maximum of the end times. Labels may overlap, so the ends alone
+        # are not sorted; every label before the first max_end >= t ends before t.
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    @classmethod
+    def from_file(cls, labels_file):
+        return cls(read_labels(labels_file))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, start, end):
+        """Indexes of the labels that overlap [start, end], in start order."""
+        first = bisect_left(self.max_ends, start)
+        last = bisect_right(self.starts, end)
+        return [i for i in range(first, last) if self.ends[i] >= start]
+
+    def mode_for(self, start, end):
+        """Mode of the label overlapping [start, end] the most, or None. Ties go to the earliest label."""
+        best = None
+        best_overlap = None
+        for i in self.overlapping(start, end):
+            overlap = min(end, self.ends[i]) - max(start, self.starts[i])
+            if best_overlap is None or overlap > best_overlap:
+                best, best_overlap = i, overlap
+        return self.modes[best] if best is not None else None
+
+    def label_at(self, t):
+        """Index of the label covering time t (the earliest if several do), or None."""
+        covering = self.overlapping(t, t)
+        return covering[0] if covering else None
+
+    def covers(self, index, t):
+        return index is not None and self.starts[index] <= t <= self.ends[index]
@@ -0,0 +1,104 @@
+"""
+Storage layouts for trackpoints.
+
+documents: one TrackPoint document per GPS fix (the original schema).
+buckets:   TrackPointBucket documents holding up to BUCKET_SIZE consecutive
+           fixes of one activity as lat/lon/altitude/date_time arrays, with the
+           time range and bounding box of the bucket. Buckets are cut at ingest
+           chunk boundaries, so some may hold fewer points.
+timeseries: a MongoDB time-series collection, TrackPointSeries, with one
+           measurement per GPS fix. date_time is the time field and
+           meta = {activity_id, user_id} the meta field, so the server groups
+           the fixes of an activity into compressed buckets itself.
+"""
+
+LAYOUT_DOCUMENTS = "documents"
+LAYOUT_BUCKETS = "buckets"
+LAYOUT_TIMESERIES = "timeseries"
+LAYOUTS = (LAYOUT_DOCUMENTS, LAYOUT_BUCKETS, LAYOUT_TIMESERIES)
+
+TRACKPOINT_COLLECTIONS = {
+    LAYOUT_DOCUMENTS: "TrackPoint",
+    LAYOUT_BUCKETS: "TrackPointBucket",
+    LAYOUT_TIMESERIES: "TrackPointSeries",
+}
+
+# Field of a trackpoint (or bucket) document that holds its activity id
+ACTIVITY_FIELDS = {
+    LAYOUT_DOCUMENTS: "activity_id",
+    LAYOUT_BUCKETS: "activity_id",
+    LAYOUT_TIMESERIES: "meta.activity_id",
+}
+
+# Fixes are a few seconds apart
+TIMESERIES_OPTIONS = {"timeField": "date_time", "metaField": "meta", "granularity": "seconds"}
+
+# Collection with one document describing how the data was loaded
+META_COLLECTION = "Meta"
+
+BUCKET_SIZE = 1000
+
+
+def make_buckets(activity_id, user_id, trackpoints, bucket_size=BUCKET_SIZE, offset=0):
+    """
+    Packs trackpoints of one activity into bucket documents. offset is the
+    position of the first trackpoint in the activity; a bucket's seq is the
+    position of its first trackpoint, so buckets sort by seq.
+    """
+    buckets = []
+    for start in range(0, len(trackpoints), bucket_size):
+        chunk = trackpoints[start:start + bucket_size]
+        lat = [tp["lat"] for tp in chunk]
+        lon = [tp["lon"] for tp in chunk]
+        date_time = [tp["date_time"] for tp in chunk]
+        buckets.append({
+            "activity_id": activity_id,
+            "user_id": user_id,
+            "seq": offset + start,
+            "n": len(chunk),
+            "min_time": min(date_time),
+            "max_time": max(date_time),
+            "bbox": {
+                "min_lat": min(lat),
+                "max_lat": max(lat),
+                "min_lon": min(lon),
+                "max_lon": max(lon),
+            },
+            "lat": lat,
+            "lon": lon,
+            "altitude": [tp["altitude"] for tp in chunk],
+            "date_time": date_time,
+        })
+    return buckets
+
+
+def make_measurement(activity_id, user_id, trackpoint):
+    """Turns a trackpoint dict into a time-series measurement, in place."""
+    trackpoint.pop("activity_id", None)
+    trackpoint["meta"] = {"activity_id": activity_id, "user_id": user_id}
+    return trackpoint
+
+
+def create_trackpoint_collection(db, layout):
+    """Creates the time-series collection up front; the other layouts are created on first insert."""
+    name = TRACKPOINT_COLLECTIONS[layout]
+    if layout == LAYOUT_TIMESERIES and name not in db.list_collection_names():
+        db.create_collection(name, timeseries=TIMESERIES_OPTIONS)
+
+
+def unpack_buckets(buckets, fields=("lat", "lon", "altitude", "date_time")):
+    """Turns bucket documents (sorted by seq) back into trackpoint dicts."""
+    trackpoints = []
+    for bucket in buckets:
+        columns = [bucket[field] for field in fields]
+        trackpoints.extend(dict(zip(fields, values)) for values in zip(*columns))
+    return trackpoints
+
+
+def get_layout(db):
+    meta = db[META_COLLECTION].find_one({"_id": "ingest"})
+    return meta.get("layout", LAYOUT_DOCUMENTS) if meta else LAYOUT_DOCUMENTS
+
+
+def set_layout(db, layout):
+    db[META_COLLECTION].update_one({"_id": "ingest"}, {"$set": {"layout": layout}}, upsert=True)
@@ -0,0 +1,184 @@
+"""
+Manifest of ingested .plt files, used for incremental and resumable ingest.
+
+IngestManifest has one document per file, keyed by its path relative to the
+data folder:
+    {_id, user_id, size, mtime, sha1, activity_ids, status}
+
+The write buffer adds an activity id to its file's entry (status "pending")
+before the activity or any of its trackpoints are written. It marks the entry
+"done" only after everything from the file has been flushed. After a crash,
+the pending entries list exactly the data that has to be removed before the
+file is loaded again.
+"""
+from collections import namedtuple
+import hashlib
+import os
+
+from pymongo import DeleteOne, UpdateOne
+
+from cells import CELL_COLLECTION
+from rollups import apply_rollups
+from simplify import SIMPLIFIED_COLLECTION
+
+MANIFEST_COLLECTION = "IngestManifest"
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+
+# Emitted after the last chunk of a file; the file is done once it is flushed
+IngestedFile = namedtuple('IngestedFile', ['path', 'user_id', 'size', 'mtime', 'sha1'])
+
+# Result of Manifest.plan
+IngestPlan = namedtuple('IngestPlan', ['files', 'stale', 'touched', 'unchanged'])
+
+
+def list_plt_files(data_path, user_id):
+    """Paths of all .plt files of a user, relative to data_path."""
+    user_folder = os.path.join(data_path, user_id, 'Trajectory')
+    if not os.path.isdir(user_folder):
+        return []
+    return [os.path.join(user_id, 'Trajectory', name) for name in os.listdir(user_folder) if name.endswith('.plt')]
+
+
+def file_stat(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime
+
+
+def file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class StreamHash:
+    """SHA-1 fed with a file while it is parsed; see pltreader.iter_plt_points."""
+
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def update(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+
+
+def ingested_file(data_path, path, user_id, stream_hash=None):
+    """
+    Manifest record of a file. stream_hash is used if it saw the whole file;
+    otherwise (e.g. the parser stopped early) the file is read again to hash it.
+    """
+    file_path = os.path.join(data_path, path)
+    size, mtime = file_stat(file_path)
+    if stream_hash is not None and stream_hash.size == size:
+        sha1 = stream_hash.sha1.hexdigest()
+    else:
+        sha1 = file_hash(file_path)
+    return IngestedFile(path, user_id, size, mtime, sha1)
+
+
+class Manifest:
+
+    def __init__(self, db):
+        self.collection = db[MANIFEST_COLLECTION]
+
+    def entries(self):
+        return {entry["_id"]: entry for entry in self.collection.find()}
+
+    def plan(self, data_path, user_ids):
+        """
+        Compares the files on disk with the manifest. Returns an IngestPlan:
+        files maps user_id to the paths that have to be (re)loaded, stale lists
+        manifest entries whose data must be removed first (changed, deleted or
+        unfinished files), touched lists entries with a new mtime but the same
+        content, and unchanged counts the files that are skipped.
+        """
+        entries = self.entries()
+        files = {}
+        stale = []
+        touched = []
+        unchanged = 0
+        on_disk = set()
+
+        for user_id in user_ids:
+            for path in list_plt_files(data_path, user_id):
+                on_disk.add(path)
+                entry = entries.get(path)
+                if entry is not None and entry["status"] == STATUS_DONE:
+                    size, mtime = file_stat(os.path.join(data_path, path))
+                    if size == entry["size"] and mtime == entry["mtime"]:
+                        unchanged += 1
+                        continue
+                    if size == entry["size"] and file_hash(os.path.join(data_path, path)) == entry["sha1"]:
+                        touched.append((path, mtime))
+                        unchanged += 1
+                        continue
+                if entry is not None:
+                    stale.append(entry)
+                files.setdefault(user_id, []).append(path)
+
+        stale.extend(entry for path, entry in entries.items() if path not in on_disk)
+        return IngestPlan(files, stale, touched, unchanged)
+
+    def touch(self, touched):
+        if touched:
+            self.collection.bulk_write([UpdateOne({"_id": path}, {"$set": {"mtime": mtime}})
+                                        for path, mtime in touched], ordered=False)
+
+    def remove(self, db, entries, trackpoint_collection, activity_field="activity_id"):
+        """
+        Deletes the activities, trackpoints (raw and simplified), cell visits
+        and manifest entries of the given files. The rollups are decremented
+        for files that were done; for unfinished files it is unknown how far
+        the rollups got, so the caller has to rebuild them if this returns True.
+        """
+        rebuild_rollups = False
+        for entry in entries:
+            activity_ids = entry.get("activity_ids", [])
+            if entry["status"] == STATUS_DONE:
+                apply_rollups(db, list(db["Activity"].find({"_id": {"$in": activity_ids}})), sign=-1)
+            else:
+                rebuild_rollups = True
+            if activity_ids:
+                trackpoint_collection.delete_many({activity_field: {"$in": activity_ids}})
+                db[CELL_COLLECTION].delete_many({"activity_id": {"$in": activity_ids}})
+                db[SIMPLIFIED_COLLECTION].delete_many({"activity_id": {"$in": activity_ids}})
+                db["Activity"].delete_many({"_id": {"$in": activity_ids}})
+        if entries:
+            self.collection.bulk_write([DeleteOne({"_id": entry["_id"]}) for entry in entries], ordered=False)
+        return rebuild_rollups
+
+    def mark_pending(self, activity_ids_by_file):
+        """Records activity ids for their files before the activities are written."""
+        updates = [
+            UpdateOne(
+                {"_id": path},
+                {
+                    "$set": {"user_id": user_id, "status": STATUS_PENDING},
+                    "$addToSet": {"activity_ids": {"$each": list(activity_ids)}}
+                },
+                upsert=True
+            )
+            for (path, user_id), activity_ids in activity_ids_by_file.items()
+        ]
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+
+    def mark_done(self, files):
+        updates = [
+            UpdateOne(
+                {"_id": f.path},
+                {
+                    "$set": {"user_id": f.user_id, "size": f.size, "mtime": f.mtime,
+                             "sha1": f.sha1, "status": STATUS_DONE},
+                    "$setOnInsert": {"activity_ids": []}
+                },
+                upsert=True
+            )
+            for f in files
+        ]
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is only needed for read_plt_arrays
+    np = None
+
+# Every .plt file starts with six header lines
+HEADER_LINES = 6
+
+# Column 5 counts days since 1899-12-30; this is the offset to the Unix epoch
+EPOCH_DAY_OFFSET = 25569
+SECONDS_PER_DAY = 86400
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+PltArrays = namedtuple('PltArrays', ['lat', 'lon', 'alt', 'epoch'])
+
+
+def parse_timestamp(date, time):
+    """
+    Decodes the fixed-width 'YYYY-MM-DD' and 'HH:MM:SS' fields of a .plt line.
+    Same result as datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M:%S'),
+    without the format parsing.
+    """
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                    int(time[0:2]), int(time[3:5]), int(time[6:8]))
+
+
+def parse_line(line):
+    """Returns (lat, lon, altitude, date_time) for one trackpoint line."""
+    lat, lon, _, altitude, _, date, time = line.rstrip().split(',')
+    return float(lat), float(lon), float(altitude), parse_timestamp(date, time)
+
+
+def iter_plt_points(file_path, digest=None):
+    """
+    Yields the trackpoints of a .plt file one line at a time, as parse_line
+    tuples. digest (e.g. a hashlib object) is updated with every byte read, so
+    the file does not have to be read a second time to hash it.
+    """
+    if digest is None:
+        with open(file_path, 'r') as f:
+            for _ in range(HEADER_LINES):
+                next(f, None)
+            for line in f:
+                if line.strip():
+                    yield parse_line(line)
+        return
+    with open(file_path, 'rb') as f:
+        for number, line in enumerate(f):
+            digest.update(line)
+            if number >= HEADER_LINES and line.strip():
+                yield parse_line(line.decode())
+
+
+def read_plt(file_path):
+    """Reads all trackpoints of a .plt file as (lat, lon, altitude, date_time) tuples."""
+    return list(iter_plt_points(file_path))
+
+
+def read_plt_arrays(file_path):
+    """
+    Reads a .plt file into columnar NumPy arrays: lat, lon and alt as float64
+    and epoch as int64 seconds. The timestamp is taken from the day-number
+    column, rounded to whole seconds.
+    """
+    if np is None:
+        raise ImportError("read_plt_arrays requires numpy")
+
+    data = np.loadtxt(file_path, delimiter=',', skiprows=HEADER_LINES,
+                      usecols=(0, 1, 3, 4), dtype=np.float64, ndmin=2)
+    epoch = np.rint((data[:, 3] - EPOCH_DAY_OFFSET) * SECONDS_PER_DAY).astype(np.int64)
+    return PltArrays(
+        np.ascontiguousarray(data[:, 0]),
+        np.ascontiguousarray(data[:, 1]),
+        np.ascontiguousarray(data[:, 2]),
+        epoch,
+    )
+
+
+def epoch_to_datetime(epoch):
+    return _UNIX_EPOCH + timedelta(seconds=int(epoch))
+
+
+def datetime_to_epoch(date_time):
+    return int((date_time - _UNIX_EPOCH).total_seconds())
@@ -0,0 +1,55 @@
+"""
+Presentation of query results.
+
+The Queries iter_* methods yield typed rows (namedtuples, or documents as
+dicts). This module turns them into tables with tabulate. Rows are consumed
+and printed page_size at a time, so printing a large result never holds more
+than one page in memory.
+"""
+from itertools import islice
+
+from tabulate import tabulate
+
+PAGE_SIZE = 50
+
+
+def pages(rows, page_size=PAGE_SIZE):
+    """Lists of up to page_size rows, consumed lazily from rows."""
+    rows = iter(rows)
+    while True:
+        page = list(islice(rows, page_size))
+        if not page:
+            return
+        yield page
+
+
+def headers_for(row):
+    """Field names of a namedtuple row, or "keys" for dicts."""
+    return list(row._fields) if hasattr(row, "_fields") else "keys"
+
+
+def _tabulate(page, floatfmt):
+    # Ids such as user "010" are strings and must not be parsed as numbers
+    first = page[0]
+    values = first.values() if isinstance(first, dict) else first
+    text_columns = [i for i, value in enumerate(values) if isinstance(value, str)]
+    return tabulate(page, headers=headers_for(first), floatfmt=floatfmt, disable_numparse=text_columns)
+
+
+def format_rows(rows, page_size=PAGE_SIZE, floatfmt=".2f"):
+    """Yields one table per page of rows."""
+    for page in pages(rows, page_size):
+        yield _tabulate(page, floatfmt)
+
+
+def print_rows(rows, title=None, page_size=PAGE_SIZE, floatfmt=".2f"):
+    """Prints rows as tables of page_size rows; returns the number of rows printed."""
+    if title:
+        print(title)
+    count = 0
+    for page in pages(rows, page_size):
+        print(_tabulate(page, floatfmt))
+        count += len(page)
+    if not count:
+        print("(no rows)")
+    return count
@@ -1,197 +1,606 @@
+from collections import Counter, namedtuple
 from datetime import datetime
+import functools
+import inspect
+from pprint import pformat
+import re
+from cells import CELL_COLLECTION, floor_time, get_grid
 from DbConnector import DbConnector;
-from math import radians, sin, cos, sqrt, atan2
-from pprint import pprint
+import geohash
+import geometry
+from layouts import ACTIVITY_FIELDS, LAYOUT_BUCKETS, LAYOUT_TIMESERIES, TRACKPOINT_COLLECTIONS, get_layout
+from present import print_rows
+from resultcache import RESULT_COLLECTION, ResultCache
+from rollups import ROLLUP_COLLECTION
+from simplify import (SIMPLIFIED_COLLECTION, TIER_RAW, TIER_SIMPLIFIED, TIERS, get_simplification,
+                      simplification_report)
+from trajcache import DEFAULT_CACHE_BYTES, TrajectoryCache
+
+
+# Landmarks for the proximity queries, as (lat, lon)
+LANDMARKS = {
+    "forbidden_city": (39.916, 116.397),
+}
+
+FORBIDDEN_CITY_RADIUS_M = 500
+
+# Tasks that can be answered from the UserStats rollups take method="rollup"
+ROLLUP_METHODS = ("aggregate", "rollup")
+
+# total_distance: haversine sums on the client, on the server, or Activity.total_distance
+DISTANCE_METHODS = ("client", "window", "stored")
+
+# find_invalid_activities: gap check in Python after a $lookup, on the server, from
+# Activity.is_valid, or in Python on trajectories from the cache
+INVALID_METHODS = ("lookup", "window", "stored", "cache")
+
+# Area queries cover their box with at most this many cells; larger boxes are
+# covered with coarser cells, matched as geohash prefixes
+MAX_COVER_CELLS = 2000
+
+# Time buckets looked up per query by colocated_with
+COLOCATION_BATCH = 500
+
+# Documents fetched per round trip by the iter_* methods
+DEFAULT_BATCH_SIZE = 1000
+
+# Rows yielded by the iter_* methods
+CollectionRow = namedtuple('CollectionRow', ['collection', 'document'])
+CollectionCount = namedtuple('CollectionCount', ['collection', 'count'])
+AverageActivities = namedtuple('AverageActivities', ['average_activities'])
+UserRow = namedtuple('UserRow', ['user_id'])
+UserActivities = namedtuple('UserActivities', ['user_id', 'activities'])
+ModeActivities = namedtuple('ModeActivities', ['mode', 'activities'])
+YearActivities = namedtuple('YearActivities', ['year', 'activities'])
+YearHours = namedtuple('YearHours', ['year', 'hours'])
+Distance = namedtuple('Distance', ['user_id', 'mode', 'start', 'end', 'distance_km'])
+UserAltitudeGain = namedtuple('UserAltitudeGain', ['user_id', 'altitude_gain'])
+UserInvalidActivities = namedtuple('UserInvalidActivities', ['user_id', 'invalid_count'])
+UserMode = namedtuple('UserMode', ['user_id', 'most_used_mode'])
+
+# Row types by name, to rebuild the rows of results read back from the QueryCache collection
+ROW_TYPES = {row_type.__name__: row_type for row_type in (
+    CollectionRow, CollectionCount, AverageActivities, UserRow, UserActivities, ModeActivities, YearActivities,
+    YearHours, Distance, UserAltitudeGain, UserInvalidActivities, UserMode
+)}
+
+# Every task in the order of the assignment
+TASKS = [
+    "top_10_rows",
+    "count_entries",
+    "average_activities_per_user",
+    "top_20_users_with_highest_activities",
+    "users_taken_taxi",
+    "count_transportation_modes",
+    "year_with_most_activities",
+    "year_with_most_hours",
+    "total_distance_walked_2008",
+    "top_20_altitude_gains",
+    "find_invalid_activities",
+    "find_users_in_forbidden_city",
+    "most_used_transport_mode",
+]
+
+
+def cached_task(task):
+    """
+    Serves a task from Queries.result_cache if there is one. The key is the
+    task name, its arguments (defaults filled in), the tier and layout, and
+    the data version; see resultcache.py.
+    """
+    signature = inspect.signature(task)
+
+    @functools.wraps(task)
+    def wrapper(self, *args, **kwargs):
+        if self.result_cache is None:
+            return task(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = {name: value for name, value in bound.arguments.items() if name != "self"}
+        params.update(tier=self.tier, layout=self.layout)
+        hit, result, version = self.result_cache.get(task.__name__, params)
+        if hit:
+            self._show_cached(task.__name__, result)
+            return result
+        result = task(self, *args, **kwargs)
+        # Stored under the version read before the task ran, never a later one
+        self.result_cache.put(task.__name__, params, result, version)
+        return result
+
+    return wrapper
 
 
 class Queries:    
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, database=None, layout=None, verbose=True, cache_bytes=DEFAULT_CACHE_BYTES, tier=None,
+                 cache_results=False, results_file=None, results_collection=None):
+        self.connection = DbConnector(DATABASE=database)
         self.db = self.connection.db
-        
-    def calculate_distance(self, lat1, lon1, lat2, lon2):
-        R = 6371.0  # Radius of Earth in kilometers
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        return R * c
+        # Trackpoints are read from the raw tier, or from the simplified one if it was
+        # loaded; the default is raw unless only the simplified points were stored
+        self.simplification = get_simplification(self.db)
+        self.tier = tier or (TIER_RAW if self.simplification is None or self.simplification.raw
+                             else TIER_SIMPLIFIED)
+        if self.tier not in TIERS:
+            raise ValueError(f"Unknown tier: {self.tier} (expected one of {', '.join(TIERS)})")
+        if self.tier == TIER_SIMPLIFIED:
+            if self.simplification is None:
+                raise ValueError("The database has no simplified trajectories")
+            # The simplified tier is stored in the bucket layout
+            self.layout = LAYOUT_BUCKETS
+            self.trackpoint_collection = self.db[SIMPLIFIED_COLLECTION]
+        else:
+            # The layout the data was loaded with is recorded in the Meta collection
+            self.layout = layout or get_layout(self.db)
+            self.trackpoint_collection = self.db[TRACKPOINT_COLLECTIONS[self.layout]]
+        self.activity_field = ACTIVITY_FIELDS[self.layout]
+        # Geohash cells and time buckets the trackpoints were summarized into at ingest
+        self.cell_collection = self.db[CELL_COLLECTION]
+        self.grid = get_grid(self.db)
+        # Tasks print their results unless verbose is False; they also return them
+        self.verbose = verbose
+        # Decoded trajectories, reused by the tasks that compute on the client
+        self.trajectories = TrajectoryCache(self.trackpoint_collection, self.layout, cache_bytes)
+        # Task results, kept until ingest changes the data version. results_file and
+        # results_collection (True for QueryCache) also persist them
+        if results_collection is True:
+            results_collection = RESULT_COLLECTION
+        self.result_cache = (ResultCache(self.db, results_file, results_collection, row_types=ROW_TYPES)
+                             if cache_results or results_file or results_collection else None)
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def show(self, title, rows):
+        """Prints rows as a table unless verbose is False; see present.print_rows."""
+        if self.verbose:
+            print_rows(rows, title)
+
+    def _show_cached(self, task, result):
+        if not self.verbose:
+            return
+        title = f"{task} (cached for data version {self.result_cache.data_version()}):"
+        if isinstance(result, list):
+            print_rows(result, title)
+        else:
+            self.log(title)
+            self.log(pformat(result))
+
+    def _trackpoint_stages(self):
+        """
+        Aggregation stages on the trackpoint collection that give one document
+        per trackpoint with activity_id, lat, lon, altitude and date_time,
+        whatever the storage layout.
+        """
+        if self.layout == LAYOUT_TIMESERIES:
+            return [
+                {
+                    "$project": {
+                        "_id": 0,
+                        "activity_id": "$meta.activity_id",
+                        "user_id": "$meta.user_id",
+                        "lat": 1,
+                        "lon": 1,
+                        "altitude": 1,
+                        "date_time": 1
+                    }
+                }
+            ]
+        if self.layout != LAYOUT_BUCKETS:
+            return []
+        return [
+            {"$unwind": {"path": "$date_time", "includeArrayIndex": "i"}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "activity_id": 1,
+                    "user_id": 1,
+                    "lat": {"$arrayElemAt": ["$lat", "$i"]},
+                    "lon": {"$arrayElemAt": ["$lon", "$i"]},
+                    "altitude": {"$arrayElemAt": ["$altitude", "$i"]},
+                    "date_time": 1
+                }
+            }
+        ]
+
+    def _trackpoint_times_lookup(self):
+        """Stages that add the date_time of every trackpoint to Activity documents as trackpoint_times."""
+        if self.layout == LAYOUT_BUCKETS:
+            return [
+                {"$lookup": {"from": self.trackpoint_collection.name, "localField": "_id",
+                             "foreignField": "activity_id", "as": "buckets"}},
+                {
+                    "$project": {
+                        "user_id": 1,
+                        "trackpoint_times": {
+                            "$reduce": {
+                                "input": "$buckets.date_time",
+                                "initialValue": [],
+                                "in": {"$concatArrays": ["$$value", "$$this"]}
+                            }
+                        }
+                    }
+                }
+            ]
+        return [
+            {"$lookup": {"from": self.trackpoint_collection.name, "localField": "_id",
+                         "foreignField": self.activity_field, "as": "trackpoints"}},
+            {"$project": {"user_id": 1, "trackpoint_times": "$trackpoints.date_time"}}
+        ]
+
+    def _check_method(self, method, methods):
+        if method not in methods:
+            raise ValueError(f"Unknown method: {method} (expected one of {', '.join(methods)})")
+
+    def _keeps_gaps(self, max_gap):
+        """Whether the trackpoints read have a gap of max_gap seconds or more exactly where the raw ones do."""
+        if self.tier == TIER_RAW:
+            return True
+        # Simplification never opens a gap of simplification.max_gap or more; see simplify.py
+        return self.simplification.max_gap is not None and max_gap >= self.simplification.max_gap
+
+    def _rollup_map_pipeline(self, field):
+        """Sums one of the UserStats maps over all users, as {_id: key, count: total}."""
+        return [
+            {"$project": {"entries": {"$objectToArray": f"${field}"}}},
+            {"$unwind": "$entries"},
+            {"$group": {"_id": "$entries.k", "count": {"$sum": "$entries.v"}}},
+            {"$match": {"count": {"$gt": 0}}}
+        ]
+
+    def _count_trackpoints(self):
+        if self.layout == LAYOUT_BUCKETS:
+            result = list(self.trackpoint_collection.aggregate([{"$group": {"_id": None, "count": {"$sum": "$n"}}}]))
+            return result[0]["count"] if result else 0
+        return self.trackpoint_collection.count_documents({})
     
     # task 1
+    @cached_task
     def top_10_rows(self):
-        print("Top 10 rows from the User collection:")
-        user_rows = list(self.db["User"].find().limit(10))
-        for row in user_rows:
-            pprint(row)
+        rows = {"User": [], "Activity": [], "TrackPoint": []}
+        for row in self.iter_top_10_rows():
+            rows[row.collection].append(row.document)
+        for collection, documents in rows.items():
+            self.show(f"Top 10 rows from the {collection} collection:", documents)
+        return rows
 
-        print("\nTop 10 rows from the Activity collection:")
-        activity_rows = list(self.db["Activity"].find().limit(10))
-        for row in activity_rows:
-            pprint(row)
-
-        print("\nTop 10 rows from the TrackPoint collection:")
-        trackpoint_rows = list(self.db["TrackPoint"].find().limit(10))
-        for row in trackpoint_rows:
-            pprint(row)
+    def iter_top_10_rows(self, limit=10, projections=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        CollectionRows with the first limit documents of User, Activity and
+        TrackPoint. projections maps a collection name to a projection.
+        """
+        projections = projections or {}
+        for collection in ("User", "Activity", "TrackPoint"):
+            for document in self.iter_documents(collection, projection=projections.get(collection),
+                                                limit=limit, batch_size=batch_size):
+                yield CollectionRow(collection, document)
 
+    def iter_documents(self, collection, query=None, projection=None, limit=0, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Streams the documents of a collection from the server, batch_size at a
+        time. "TrackPoint" reads the trackpoint collection of the layout as one
+        document per trackpoint (see _trackpoint_stages), which query and
+        projection then apply to.
+        """
+        if collection != "TrackPoint":
+            yield from self.db[collection].find(query or {}, projection, limit=limit, batch_size=batch_size)
+            return
+        pipeline = [
+            *self._trackpoint_stages(),
+            *([{"$match": query}] if query else []),
+            *([{"$limit": limit}] if limit else []),
+            *([{"$project": projection}] if projection else [])
+        ]
+        yield from self.trackpoint_collection.aggregate(pipeline, batchSize=batch_size, allowDiskUse=True)
 
     # task 2.1
+    @cached_task
     def count_entries(self):
-        user_count = self.db['User'].count_documents({})
-        print(f"Total Users: {user_count}")
+        rows = list(self.iter_count_entries())
+        self.show("Number of documents per collection:", rows)
+        return {row.collection: row.count for row in rows}
 
-        activity_count = self.db['Activity'].count_documents({})
-        print(f"Total Activities: {activity_count}")
+    def iter_count_entries(self):
+        yield CollectionCount("User", self.db['User'].count_documents({}))
+        yield CollectionCount("Activity", self.db['Activity'].count_documents({}))
+        yield CollectionCount("TrackPoint", self._count_trackpoints())
 
-        trackpoint_count = self.db['TrackPoint'].count_documents({})
-        print(f"Total TrackPoints: {trackpoint_count}")
-        
     # task 2.2
-    def average_activities_per_user(self):
-        pipeline = [
-            {
-                "$group": {
-                    "_id": "$user_id",
-                    "activity_count": {"$sum": 1}
-                }
-            },
-            {
-                "$group": {
-                    "_id": None,  # Single document result
-                    "avg_activities_per_user": {"$avg": "$activity_count"}  # Calculate the average
-                }
-            }
-        ]
-        
-        result = list(self.db["Activity"].aggregate(pipeline))
-        
-        if result:
-            avg_activities = result[0]['avg_activities_per_user']
-            print(f"Average number of activities per user: {avg_activities:.2f}")
+    @cached_task
+    def average_activities_per_user(self, method="aggregate"):
+        rows = list(self.iter_average_activities_per_user(method))
+        self.show("Average number of activities per user:", rows)
+        return rows[0].average_activities if rows else None
+
+    def iter_average_activities_per_user(self, method="aggregate"):
+        self._check_method(method, ROLLUP_METHODS)
+        if method == "rollup":
+            collection = self.db[ROLLUP_COLLECTION]
+            pipeline = [
+                {"$match": {"activity_count": {"$gt": 0}}},
+                {"$group": {"_id": None, "avg_activities_per_user": {"$avg": "$activity_count"}}}
+            ]
         else:
-            print("No activities found.")
-    
+            collection = self.db["Activity"]
+            pipeline = [
+                {
+                    "$group": {
+                        "_id": "$user_id",
+                        "activity_count": {"$sum": 1}
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": None,  # Single document result
+                        "avg_activities_per_user": {"$avg": "$activity_count"}  # Calculate the average
+                    }
+                }
+            ]
+
+        for doc in collection.aggregate(pipeline):
+            yield AverageActivities(doc['avg_activities_per_user'])
+
     # task 2.3
-    def top_20_users_with_highest_activities(self):
-        pipeline = [
-            {
-                '$group': {
-                    '_id': '$user_id',
-                    'activity_count': {'$sum': 1}
+    @cached_task
+    def top_20_users_with_highest_activities(self, method="aggregate"):
+        rows = list(self.iter_top_20_users_with_highest_activities(method))
+        self.show("Top 20 users with the highest number of activities:", rows)
+        return rows
+
+    def iter_top_20_users_with_highest_activities(self, method="aggregate", limit=20, batch_size=DEFAULT_BATCH_SIZE):
+        self._check_method(method, ROLLUP_METHODS)
+        if method == "rollup":
+            result = self.db[ROLLUP_COLLECTION].find(
+                {"activity_count": {"$gt": 0}}, {"activity_count": 1}, batch_size=batch_size
+            ).sort("activity_count", -1).limit(limit)
+        else:
+            pipeline = [
+                {
+                    '$group': {
+                        '_id': '$user_id',
+                        'activity_count': {'$sum': 1}
+                    }
+                },
+                {
+                    '$sort': {'activity_count': -1}
+                },
+                {
+                    '$limit': limit
                 }
-            },
-            {
-                '$sort': {'activity_count': -1}
-            },
-            {
-                '$limit': 20
-            }
-        ]
-        result = self.db['Activity'].aggregate(pipeline)
-        print("Top 20 users with the highest number of activities:")
+            ]
+            result = self.db['Activity'].aggregate(pipeline, batchSize=batch_size)
         for row in result:
-            print(f"User ID: {row['_id']}, Activities: {row['activity_count']}")
+            yield UserActivities(row['_id'], row['activity_count'])
 
     # task 2.4
+    @cached_task
     def users_taken_taxi(self):
-        result = self.db['Activity'].distinct("user_id", {"transportation_mode": "taxi"})
-        
-        print("Users who have taken a taxi:")
-        for user in result:
-            print(f"User ID: {user}")
-    
-    # task 2.5
-    def count_transportation_modes(self):
+        rows = list(self.iter_users_taken_taxi())
+        self.show("Users who have taken a taxi:", rows)
+        return [row.user_id for row in rows]
+
+    def iter_users_taken_taxi(self, batch_size=DEFAULT_BATCH_SIZE):
         pipeline = [
-            {"$match": {"transportation_mode": {"$ne": None}}},  # Exclude null values
-            {"$group": {"_id": "$transportation_mode", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}  # Sort by count in descending order
+            {"$match": {"transportation_mode": "taxi"}},
+            {"$group": {"_id": "$user_id"}},
+            {"$sort": {"_id": 1}}
         ]
-        
-        result = self.db['Activity'].aggregate(pipeline)
-        
-        print("Transportation modes and their activity counts:")
-        for doc in result:
-            print(f"Mode: {doc['_id']}, Activities: {doc['count']}")
-    
+        for doc in self.db['Activity'].aggregate(pipeline, batchSize=batch_size):
+            yield UserRow(doc['_id'])
+
+    # task 2.5
+    @cached_task
+    def count_transportation_modes(self, method="aggregate"):
+        rows = list(self.iter_count_transportation_modes(method))
+        self.show("Transportation modes and their activity counts:", rows)
+        return rows
+
+    def iter_count_transportation_modes(self, method="aggregate", batch_size=DEFAULT_BATCH_SIZE):
+        self._check_method(method, ROLLUP_METHODS)
+        if method == "rollup":
+            collection = self.db[ROLLUP_COLLECTION]
+            pipeline = self._rollup_map_pipeline("mode_counts") + [{"$sort": {"count": -1}}]
+        else:
+            collection = self.db['Activity']
+            pipeline = [
+                {"$match": {"transportation_mode": {"$ne": None}}},  # Exclude null values
+                {"$group": {"_id": "$transportation_mode", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}}  # Sort by count in descending order
+            ]
+
+        for doc in collection.aggregate(pipeline, batchSize=batch_size):
+            yield ModeActivities(doc['_id'], doc['count'])
+
     # task 2.6a)
-    def year_with_most_activities(self):
-        pipeline = [
-            {"$group": {"_id": {"$year": "$start_date_time"}, "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 1}
-        ]
-        
-        result = self.db['Activity'].aggregate(pipeline)
-        
-        for doc in result:
-            print(f"Year with the most activities: {doc['_id']} ({doc['count']} activities)")
-        
+    @cached_task
+    def year_with_most_activities(self, method="aggregate"):
+        rows = list(self.iter_year_with_most_activities(method))
+        self.show("Year with the most activities:", rows)
+        return rows[0] if rows else None
+
+    def iter_year_with_most_activities(self, method="aggregate", limit=1):
+        """YearActivities rows, the year with the most activities first."""
+        self._check_method(method, ROLLUP_METHODS)
+        if method == "rollup":
+            collection = self.db[ROLLUP_COLLECTION]
+            pipeline = self._rollup_map_pipeline("year_counts") + [
+                {"$project": {"_id": {"$toInt": "$_id"}, "count": 1}},
+                {"$sort": {"count": -1}},
+                {"$limit": limit}
+            ]
+        else:
+            collection = self.db['Activity']
+            pipeline = [
+                {"$group": {"_id": {"$year": "$start_date_time"}, "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}},
+                {"$limit": limit}
+            ]
+
+        for doc in collection.aggregate(pipeline):
+            yield YearActivities(doc['_id'], doc['count'])
+
     # task b)
-    def year_with_most_hours(self):
-        pipeline = [
-            {"$group": {
-                "_id": {"$year": "$start_date_time"},
-                "total_hours": {
-                    "$sum": {
-                        "$divide": [
-                            {"$subtract": ["$end_date_time", "$start_date_time"]},  # Difference in milliseconds
-                            1000 * 60 * 60  # Convert to hours
-                        ]
+    @cached_task
+    def year_with_most_hours(self, method="aggregate"):
+        rows = list(self.iter_year_with_most_hours(method))
+        self.show("Year with the most recorded hours:", rows)
+        return rows[0] if rows else None
+
+    def iter_year_with_most_hours(self, method="aggregate", limit=1):
+        """YearHours rows, the year with the most recorded hours first."""
+        self._check_method(method, ROLLUP_METHODS)
+        if method == "rollup":
+            collection = self.db[ROLLUP_COLLECTION]
+            pipeline = self._rollup_map_pipeline("year_hours") + [
+                {"$project": {"_id": {"$toInt": "$_id"}, "total_hours": "$count"}},
+                {"$sort": {"total_hours": -1}},
+                {"$limit": limit}
+            ]
+        else:
+            collection = self.db['Activity']
+            pipeline = [
+                {"$group": {
+                    "_id": {"$year": "$start_date_time"},
+                    "total_hours": {
+                        "$sum": {
+                            "$divide": [
+                                {"$subtract": ["$end_date_time", "$start_date_time"]},  # Difference in milliseconds
+                                1000 * 60 * 60  # Convert to hours
+                            ]
+                        }
                     }
-                }
-            }},
-            {"$sort": {"total_hours": -1}},
-            {"$limit": 1}
-        ]
-        
-        result = self.db['Activity'].aggregate(pipeline)
-        
-        for doc in result:
-            print(f"Year with the most recorded hours: {doc['_id']} ({doc['total_hours']:.2f} hours)")    
-    
+                }},
+                {"$sort": {"total_hours": -1}},
+                {"$limit": limit}
+            ]
+
+        for doc in collection.aggregate(pipeline):
+            yield YearHours(doc['_id'], doc['total_hours'])
+
     # task 2.7
-    def total_distance_walked_2008(self):
-        print("Retrieving walking activities for user 112 in 2008...")
+    @cached_task
+    def total_distance_walked_2008(self, method="client"):
+        self.log("Calculating the distance walked by user 112 in 2008...")
+        rows = list(self.iter_total_distance_walked_2008(method))
+        self.show("Total distance walked in 2008 by user 112:", rows)
+        return rows[0].distance_km
 
-        activity_docs = self.db["Activity"].find(
-            {
-                "user_id": "112",
-                "transportation_mode": "walk",
-                "start_date_time": {
-                    "$gte": datetime(2008, 1, 1),  
-                    "$lt": datetime(2009, 1, 1)
-                }
-            },
-            {"_id": 1}
-        )
+    def iter_total_distance_walked_2008(self, method="client"):
+        start, end = datetime(2008, 1, 1), datetime(2009, 1, 1)
+        yield Distance("112", "walk", start, end, self.total_distance("112", "walk", start, end, method))
 
-        activity_ids = [activity["_id"] for activity in activity_docs]
-        print(f"Found {len(activity_ids)} walking activities for user 112 in 2008.")
+    def total_distance(self, user_id=None, mode=None, start=None, end=None, method="client"):
+        """
+        Distance in km covered in the activities of a user (all users if None)
+        with a transportation mode (any if None) that started in [start, end).
 
-        total_distance = 0.0
+        method="client" fetches the trackpoints of every activity and sums the
+        distances in Python, "window" sums them on the server with
+        $setWindowFields and "stored" sums the total_distance computed for
+        each Activity at ingest.
+        """
+        self._check_method(method, DISTANCE_METHODS)
+        match = self._activity_filter(user_id, mode, start, end)
+        if method == "stored":
+            result = list(self.db["Activity"].aggregate([
+                {"$match": match},
+                {"$group": {"_id": None, "total_distance": {"$sum": "$total_distance"}}}
+            ]))
+            return result[0]["total_distance"] if result else 0.0
 
-        for activity_id in activity_ids:
-            trackpoints = list(self.db["TrackPoint"].find(
-                {"activity_id": activity_id},
-                sort=[("date_time", 1)]
-            ))
+        activity_ids = [activity["_id"] for activity in self.db["Activity"].find(match, {"_id": 1})]
+        self.log(f"Found {len(activity_ids)} matching activities.")
+        if method == "window":
+            return self._total_distance_window(activity_ids)
 
-            if len(trackpoints) < 2:
-                print(f"Not enough trackpoints to calculate distance for activity {activity_id}.")
+        total_distance = 0.0
+        for activity_id, trajectory in self.trajectories.get_many(activity_ids):
+            if len(trajectory.lat) < 2:
+                self.log(f"Not enough trackpoints to calculate distance for activity {activity_id}.")
                 continue
-            
-            for i in range(1, len(trackpoints)):
-                lat1, lon1 = trackpoints[i - 1]["lat"], trackpoints[i - 1]["lon"]
-                lat2, lon2 = trackpoints[i]["lat"], trackpoints[i]["lon"]
-                distance = self.calculate_distance(lat1, lon1, lat2, lon2)
-                total_distance += distance
 
-        print(f"Total distance walked in 2008 by user 112: {total_distance:.2f} km")
+            total_distance += geometry.total_distance(trajectory.lat, trajectory.lon)
+        return total_distance
+
+    def _activity_filter(self, user_id=None, mode=None, start=None, end=None):
+        match = {}
+        if user_id is not None:
+            match["user_id"] = user_id
+        if mode is not None:
+            match["transportation_mode"] = mode
+        if start is not None or end is not None:
+            match["start_date_time"] = {
+                **({"$gte": start} if start is not None else {}),
+                **({"$lt": end} if end is not None else {})
+            }
+        return match
+
+    def _total_distance_window(self, activity_ids):
+        pipeline = [
+            {"$match": {self.activity_field: {"$in": activity_ids}}},
+            *self._trackpoint_stages(),
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$activity_id",
+                    "sortBy": {"date_time": 1},
+                    "output": {
+                        "previous_lat": {"$shift": {"output": "$lat", "by": -1}},
+                        "previous_lon": {"$shift": {"output": "$lon", "by": -1}}
+                    }
+                }
+            },
+            {
+                # The first point of an activity has no previous point
+                "$group": {
+                    "_id": None,
+                    "total_distance": {
+                        "$sum": {
+                            "$cond": [
+                                {"$eq": ["$previous_lat", None]},
+                                0,
+                                geometry.haversine_expr("$previous_lat", "$previous_lon", "$lat", "$lon")
+                            ]
+                        }
+                    }
+                }
+            }
+        ]
+        result = list(self.trackpoint_collection.aggregate(pipeline, allowDiskUse=True))
+        return result[0]["total_distance"] if result else 0.0
 
-    
     # task 2.8
-    def top_20_altitude_gains(self):
+    @cached_task
+    def top_20_altitude_gains(self, method="window"):
+        rows = list(self.iter_top_20_altitude_gains(method))
+        self.show("Top 20 users with the highest altitude gains (meters):", rows)
+        return rows
+
+    def iter_top_20_altitude_gains(self, method="window", limit=20, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        UserAltitudeGain rows, highest gain first.
+
+        method="loop" fetches the altitudes of every activity to the client,
+        "window" computes the gains on the server with $setWindowFields and
+        "stored" sums the altitude_gain computed for each Activity at ingest.
+        The simplified tier drops altitudes, so it always uses "stored", which
+        was computed from the raw points.
+        """
+        if self.tier == TIER_SIMPLIFIED and method != "stored":
+            self.log(f"The simplified tier has no raw altitudes; using method 'stored' instead of '{method}'.")
+            method = "stored"
+        if method == "loop":
+            top_users = self._top_altitude_gains_loop(limit)
+        elif method == "window":
+            top_users = self._top_altitude_gains_window(limit, batch_size)
+        elif method == "stored":
+            top_users = self._top_altitude_gains_stored(limit, batch_size)
+        else:
+            raise ValueError(f"Unknown method for top_20_altitude_gains: {method}")
+
+        for user_id, altitude_gain in top_users:
+            yield UserAltitudeGain(user_id, altitude_gain)
+
+    def _top_altitude_gains_loop(self, limit):
         # Dictionary to store total altitude gain for each user
         altitude_gain_by_user = {}
 
@@ -199,121 +608,298 @@ class Queries:
             user_id = user["_id"]
             total_altitude_gain = 0.0
 
-            activities = list(self.db["Activity"].find({"user_id": user_id}))
+            activity_ids = self.db["Activity"].distinct("_id", {"user_id": user_id})
             
             # Debug: Print number of activities for the user
-            print(f"Processing User {user_id}, Number of activities: {len(activities)}")
+            self.log(f"Processing User {user_id}, Number of activities: {len(activity_ids)}")
             
-            for activity in activities:
-                activity_id = activity["_id"]
-
-                trackpoints = list(self.db["TrackPoint"].find({"activity_id": activity_id, "altitude": {"$gt": -777}}).sort("date_time", 1))
-                
-                
-                for i in range(1, len(trackpoints)):
-                    previous_altitude = trackpoints[i - 1]["altitude"]
-                    current_altitude = trackpoints[i]["altitude"]
-
-                    if current_altitude > previous_altitude:
-                        total_altitude_gain += (current_altitude - previous_altitude)
+            for _, trajectory in self.trajectories.get_many(activity_ids):
+                # Missing altitudes (-777) are skipped by altitude_gain
+                total_altitude_gain += geometry.altitude_gain(trajectory.alt)
 
             altitude_gain_by_user[user_id] = total_altitude_gain
 
-        top_users = sorted(altitude_gain_by_user.items(), key=lambda x: x[1], reverse=True)[:20]
+        return sorted(altitude_gain_by_user.items(), key=lambda x: x[1], reverse=True)[:limit]
 
-        # Print results
-        print("Top 20 users with the highest altitude gains:")
-        for user_id, altitude_gain in top_users:
-            print(f"User ID: {user_id}, Altitude Gain: {altitude_gain:.2f} meters")
+    def _top_altitude_gains_window(self, limit, batch_size):
+        # Every trackpoint is read, so missing altitudes (-777) are not excluded with a
+        # leading $match (which check_indexes would flag as an unindexed filter). They
+        # are turned into nulls and carried over by $locf instead: a point is compared
+        # with the last point before it that has an altitude, as in geometry.altitude_gain
+        pipeline = [
+            *self._trackpoint_stages(),
+            {
+                "$set": {
+                    "altitude": {
+                        "$cond": [{"$eq": ["$altitude", geometry.MISSING_ALTITUDE]}, None, "$altitude"]
+                    }
+                }
+            },
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$activity_id",
+                    "sortBy": {"date_time": 1},
+                    "output": {
+                        "last_altitude": {"$locf": "$altitude"}
+                    }
+                }
+            },
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$activity_id",
+                    "sortBy": {"date_time": 1},
+                    "output": {
+                        "previous_altitude": {"$shift": {"output": "$last_altitude", "by": -1}}
+                    }
+                }
+            },
+            {
+                # Points without an altitude, and the first point with one, subtract a
+                # null; $max ignores it
+                "$group": {
+                    "_id": "$activity_id",
+                    "altitude_gain": {
+                        "$sum": {"$max": [{"$subtract": ["$altitude", "$previous_altitude"]}, 0]}
+                    }
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "Activity",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "activity"
+                }
+            },
+            {"$unwind": "$activity"},
+            {"$group": {"_id": "$activity.user_id", "altitude_gain": {"$sum": "$altitude_gain"}}},
+            {"$sort": {"altitude_gain": -1}},
+            {"$limit": limit}
+        ]
+        result = self.trackpoint_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+        return ((doc["_id"], doc["altitude_gain"]) for doc in result)
+
+    def _top_altitude_gains_stored(self, limit, batch_size):
+        pipeline = [
+            {"$group": {"_id": "$user_id", "altitude_gain": {"$sum": "$altitude_gain"}}},
+            {"$sort": {"altitude_gain": -1}},
+            {"$limit": limit}
+        ]
+        return ((doc["_id"], doc["altitude_gain"]) for doc in self.db["Activity"].aggregate(pipeline,
+                                                                                            batchSize=batch_size))
 
 
     # task 2.9
-    def find_invalid_activities(self):
-        print("Finding users with invalid activities...")
+    @cached_task
+    def find_invalid_activities(self, max_gap=geometry.MAX_GAP_SECONDS, users=None, method="window"):
+        """
+        Number of invalid activities per user: activities with two consecutive
+        trackpoints max_gap seconds or more apart. users defaults to the users
+        with labels. See iter_invalid_activities for the methods.
+        """
+        self.log("Finding users with invalid activities...")
+        rows = list(self.iter_invalid_activities(max_gap, users, method))
+        self.show(f"Users with invalid activities (time deviation >= {max_gap / 60:g} minutes):", rows)
+        return {row.user_id: row.invalid_count for row in rows}
+
+    def iter_invalid_activities(self, max_gap=geometry.MAX_GAP_SECONDS, users=None, method="window",
+                                batch_size=DEFAULT_BATCH_SIZE):
+        """
+        UserInvalidActivities rows sorted by user id.
 
-        self.db["TrackPoint"].create_index("activity_id")
-        self.db["Activity"].create_index("user_id")
+        method="lookup" joins the trackpoint times onto each activity and
+        checks the gaps in Python, "window" finds the largest gap of each
+        activity on the server with $setWindowFields, and "stored" counts the
+        is_valid flags computed at ingest (only for the default max_gap) and
+        "cache" checks the gaps in Python on trajectories from the cache.
+        On the simplified tier a max_gap below the one the tier keeps uses
+        "stored" instead.
+        """
+        self._check_method(method, INVALID_METHODS)
+        if method != "stored" and not self._keeps_gaps(max_gap):
+            if max_gap != geometry.MAX_GAP_SECONDS:
+                raise ValueError(f"The simplified tier does not keep gaps of {max_gap} seconds; "
+                                 f"use the raw tier")
+            self.log(f"The simplified tier does not keep the time gaps; using method 'stored' instead of '{method}'.")
+            method = "stored"
+        if users is None:
+            users = self.db["User"].distinct("_id", {"has_labels": True})
 
-        users_with_labels = self.db["User"].distinct("_id", {"has_labels": True})
+        if method == "stored":
+            if max_gap != geometry.MAX_GAP_SECONDS:
+                raise ValueError(f"is_valid was stored for a gap of {geometry.MAX_GAP_SECONDS} seconds")
+            result = self.db["Activity"].aggregate([
+                {"$match": {"user_id": {"$in": users}, "is_valid": False}},
+                {"$group": {"_id": "$user_id", "invalid_count": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ], batchSize=batch_size)
+        elif method == "window":
+            result = self._invalid_activities_window(max_gap, users, batch_size)
+        elif method == "cache":
+            result = self._invalid_activities_cache(max_gap, users)
+        else:
+            result = self._invalid_activities_lookup(max_gap, users, batch_size)
+        for doc in result:
+            yield UserInvalidActivities(doc["_id"], doc["invalid_count"])
 
+    def _invalid_activities_window(self, max_gap, users, batch_size):
+        activity_ids = self.db["Activity"].distinct("_id", {"user_id": {"$in": users}})
         pipeline = [
+            {"$match": {self.activity_field: {"$in": activity_ids}}},
+            *self._trackpoint_stages(),
             {
-                "$match": {
-                    "user_id": {"$in": users_with_labels}  
+                "$setWindowFields": {
+                    "partitionBy": "$activity_id",
+                    "sortBy": {"date_time": 1},
+                    "output": {
+                        "previous_time": {"$shift": {"output": "$date_time", "by": -1}}
+                    }
+                }
+            },
+            {
+                # The first point has no previous time; $max ignores the null
+                "$group": {
+                    "_id": "$activity_id",
+                    "max_gap_ms": {"$max": {"$subtract": ["$date_time", "$previous_time"]}}
                 }
             },
+            {"$match": {"max_gap_ms": {"$gte": max_gap * 1000}}},
             {
                 "$lookup": {
-                    "from": "TrackPoint", 
-                    "localField": "_id",  
-                    "foreignField": "activity_id",
-                    "as": "trackpoints"
+                    "from": "Activity",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "activity"
                 }
             },
+            {"$unwind": "$activity"},
+            {"$group": {"_id": "$activity.user_id", "invalid_count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ]
+        return self.trackpoint_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    def _invalid_activities_cache(self, max_gap, users):
+        user_by_activity = {activity["_id"]: activity["user_id"]
+                            for activity in self.db["Activity"].find({"user_id": {"$in": users}}, {"user_id": 1})}
+        invalid_activities_per_user = {}
+        for activity_id, trajectory in self.trajectories.get_many(user_by_activity):
+            if not geometry.is_valid(trajectory.epoch, max_gap):
+                user_id = user_by_activity[activity_id]
+                invalid_activities_per_user[user_id] = invalid_activities_per_user.get(user_id, 0) + 1
+        return iter([{"_id": user_id, "invalid_count": count}
+                     for user_id, count in sorted(invalid_activities_per_user.items())])
+
+    def _invalid_activities_lookup(self, max_gap, users, batch_size):
+        pipeline = [
             {
                 "$match": {
-                    "trackpoints.1": {"$exists": True}  # Only activities with at least 2 trackpoints
+                    "user_id": {"$in": users}  
                 }
             },
+            *self._trackpoint_times_lookup(),
             {
-                "$project": {
-                    "user_id": 1,
-                    "trackpoints.date_time": 1  
+                "$match": {
+                    "trackpoint_times.1": {"$exists": True}  # Only activities with at least 2 trackpoints
                 }
             }
         ]
 
-        activities = list(self.db["Activity"].aggregate(pipeline))
-        
-        if not activities:
-            print("No activities found with the specified criteria.")
-            return {}
-
         # Dictionary to store invalid activity count per user
         invalid_activities_per_user = {}
 
-        for activity in activities:
+        # Activities stream in batches; only the per-user counts are kept
+        for activity in self.db["Activity"].aggregate(pipeline, batchSize=batch_size):
             user_id = activity['user_id']
-            trackpoints = activity['trackpoints']
+            trackpoint_times = sorted(activity['trackpoint_times'])
 
-            trackpoints = sorted(trackpoints, key=lambda tp: tp['date_time'])
-
-            trackpoint_times = [tp['date_time'] for tp in trackpoints if 'date_time' in tp]
-            
-            # Check if any consecutive trackpoints have a time deviation of >= 5 minutes
-            is_invalid = any(
-                (trackpoint_times[i] - trackpoint_times[i - 1]).total_seconds() >= 300
-                for i in range(1, len(trackpoint_times))
-            )
+            # Check if any consecutive trackpoints have a time deviation of >= max_gap
+            is_invalid = not geometry.is_valid(geometry.to_epoch(trackpoint_times), max_gap)
 
             if is_invalid:
                 invalid_activities_per_user[user_id] = invalid_activities_per_user.get(user_id, 0) + 1
 
-        sorted_invalid_activities = sorted(invalid_activities_per_user.items())
-
-        print("Users with invalid activities (time deviation >= 5 minutes):")
-        for user_id, invalid_count in sorted_invalid_activities:
-            print(f"User ID: {user_id}, Invalid Activities: {invalid_count}")
+        return iter([{"_id": user_id, "invalid_count": count}
+                     for user_id, count in sorted(invalid_activities_per_user.items())])
 
     # task 2.10
+    @cached_task
     def find_users_in_forbidden_city(self):
-        forbidden_city_lat = 39.916
-        forbidden_city_lon = 116.397
-        threshold = 0.005  # Small threshold to account for proximity around the Forbidden City
+        rows = list(self.iter_users_in_forbidden_city())
+        self.show("Users who have tracked an activity in the Forbidden City:", rows)
+        return [row.user_id for row in rows]
 
-        pipeline = [
-            {
-                "$match": {
-                    "$and": [
-                        {"lat": {"$gt": forbidden_city_lat - threshold, "$lt": forbidden_city_lat + threshold}},
-                        {"lon": {"$gt": forbidden_city_lon - threshold, "$lt": forbidden_city_lon + threshold}}
-                    ]
+    def iter_users_in_forbidden_city(self, radius_m=FORBIDDEN_CITY_RADIUS_M):
+        forbidden_city_lat, forbidden_city_lon = LANDMARKS["forbidden_city"]
+        for user_id in self.users_near(forbidden_city_lat, forbidden_city_lon, radius_m):
+            yield UserRow(user_id)
+
+    def users_near(self, lat, lon, radius_m):
+        """Sorted ids of the users with a trackpoint within radius_m meters of (lat, lon)."""
+        return self.users_near_landmarks({"point": (lat, lon)}, radius_m)["point"]
+
+    def users_near_landmarks(self, landmarks, radius_m):
+        """
+        Users near each of several landmarks, in one aggregation.
+        landmarks maps a name to (lat, lon); returns name -> sorted user ids.
+        """
+        if not landmarks:
+            return {}
+        pipelines = [self._users_near_pipeline(name, lat, lon, radius_m) for name, (lat, lon) in landmarks.items()]
+        pipeline = pipelines[0] + [
+            {"$unionWith": {"coll": self.trackpoint_collection.name, "pipeline": other}}
+            for other in pipelines[1:]
+        ]
+
+        users = {name: [] for name in landmarks}
+        for doc in self.trackpoint_collection.aggregate(pipeline):
+            users[doc["landmark"]].append(doc["user_id"])
+        return {name: sorted(user_ids) for name, user_ids in users.items()}
+
+    def _users_near_pipeline(self, name, lat, lon, radius_m):
+        if self.layout == LAYOUT_BUCKETS:
+            # Buckets whose bounding box overlaps the circle, then an exact distance check per point.
+            # Buckets carry the user_id, so no join with Activity is needed.
+            south, west, north, east = geometry.bounding_box(lat, lon, radius_m)
+            return [
+                {
+                    "$match": {
+                        "bbox.min_lat": {"$lte": north},
+                        "bbox.max_lat": {"$gte": south},
+                        "bbox.min_lon": {"$lte": east},
+                        "bbox.max_lon": {"$gte": west}
+                    }
+                },
+                *self._trackpoint_stages(),
+                {"$match": {"$expr": {"$lte": [geometry.haversine_expr("$lat", "$lon", lat, lon), radius_m / 1000]}}},
+                {"$group": {"_id": "$user_id"}},
+                {"$project": {"_id": 0, "landmark": {"$literal": name}, "user_id": "$_id"}}
+            ]
+
+        near = {
+            "$match": {
+                "location": {
+                    "$geoWithin": {
+                        "$centerSphere": [[lon, lat], radius_m / 1000 / geometry.EARTH_RADIUS_KM]
+                    }
                 }
-            },
+            }
+        }
+        if self.layout == LAYOUT_TIMESERIES:
+            # Measurements carry the user_id in their meta field
+            return [
+                near,
+                {"$group": {"_id": "$meta.user_id"}},
+                {"$project": {"_id": 0, "landmark": {"$literal": name}, "user_id": "$_id"}}
+            ]
+
+        return [
+            near,
+            # One row per activity before the join, not one per matching trackpoint
+            {"$group": {"_id": "$activity_id"}},
             {
                 "$lookup": {
                     "from": "Activity",
-                    "localField": "activity_id",
+                    "localField": "_id",
                     "foreignField": "_id",
                     "as": "activity"
                 }
@@ -325,17 +911,19 @@ class Queries:
                 "$group": {
                     "_id": "$activity.user_id"
                 }
-            }
+            },
+            {"$project": {"_id": 0, "landmark": {"$literal": name}, "user_id": "$_id"}}
         ]
-
-        result = self.db['TrackPoint'].aggregate(pipeline)
-
-        print("Users who have tracked an activity in the Forbidden City:")
-        for doc in result:
-            print(f"User ID: {doc['_id']}")
     
     #task 2.11
-    def most_used_transport_mode(self):
+    @cached_task
+    def most_used_transport_mode(self, method="aggregate"):
+        rows = list(self.iter_most_used_transport_mode(method))
+        self.show("User and their most used transportation mode:", rows)
+        return rows
+
+    def iter_most_used_transport_mode(self, method="aggregate", batch_size=DEFAULT_BATCH_SIZE):
+        self._check_method(method, ROLLUP_METHODS)
         pipeline = [
             {
                 "$match": {
@@ -372,12 +960,140 @@ class Queries:
             }
         ]
 
-        result = self.db['Activity'].aggregate(pipeline)
+        if method == "rollup":
+            # Most used mode per user from the mode_counts map; ties go to the first mode by name
+            for doc in self.db[ROLLUP_COLLECTION].find({}, {"mode_counts": 1}, batch_size=batch_size).sort("_id", 1):
+                counts = {mode: count for mode, count in doc.get("mode_counts", {}).items() if count > 0}
+                if counts:
+                    yield UserMode(doc["_id"], min(counts, key=lambda m: (-counts[m], m)))
+        else:
+            for doc in self.db['Activity'].aggregate(pipeline, batchSize=batch_size):
+                yield UserMode(doc['_id'], doc['most_used_mode'])
 
-        print("User and their most used transportation mode:")
-        for doc in result:
-            print(f"User ID: {doc['_id']}, Most Used Mode: {doc['most_used_mode']}")
 
+    def simplification_report(self):
+        """Compression ratio and distance error of the simplified tier, or None if there is none."""
+        report = simplification_report(self.db)
+        if report is not None:
+            self.log(f"Simplified at {report['tolerance_m']} m: {report['raw_points']} -> {report['points']} "
+                     f"trackpoints ({report['compression_ratio']:.1f}x), distance error "
+                     f"{report['total_distance_error']:.2%} overall, {report['mean_distance_error']:.2%} mean, "
+                     f"{report['max_distance_error']:.2%} max per activity")
+        return report
+
+    def _cell_filter(self, bbox=None, start=None, end=None):
+        """
+        CellVisit filter for the cells intersecting bbox = (south, west, north,
+        east) and the time buckets overlapping [start, end).
+        """
+        query = {}
+        if bbox is not None:
+            precision = self.grid.precision
+            while precision > 1 and geohash.covering_count(*bbox, precision) > MAX_COVER_CELLS:
+                precision -= 1
+            cells = geohash.covering(*bbox, precision)
+            if precision == self.grid.precision:
+                query["cell"] = {"$in": cells}
+            else:
+                query["cell"] = {"$in": [re.compile("^" + cell) for cell in cells]}
+        if start is not None or end is not None:
+            query["time_bucket"] = {}
+            if start is not None:
+                query["time_bucket"]["$gte"] = floor_time(start, self.grid.bucket_seconds)
+            if end is not None:
+                query["time_bucket"]["$lt"] = end
+        return query
+
+    def area_counts(self, south, west, north, east, start=None, end=None):
+        """
+        Trackpoints, activities and users in a box during [start, end), at the
+        resolution of the grid: every cell intersecting the box counts whole.
+        """
+        pipeline = [
+            {"$match": self._cell_filter((south, west, north, east), start, end)},
+            {
+                "$group": {
+                    "_id": None,
+                    "points": {"$sum": "$n"},
+                    "activities": {"$addToSet": "$activity_id"},
+                    "users": {"$addToSet": "$user_id"}
+                }
+            },
+            {"$project": {"_id": 0, "points": 1, "activities": {"$size": "$activities"},
+                          "users": {"$size": "$users"}}}
+        ]
+        result = list(self.cell_collection.aggregate(pipeline))
+        return result[0] if result else {"points": 0, "activities": 0, "users": 0}
+
+    def heatmap(self, bbox=None, start=None, end=None, precision=None, limit=None):
+        """
+        Trackpoints and users per cell, busiest first, as dicts with cell,
+        lat, lon (the center of the cell), points and users. precision below
+        the grid's aggregates into coarser cells.
+        """
+        precision = min(precision or self.grid.precision, self.grid.precision)
+        cell = "$cell" if precision == self.grid.precision else {"$substrCP": ["$cell", 0, precision]}
+        pipeline = [
+            {"$match": self._cell_filter(bbox, start, end)},
+            {"$group": {"_id": cell, "points": {"$sum": "$n"}, "users": {"$addToSet": "$user_id"}}},
+            {"$project": {"points": 1, "users": {"$size": "$users"}}},
+            {"$sort": {"points": -1, "_id": 1}},
+            *([{"$limit": limit}] if limit else [])
+        ]
+        rows = []
+        for doc in self.cell_collection.aggregate(pipeline, allowDiskUse=True):
+            lat, lon = geohash.center(doc["_id"])
+            rows.append({"cell": doc["_id"], "lat": lat, "lon": lon, "points": doc["points"], "users": doc["users"]})
+        return rows
+
+    def colocated_with(self, user_id, start=None, end=None):
+        """
+        Users who were in the same cell during the same time bucket as user_id,
+        as (user_id, shared cell-time slots), most shared first.
+        """
+        slots = {}
+        for visit in self.cell_collection.find({"user_id": user_id, **self._cell_filter(None, start, end)},
+                                               {"_id": 0, "cell": 1, "time_bucket": 1}):
+            slots.setdefault(visit["time_bucket"], set()).add(visit["cell"])
+
+        shared = Counter()
+        buckets = sorted(slots)
+        for first in range(0, len(buckets), COLOCATION_BATCH):
+            batch = buckets[first:first + COLOCATION_BATCH]
+            pipeline = [
+                {
+                    "$match": {
+                        "$or": [{"cell": {"$in": sorted(slots[bucket])}, "time_bucket": bucket} for bucket in batch],
+                        "user_id": {"$ne": user_id}
+                    }
+                },
+                {"$group": {"_id": {"user_id": "$user_id", "cell": "$cell", "time_bucket": "$time_bucket"}}},
+                {"$group": {"_id": "$_id.user_id", "slots": {"$sum": 1}}}
+            ]
+            for doc in self.cell_collection.aggregate(pipeline):
+                shared[doc["_id"]] += doc["slots"]
+        return sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+
+    def colocations(self, start=None, end=None, min_slots=1, bbox=None):
+        """
+        Pairs of users who were in the same cell during the same time bucket,
+        as (user_a, user_b, shared cell-time slots) with user_a < user_b, most
+        shared first.
+        """
+        pipeline = [
+            {"$match": self._cell_filter(bbox, start, end)},
+            {"$group": {"_id": {"cell": "$cell", "time_bucket": "$time_bucket"}, "users": {"$addToSet": "$user_id"}}},
+            {"$match": {"users.1": {"$exists": True}}},
+            {"$project": {"a": "$users", "b": "$users"}},
+            {"$unwind": "$a"},
+            {"$unwind": "$b"},
+            {"$match": {"$expr": {"$lt": ["$a", "$b"]}}},
+            {"$group": {"_id": {"a": "$a", "b": "$b"}, "slots": {"$sum": 1}}},
+            {"$match": {"slots": {"$gte": min_slots}}},
+            {"$sort": {"slots": -1, "_id.a": 1, "_id.b": 1}}
+        ]
+        return [(doc["_id"]["a"], doc["_id"]["b"], doc["slots"])
+                for doc in self.cell_collection.aggregate(pipeline, allowDiskUse=True)]
 
     def close_connection(self):
         self.connection.close_connection()
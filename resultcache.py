@@ -0,0 +1,216 @@
+"""
+Cache of Queries task results, invalidated when the data changes.
+
+Ingest (and every rebuild of a derived collection) stamps the Meta collection
+with a new data_version. Results are keyed by task name, parameters and the
+data version, so a new load makes every older entry unreachable without any
+explicit invalidation. Entries are held in memory (LRU) and can also be
+persisted to a local pickle file or a MongoDB collection, so they survive
+restarts and are shared between processes. The collection is shared, so
+results are stored there as plain BSON (see to_bson), never pickled; row
+namedtuples are rebuilt from the row_types the cache is given.
+
+The data version itself is re-read from Meta at most every version_ttl
+seconds; within that window a repeat call is a dictionary lookup.
+"""
+from collections import OrderedDict
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidDocument
+
+from layouts import META_COLLECTION
+
+RESULT_COLLECTION = "QueryCache"
+
+DEFAULT_MAX_ENTRIES = 1024
+
+# Seconds a data version read from Meta is trusted before it is read again
+VERSION_TTL = 1.0
+
+
+def get_data_version(db):
+    meta = db[META_COLLECTION].find_one({"_id": "ingest"}, {"data_version": 1})
+    return meta.get("data_version") if meta else None
+
+
+def bump_data_version(db):
+    """Stamps the data with a new version; unique, so a reload never reuses an old stamp."""
+    version = str(ObjectId())
+    db[META_COLLECTION].update_one({"_id": "ingest"}, {"$set": {"data_version": version}}, upsert=True)
+    return version
+
+
+def result_key(task, params, version):
+    """Cache key of a task result; params must be picklable and are compared by value."""
+    digest = hashlib.sha1(pickle.dumps(sorted(params.items()), protocol=4)).hexdigest()
+    return f"{task}:{version}:{digest}"
+
+
+def to_bson(value):
+    """
+    BSON-safe form of a result. Namedtuples, tuples and dicts are tagged so
+    from_bson can rebuild them; dicts are stored as key/value pairs, so their
+    keys need not be strings.
+    """
+    if hasattr(value, "_fields"):
+        return {"__row__": type(value).__name__, "values": [to_bson(item) for item in value]}
+    if isinstance(value, tuple):
+        return {"__tuple__": [to_bson(item) for item in value]}
+    if isinstance(value, list):
+        return [to_bson(item) for item in value]
+    if isinstance(value, dict):
+        return {"__dict__": [[to_bson(key), to_bson(item)] for key, item in value.items()]}
+    return value
+
+
+def from_bson(value, row_types):
+    """Result stored by to_bson; raises KeyError for a row type not in row_types."""
+    if isinstance(value, list):
+        return [from_bson(item, row_types) for item in value]
+    if isinstance(value, dict):
+        if "__row__" in value:
+            return row_types[value["__row__"]](*(from_bson(item, row_types) for item in value["values"]))
+        if "__tuple__" in value:
+            return tuple(from_bson(item, row_types) for item in value["__tuple__"])
+        return {from_bson(key, row_types): from_bson(item, row_types) for key, item in value["__dict__"]}
+    return value
+
+
+class ResultCache:
+
+    def __init__(self, db, path=None, collection=None, max_entries=DEFAULT_MAX_ENTRIES, version_ttl=VERSION_TTL,
+                 row_types=None):
+        self.db = db
+        self.path = path
+        self.collection = db[collection] if collection else None
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        # Name -> namedtuple class of the rows in results read back from the collection
+        self.row_types = row_types or {}
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_read = None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._entries.update(pickle.load(f))
+
+    def data_version(self):
+        now = time.monotonic()
+        if self._version_read is None or now - self._version_read >= self.version_ttl:
+            version = get_data_version(self.db)
+            with self._lock:
+                if version != self._version:
+                    self._drop_other_versions(version)
+                self._version, self._version_read = version, now
+        return self._version
+
+    def get(self, task, params):
+        """
+        (True, result, version) on a hit, (False, None, version) on a miss.
+        version is the data version the lookup was made for; a result computed
+        after a miss is stored with put under that version.
+        """
+        version = self.data_version()
+        key = result_key(task, params, version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, _copy(self._entries[key]), version
+        if self.collection is not None:
+            hit, result = self._from_document(self.collection.find_one({"_id": key}, {"value": 1}))
+            if hit:
+                with self._lock:
+                    self._store(key, result)
+                    self.hits += 1
+                return True, _copy(result), version
+        with self._lock:
+            self.misses += 1
+        return False, None, version
+
+    def put(self, task, params, result, version):
+        """
+        Stores a result computed for the data version get returned. The version
+        is not read again: data that changed while the task ran must not be
+        stamped onto a result computed before the change.
+        """
+        key = result_key(task, params, version)
+        with self._lock:
+            if version != self._version:
+                # The data changed while the task ran; its entries were already dropped
+                return
+            self._store(key, _copy(result))
+            if self.path:
+                self._save()
+        if self.collection is not None:
+            try:
+                self.collection.replace_one(
+                    {"_id": key},
+                    {"_id": key, "task": task, "data_version": version, "value": to_bson(result)},
+                    upsert=True
+                )
+            except InvalidDocument:
+                # Results with values BSON cannot hold are only cached locally
+                pass
+
+    def _from_document(self, doc):
+        """(True, result) for a collection entry, (False, None) if there is none or it cannot be read."""
+        # Entries written before results were stored as BSON have no value
+        if doc is None or "value" not in doc:
+            return False, None
+        try:
+            return True, from_bson(doc["value"], self.row_types)
+        except KeyError:
+            # A row type this cache was not given
+            return False, None
+
+    def _store(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _drop_other_versions(self, version):
+        # Entries of other versions can never be hit again
+        stale = [key for key in self._entries if key.split(":")[1] != str(version)]
+        for key in stale:
+            del self._entries[key]
+        if stale and self.path:
+            self._save()
+        if self.collection is not None:
+            self.collection.delete_many({"data_version": {"$ne": version}})
+
+    def _save(self):
+        # Written to a temporary file first, so a crash never leaves a truncated cache
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+            pickle.dump(dict(self._entries), f, protocol=4)
+        os.replace(f.name, self.path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+        if self.collection is not None:
+            self.collection.delete_many({})
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _copy(result):
+    # Results can nest containers (e.g. top_10_rows maps collections to lists of
+    # documents), so callers get a deep copy and cannot change a cached result
+    return copy.deepcopy(result)
@@ -0,0 +1,118 @@
+"""
+Per-user summary collection maintained at ingest.
+
+UserStats has one document per user with activity_count, total_hours,
+total_distance, altitude_gain and three maps: mode_counts (transportation mode
+-> activities), year_counts (start year -> activities) and year_hours (start
+year -> hours). Ingest adds each flushed batch of activities with $inc; the
+collection can be regenerated from Activity with rebuild_rollups.
+
+Run:
+    python rollups.py --rebuild [--database NAME]
+"""
+import argparse
+
+from pymongo import UpdateOne
+
+from DbConnector import DbConnector
+from resultcache import bump_data_version
+
+ROLLUP_COLLECTION = "UserStats"
+
+MILLISECONDS_PER_HOUR = 1000 * 60 * 60
+
+
+def activity_hours(activity):
+    return (activity["end_date_time"] - activity["start_date_time"]).total_seconds() / 3600
+
+
+def rollup_increments(activity, sign=1):
+    """$inc fields for adding (sign=1) or removing (sign=-1) one activity."""
+    year = str(activity["start_date_time"].year)
+    hours = activity_hours(activity)
+    increments = {
+        "activity_count": sign,
+        "total_hours": sign * hours,
+        "total_distance": sign * activity["total_distance"],
+        "altitude_gain": sign * activity["altitude_gain"],
+        f"year_counts.{year}": sign,
+        f"year_hours.{year}": sign * hours,
+    }
+    if activity["transportation_mode"] is not None:
+        increments[f"mode_counts.{activity['transportation_mode']}"] = sign
+    return increments
+
+
+def rollup_updates(activities, sign=1):
+    """One upserting UpdateOne per user, summing the increments of all their activities."""
+    by_user = {}
+    for activity in activities:
+        increments = by_user.setdefault(activity["user_id"], {})
+        for field, value in rollup_increments(activity, sign).items():
+            increments[field] = increments.get(field, 0) + value
+    return [UpdateOne({"_id": user_id}, {"$inc": increments}, upsert=True) for user_id, increments in by_user.items()]
+
+
+def apply_rollups(db, activities, sign=1):
+    updates = rollup_updates(activities, sign)
+    if updates:
+        db[ROLLUP_COLLECTION].bulk_write(updates, ordered=False)
+
+
+def _merge_map_pipeline(key_expr, value_expr, field, match=None):
+    # Groups Activity by (user, key) and merges the result into UserStats as a map
+    return [
+        *([{"$match": match}] if match else []),
+        {"$group": {"_id": {"user_id": "$user_id", "key": key_expr}, "value": {"$sum": value_expr}}},
+        {"$group": {"_id": "$_id.user_id", field: {"$push": {"k": "$_id.key", "v": "$value"}}}},
+        {"$project": {field: {"$arrayToObject": f"${field}"}}},
+        {"$merge": {"into": ROLLUP_COLLECTION, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ]
+
+
+def rebuild_rollups(db):
+    """Regenerates UserStats from the Activity collection."""
+    hours = {"$divide": [{"$subtract": ["$end_date_time", "$start_date_time"]}, MILLISECONDS_PER_HOUR]}
+    year = {"$toString": {"$year": "$start_date_time"}}
+    activities = db["Activity"]
+
+    db[ROLLUP_COLLECTION].drop()
+    activities.aggregate([
+        {
+            "$group": {
+                "_id": "$user_id",
+                "activity_count": {"$sum": 1},
+                "total_hours": {"$sum": hours},
+                "total_distance": {"$sum": "$total_distance"},
+                "altitude_gain": {"$sum": "$altitude_gain"}
+            }
+        },
+        {"$merge": {"into": ROLLUP_COLLECTION, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ], allowDiskUse=True)
+    activities.aggregate(_merge_map_pipeline("$transportation_mode", 1, "mode_counts",
+                                             {"transportation_mode": {"$ne": None}}), allowDiskUse=True)
+    activities.aggregate(_merge_map_pipeline(year, 1, "year_counts"), allowDiskUse=True)
+    activities.aggregate(_merge_map_pipeline(year, hours, "year_hours"), allowDiskUse=True)
+    bump_data_version(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the UserStats rollup collection.")
+    parser.add_argument('--rebuild', action='store_true', help="regenerate UserStats from Activity")
+    parser.add_argument('--database', default=None)
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.print_help()
+        return
+
+    connection = DbConnector(DATABASE=args.database)
+    try:
+        rebuild_rollups(connection.db)
+        print(f"Rebuilt {connection.db[ROLLUP_COLLECTION].count_documents({})} {ROLLUP_COLLECTION} documents.")
+    finally:
+        connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
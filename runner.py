@@ -0,0 +1,125 @@
+"""
+Runs Queries tasks concurrently and collects their results and wall times.
+
+The tasks are independent reads, so they share one Queries instance (and its
+pooled client) and run on a thread pool; the report takes about as long as the
+slowest task instead of the sum of all of them.
+
+Run:
+    python runner.py [--tasks count_entries users_taken_taxi] [--workers N]
+                     [--method top_20_altitude_gains=stored] [--tier simplified] [--results-file FILE]
+                     [--show] [--json FILE]
+"""
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pprint import pformat
+import time
+
+from tabulate import tabulate
+
+from present import print_rows
+from queries import TASKS, Queries
+from simplify import TIERS
+from snapshot import SnapshotQueries
+
+# result is None and error holds the exception message if the task failed
+TaskResult = namedtuple('TaskResult', ['task', 'result', 'seconds', 'error'])
+
+# results are in the order the tasks were given; seconds is the total wall time
+RunReport = namedtuple('RunReport', ['results', 'seconds'])
+
+
+def run_task(program, task, params=None):
+    start = time.perf_counter()
+    try:
+        result = getattr(program, task)(**(params or {}))
+        error = None
+    except Exception as e:
+        result = None
+        error = f"{type(e).__name__}: {e}"
+    return TaskResult(task, result, time.perf_counter() - start, error)
+
+
+def run_tasks(program, tasks=TASKS, workers=None, params=None):
+    """
+    Runs the named tasks of program on a thread pool of workers threads (one
+    per task by default). params maps a task name to its keyword arguments.
+    """
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError(f"Unknown task: {task}")
+    params = params or {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or len(tasks) or 1) as executor:
+        futures = [executor.submit(run_task, program, task, params.get(task)) for task in tasks]
+        results = [future.result() for future in futures]
+    return RunReport(results, time.perf_counter() - start)
+
+
+def parse_method(value):
+    task, _, method = value.partition("=")
+    if task not in TASKS or not method:
+        raise argparse.ArgumentTypeError(f"expected TASK=METHOD, got {value}")
+    return task, method
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Queries tasks concurrently.")
+    parser.add_argument('--tasks', nargs='+', default=TASKS, choices=TASKS, metavar='TASK')
+    parser.add_argument('--workers', type=int, default=None, help="threads (defaults to one per task)")
+    parser.add_argument('--method', nargs='+', type=parse_method, default=[], metavar="TASK=METHOD",
+                        help="implementation to use for a task, e.g. top_20_altitude_gains=stored")
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--tier', choices=TIERS, default=None,
+                        help="read raw or simplified trajectories (defaults to raw if it was stored)")
+    parser.add_argument('--results-file', default=None,
+                        help="reuse task results cached in this file until the next ingest")
+    parser.add_argument('--snapshot', default=None, help="run against a snapshot folder instead of the database")
+    parser.add_argument('--show', action='store_true', help="print the result of every task")
+    parser.add_argument('--json', default=None, help="write the results and timings to this file")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        program = SnapshotQueries(args.snapshot, verbose=False)
+    else:
+        program = Queries(database=args.database, verbose=False, tier=args.tier, results_file=args.results_file)
+    try:
+        params = {task: {"method": method} for task, method in args.method}
+        report = run_tasks(program, args.tasks, args.workers, params)
+    finally:
+        program.close_connection()
+
+    if args.show:
+        for task_result in report.results:
+            if task_result.error is not None:
+                print(f"{task_result.task}:\n{task_result.error}")
+            elif isinstance(task_result.result, list):
+                print_rows(task_result.result, f"{task_result.task}:")
+            else:
+                print(f"{task_result.task}:\n{pformat(task_result.result)}")
+            print()
+
+    print(tabulate([[r.task, f"{r.seconds:.3f}", "ok" if r.error is None else r.error] for r in report.results],
+                   headers=["task", "seconds", "status"]))
+    print(f"\nWall time: {report.seconds:.3f} s "
+          f"(sum of task times: {sum(r.seconds for r in report.results):.3f} s)")
+    if isinstance(program, Queries):
+        cache = program.trajectories.stats()
+        print(f"Trajectory cache: {cache['hits']} hits, {cache['misses']} misses, "
+              f"{cache['entries']} activities in {cache['bytes'] / 1024 / 1024:.1f} MB")
+        if program.result_cache is not None:
+            results = program.result_cache.stats()
+            print(f"Result cache: {results['hits']} hits, {results['misses']} misses, "
+                  f"{results['entries']} results")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"seconds": report.seconds, "tasks": [r._asdict() for r in report.results]},
+                      f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
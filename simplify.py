@@ -0,0 +1,240 @@
+"""
+Simplified trajectories, stored as a second tier next to (or instead of) the
+raw trackpoints.
+
+Each ingest chunk of an activity is simplified with Douglas-Peucker: a point
+is dropped if the simplified line passes within tolerance_m meters of it,
+unless dropping it would leave two consecutive kept points max_gap seconds or
+more apart (geometry.MAX_GAP_SECONDS, the gap that makes an activity invalid).
+Time gaps of max_gap or more are therefore the same as in the raw points. The
+kept points are stored in TrackPointSimplified in the bucket layout (one
+document per chunk, see layouts.make_buckets), together with raw_n, the number
+of raw points, and the distance covered by the raw and the simplified chunk.
+Queries(tier="simplified") reads this collection instead of the raw one.
+
+The tolerance is recorded in the Meta collection. The tier can be regenerated
+from the raw trackpoints with rebuild_simplified.
+
+Run:
+    python simplify.py --rebuild --tolerance 10 [--database NAME]
+    python simplify.py --report [--database NAME]
+"""
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from DbConnector import DbConnector
+from geometry import EARTH_RADIUS_KM, MAX_GAP_SECONDS, to_epoch, total_distance
+from layouts import META_COLLECTION, TRACKPOINT_COLLECTIONS, get_layout, make_buckets
+from resultcache import bump_data_version
+from trajcache import FETCH_BATCH, fetch_trajectories
+
+SIMPLIFIED_COLLECTION = "TrackPointSimplified"
+
+TIER_RAW = "raw"
+TIER_SIMPLIFIED = "simplified"
+TIERS = (TIER_RAW, TIER_SIMPLIFIED)
+
+DEFAULT_TOLERANCE_M = 10.0
+
+# How the tier was built: tolerance in meters, whether the raw points were stored as well, and
+# the time gap in seconds no dropped point may open (None for tiers built without that rule)
+Simplification = namedtuple('Simplification', ['tolerance_m', 'raw', 'max_gap'], defaults=[MAX_GAP_SECONDS])
+
+
+def _project(lat, lon):
+    """Equirectangular x/y in meters around the mean latitude; accurate enough for one trajectory."""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    radius_m = EARTH_RADIUS_KM * 1000
+    return lon * np.cos(lat.mean()) * radius_m, lat * radius_m
+
+
+def douglas_peucker(lat, lon, tolerance_m, epoch=None, max_gap=MAX_GAP_SECONDS):
+    """
+    Indexes of the points kept by Douglas-Peucker; the first and last point are
+    always kept. With epoch (seconds, sorted), points are also kept so that no
+    two consecutive kept points are max_gap or more apart unless they already
+    were in the input.
+    """
+    n = len(lat)
+    if n <= 2:
+        return np.arange(n)
+    x, y = _project(lat, lon)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        # Distance to the segment, not the line, so points beyond its ends are not missed
+        length2 = dx * dx + dy * dy
+        t = np.clip((px * dx + py * dy) / length2, 0, 1) if length2 else 0.0
+        distances = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance_m:
+            split = first + 1 + i
+        elif epoch is not None and epoch[last] - epoch[first] >= max_gap:
+            # Keep the last point less than max_gap after the first one
+            split = int(np.searchsorted(epoch, epoch[first] + max_gap)) - 1
+            split = min(max(split, first + 1), last - 1)
+        else:
+            continue
+        keep[split] = True
+        stack.append((first, split))
+        stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+def simplified_document(activity_id, user_id, trackpoints, tolerance_m, offset=0):
+    """TrackPointSimplified document for a chunk of trackpoint dicts (sorted by time)."""
+    lat = [tp["lat"] for tp in trackpoints]
+    lon = [tp["lon"] for tp in trackpoints]
+    epoch = to_epoch([tp["date_time"] for tp in trackpoints])
+    kept = douglas_peucker(lat, lon, tolerance_m, epoch)
+    points = [trackpoints[i] for i in kept]
+    document = make_buckets(activity_id, user_id, points, len(points), offset)[0]
+    document["raw_n"] = len(trackpoints)
+    document["raw_distance"] = total_distance(lat, lon)
+    document["distance"] = total_distance(document["lat"], document["lon"])
+    return document
+
+
+def get_simplification(db):
+    """How the simplified tier was built, or None if there is none."""
+    meta = db[META_COLLECTION].find_one({"_id": "ingest"})
+    simplification = meta.get("simplification") if meta else None
+    if not simplification:
+        return None
+    # Tiers recorded without max_gap were simplified without the time gap rule
+    return Simplification(**{"max_gap": None, **simplification})
+
+
+def set_simplification(db, simplification):
+    if simplification is None:
+        db[META_COLLECTION].update_one({"_id": "ingest"}, {"$unset": {"simplification": ""}}, upsert=True)
+    else:
+        db[META_COLLECTION].update_one({"_id": "ingest"}, {"$set": {"simplification": simplification._asdict()}},
+                                       upsert=True)
+
+
+def simplification_report(db):
+    """
+    Compression ratio (raw points / kept points) and distance error of the
+    simplified tier. The distance error of an activity is |raw - simplified|
+    / raw distance; its mean and max are over the activities that moved.
+    """
+    pipeline = [
+        {
+            "$group": {
+                "_id": "$activity_id",
+                "raw_points": {"$sum": "$raw_n"},
+                "points": {"$sum": "$n"},
+                "raw_distance": {"$sum": "$raw_distance"},
+                "distance": {"$sum": "$distance"}
+            }
+        },
+        {
+            "$set": {
+                "error": {
+                    "$cond": [
+                        {"$gt": ["$raw_distance", 0]},
+                        {"$divide": [{"$abs": {"$subtract": ["$raw_distance", "$distance"]}}, "$raw_distance"]},
+                        None
+                    ]
+                }
+            }
+        },
+        {
+            "$group": {
+                "_id": None,
+                "activities": {"$sum": 1},
+                "raw_points": {"$sum": "$raw_points"},
+                "points": {"$sum": "$points"},
+                "raw_distance": {"$sum": "$raw_distance"},
+                "distance": {"$sum": "$distance"},
+                "mean_distance_error": {"$avg": "$error"},
+                "max_distance_error": {"$max": "$error"}
+            }
+        },
+        {"$project": {"_id": 0}}
+    ]
+    result = list(db[SIMPLIFIED_COLLECTION].aggregate(pipeline, allowDiskUse=True))
+    if not result:
+        return None
+    report = result[0]
+    simplification = get_simplification(db)
+    report["tolerance_m"] = simplification.tolerance_m if simplification else None
+    # None if no activity moved
+    report["mean_distance_error"] = report["mean_distance_error"] or 0.0
+    report["max_distance_error"] = report["max_distance_error"] or 0.0
+    report["compression_ratio"] = report["raw_points"] / report["points"] if report["points"] else 0.0
+    report["total_distance_error"] = (abs(report["raw_distance"] - report["distance"]) / report["raw_distance"]
+                                      if report["raw_distance"] else 0.0)
+    return report
+
+
+def rebuild_simplified(db, tolerance_m, verbose=True):
+    """Regenerates TrackPointSimplified from the raw trackpoints, one document per activity."""
+    layout = get_layout(db)
+    trackpoint_collection = db[TRACKPOINT_COLLECTIONS[layout]]
+    collection = db[SIMPLIFIED_COLLECTION]
+
+    collection.drop()
+    activities = list(db["Activity"].find({}, {"user_id": 1}))
+    for start in range(0, len(activities), FETCH_BATCH):
+        batch = activities[start:start + FETCH_BATCH]
+        trajectories = fetch_trajectories(trackpoint_collection, layout, [activity["_id"] for activity in batch])
+        documents = []
+        for activity in batch:
+            lat, lon, alt, epoch = trajectories[activity["_id"]]
+            if len(lat) == 0:
+                continue
+            date_times = np.asarray(epoch, dtype='datetime64[s]').astype(object)
+            trackpoints = [{"lat": float(a), "lon": float(b), "altitude": float(c), "date_time": d}
+                           for a, b, c, d in zip(lat, lon, alt, date_times)]
+            documents.append(simplified_document(activity["_id"], activity["user_id"], trackpoints, tolerance_m))
+        if documents:
+            collection.insert_many(documents, ordered=False)
+        if verbose:
+            print(f"{min(start + FETCH_BATCH, len(activities))}/{len(activities)} activities")
+    set_simplification(db, Simplification(tolerance_m, True, MAX_GAP_SECONDS))
+    bump_data_version(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the simplified trajectory tier.")
+    parser.add_argument('--rebuild', action='store_true', help="regenerate TrackPointSimplified from the raw points")
+    parser.add_argument('--report', action='store_true', help="print the compression ratio and distance error")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE_M, help="tolerance in meters")
+    parser.add_argument('--database', default=None)
+    args = parser.parse_args()
+
+    if not args.rebuild and not args.report:
+        parser.print_help()
+        return
+
+    connection = DbConnector(DATABASE=args.database)
+    try:
+        if args.rebuild:
+            simplification = get_simplification(connection.db)
+            if simplification is not None and not simplification.raw:
+                raise SystemExit("The raw trackpoints were not stored; reload the data to change the tolerance.")
+            rebuild_simplified(connection.db, args.tolerance)
+        if args.report:
+            report = simplification_report(connection.db)
+            if report is None:
+                print(f"{SIMPLIFIED_COLLECTION} is empty.")
+            else:
+                for key, value in report.items():
+                    print(f"{key}: {value}")
+    finally:
+        connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+Columnar on-disk snapshot of the database for offline analytics.
+
+A snapshot is a folder with one sub-folder per user holding plain .npy files,
+which SnapshotQueries memory-maps instead of reading:
+
+    snapshot.json                       users, source layout and export time
+    <user_id>/activity_id.npy           ObjectId hex strings
+    <user_id>/activity_start.npy        epoch seconds (int64)
+    <user_id>/activity_end.npy          epoch seconds (int64)
+    <user_id>/activity_mode.npy         transportation mode, "" if unlabeled
+    <user_id>/activity_offset.npy       start of each activity in the trackpoint
+                                        columns, plus the total (int64)
+    <user_id>/lat.npy, lon.npy          float64
+    <user_id>/alt.npy                   float32
+    <user_id>/epoch.npy                 epoch seconds (int64)
+
+Trackpoints are stored in activity order, sorted by time within an activity.
+
+Run:
+    python snapshot.py export OUT_DIR [--database NAME]
+    python snapshot.py tasks OUT_DIR [--tasks ...]
+"""
+import argparse
+from datetime import datetime
+from itertools import islice
+import json
+import os
+
+import numpy as np
+
+from DbConnector import DbConnector
+import geometry
+from layouts import TRACKPOINT_COLLECTIONS, get_layout
+from pltreader import PltArrays, datetime_to_epoch, epoch_to_datetime
+from present import print_rows
+from queries import (FORBIDDEN_CITY_RADIUS_M, LANDMARKS, TASKS, AverageActivities, CollectionCount, CollectionRow,
+                     Distance, ModeActivities, UserActivities, UserAltitudeGain, UserInvalidActivities, UserMode,
+                     UserRow, YearActivities, YearHours)
+from trajcache import FETCH_BATCH, fetch_trajectories
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META = "snapshot.json"
+
+ACTIVITY_COLUMNS = ("activity_id", "activity_start", "activity_end", "activity_mode", "activity_offset")
+TRACKPOINT_COLUMNS = ("lat", "lon", "alt", "epoch")
+
+SECONDS_PER_HOUR = 3600
+
+
+def export_user(db, trackpoint_collection, layout, user_id, user_dir):
+    activities = list(db["Activity"].find(
+        {"user_id": user_id}, {"start_date_time": 1, "end_date_time": 1, "transportation_mode": 1}
+    ).sort("start_date_time", 1))
+    ids = [activity["_id"] for activity in activities]
+
+    trajectories = []
+    for start in range(0, len(ids), FETCH_BATCH):
+        batch = ids[start:start + FETCH_BATCH]
+        fetched = fetch_trajectories(trackpoint_collection, layout, batch)
+        trajectories.extend(fetched[activity_id] for activity_id in batch)
+
+    lengths = [len(trajectory.lat) for trajectory in trajectories]
+    columns = {
+        "activity_id": np.array([str(activity_id) for activity_id in ids], dtype="U24"),
+        "activity_start": np.array([datetime_to_epoch(a["start_date_time"]) for a in activities], dtype=np.int64),
+        "activity_end": np.array([datetime_to_epoch(a["end_date_time"]) for a in activities], dtype=np.int64),
+        "activity_mode": np.array([a["transportation_mode"] or "" for a in activities], dtype=str),
+        "activity_offset": np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+    }
+    for i, (name, dtype) in enumerate(zip(TRACKPOINT_COLUMNS, (np.float64, np.float64, np.float32, np.int64))):
+        parts = [trajectory[i] for trajectory in trajectories]
+        columns[name] = np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype=dtype)
+
+    os.makedirs(user_dir, exist_ok=True)
+    for name, array in columns.items():
+        np.save(os.path.join(user_dir, f"{name}.npy"), array)
+    return len(activities), int(columns["activity_offset"][-1])
+
+
+def export_snapshot(db, out_dir, layout=None, verbose=True):
+    """Writes a snapshot of db to out_dir, one user at a time."""
+    layout = layout or get_layout(db)
+    trackpoint_collection = db[TRACKPOINT_COLLECTIONS[layout]]
+    users = [{"_id": user["_id"], "has_labels": user.get("has_labels", False)}
+             for user in db["User"].find().sort("_id", 1)]
+
+    os.makedirs(out_dir, exist_ok=True)
+    for user in users:
+        activities, trackpoints = export_user(db, trackpoint_collection, layout, user["_id"],
+                                              os.path.join(out_dir, user["_id"]))
+        if verbose:
+            print(f"Exported user {user['_id']}: {activities} activities, {trackpoints} trackpoints")
+
+    with open(os.path.join(out_dir, SNAPSHOT_META), 'w') as f:
+        json.dump({"version": SNAPSHOT_VERSION, "layout": layout,
+                   "exported": datetime.now().isoformat(timespec="seconds"), "users": users}, f, indent=2)
+
+
+def _project(document, projection):
+    """A document with a find()-style projection of its top-level fields applied."""
+    if not projection:
+        return document
+    included = {field for field, value in projection.items() if value and field != "_id"}
+    if included:
+        if projection.get("_id", 1):
+            included.add("_id")
+        return {field: value for field, value in document.items() if field in included}
+    return {field: value for field, value in document.items() if field not in projection}
+
+
+class SnapshotQueries:
+    """
+    The Queries tasks answered from a snapshot. Columns are memory-mapped, and
+    trajectories are slices of them, so nothing is copied until it is used.
+    Like Queries, every task has an iter_* generator yielding the same typed
+    rows, and the tasks print them through present.print_rows and return the
+    same results; the method and batch_size arguments of Queries do not apply.
+    """
+
+    def __init__(self, path, verbose=True):
+        with open(os.path.join(path, SNAPSHOT_META)) as f:
+            meta = json.load(f)
+        if meta["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {meta['version']}")
+        self.path = path
+        self.users = meta["users"]
+        self.verbose = verbose
+        self._partitions = {}
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def show(self, title, rows):
+        """Prints rows as a table unless verbose is False; see present.print_rows."""
+        if self.verbose:
+            print_rows(rows, title)
+
+    def partition(self, user_id):
+        """Memory-mapped columns of one user, as a dict of name -> array."""
+        partition = self._partitions.get(user_id)
+        if partition is None:
+            partition = {name: np.load(os.path.join(self.path, user_id, f"{name}.npy"), mmap_mode='r')
+                         for name in ACTIVITY_COLUMNS + TRACKPOINT_COLUMNS}
+            self._partitions[user_id] = partition
+        return partition
+
+    def trajectory(self, partition, index):
+        start, end = partition["activity_offset"][index], partition["activity_offset"][index + 1]
+        return PltArrays(*(partition[name][start:end] for name in TRACKPOINT_COLUMNS))
+
+    def _user_ids(self):
+        return [user["_id"] for user in self.users]
+
+    def _activity_row(self, user_id, partition, index):
+        return {
+            "_id": str(partition["activity_id"][index]),
+            "user_id": user_id,
+            "start_date_time": epoch_to_datetime(partition["activity_start"][index]),
+            "end_date_time": epoch_to_datetime(partition["activity_end"][index]),
+            "transportation_mode": str(partition["activity_mode"][index]) or None,
+        }
+
+    # task 1
+    def top_10_rows(self):
+        rows = {"User": [], "Activity": [], "TrackPoint": []}
+        for row in self.iter_top_10_rows():
+            rows[row.collection].append(row.document)
+        for collection, documents in rows.items():
+            self.show(f"Top 10 rows from the {collection} collection:", documents)
+        return rows
+
+    def iter_top_10_rows(self, limit=10, projections=None):
+        """
+        CollectionRows with the first limit users, activities and trackpoints.
+        projections maps a collection name to a projection of top-level fields.
+        """
+        projections = projections or {}
+        for user in self.users[:limit]:
+            yield CollectionRow("User", _project(dict(user), projections.get("User")))
+        for collection, documents in (("Activity", self._iter_activities()), ("TrackPoint", self._iter_trackpoints())):
+            for document in islice(documents, limit):
+                yield CollectionRow(collection, _project(document, projections.get(collection)))
+
+    def _iter_activities(self):
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            for index in range(len(partition["activity_id"])):
+                yield self._activity_row(user_id, partition, index)
+
+    def _iter_trackpoints(self):
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            for index in range(len(partition["activity_id"])):
+                activity_id = str(partition["activity_id"][index])
+                for lat, lon, alt, epoch in zip(*self.trajectory(partition, index)):
+                    yield {"activity_id": activity_id, "lat": float(lat), "lon": float(lon),
+                           "altitude": float(alt), "date_time": epoch_to_datetime(epoch)}
+
+    # task 2.1
+    def count_entries(self):
+        rows = list(self.iter_count_entries())
+        self.show("Number of documents per collection:", rows)
+        return {row.collection: row.count for row in rows}
+
+    def iter_count_entries(self):
+        activity_count = 0
+        trackpoint_count = 0
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            activity_count += len(partition["activity_id"])
+            trackpoint_count += len(partition["epoch"])
+        yield CollectionCount("User", len(self.users))
+        yield CollectionCount("Activity", activity_count)
+        yield CollectionCount("TrackPoint", trackpoint_count)
+
+    def _activity_counts(self):
+        counts = {user_id: len(self.partition(user_id)["activity_id"]) for user_id in self._user_ids()}
+        return {user_id: count for user_id, count in counts.items() if count > 0}
+
+    # task 2.2
+    def average_activities_per_user(self):
+        rows = list(self.iter_average_activities_per_user())
+        self.show("Average number of activities per user:", rows)
+        return rows[0].average_activities if rows else None
+
+    def iter_average_activities_per_user(self):
+        counts = self._activity_counts()
+        if counts:
+            yield AverageActivities(sum(counts.values()) / len(counts))
+
+    # task 2.3
+    def top_20_users_with_highest_activities(self):
+        rows = list(self.iter_top_20_users_with_highest_activities())
+        self.show("Top 20 users with the highest number of activities:", rows)
+        return rows
+
+    def iter_top_20_users_with_highest_activities(self, limit=20):
+        for user_id, count in sorted(self._activity_counts().items(), key=lambda row: row[1], reverse=True)[:limit]:
+            yield UserActivities(user_id, count)
+
+    # task 2.4
+    def users_taken_taxi(self):
+        rows = list(self.iter_users_taken_taxi())
+        self.show("Users who have taken a taxi:", rows)
+        return [row.user_id for row in rows]
+
+    def iter_users_taken_taxi(self):
+        for user_id in sorted(self._user_ids()):
+            if (self.partition(user_id)["activity_mode"] == "taxi").any():
+                yield UserRow(user_id)
+
+    def _mode_counts(self, user_id):
+        modes, counts = np.unique(self.partition(user_id)["activity_mode"], return_counts=True)
+        return {str(mode): int(count) for mode, count in zip(modes, counts) if mode}
+
+    # task 2.5
+    def count_transportation_modes(self):
+        rows = list(self.iter_count_transportation_modes())
+        self.show("Transportation modes and their activity counts:", rows)
+        return rows
+
+    def iter_count_transportation_modes(self):
+        totals = {}
+        for user_id in self._user_ids():
+            for mode, count in self._mode_counts(user_id).items():
+                totals[mode] = totals.get(mode, 0) + count
+        for mode, count in sorted(totals.items(), key=lambda row: row[1], reverse=True):
+            yield ModeActivities(mode, count)
+
+    def _totals_by_year(self, value):
+        totals = {}
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            start = np.asarray(partition["activity_start"])
+            years = start.astype('datetime64[s]').astype('datetime64[Y]').astype(np.int64) + 1970
+            unique_years, inverse = np.unique(years, return_inverse=True)
+            for year, total in zip(unique_years, np.bincount(inverse, weights=value(partition, start),
+                                                             minlength=len(unique_years))):
+                totals[int(year)] = totals.get(int(year), 0) + total
+        return totals
+
+    # task 2.6a)
+    def year_with_most_activities(self):
+        rows = list(self.iter_year_with_most_activities())
+        self.show("Year with the most activities:", rows)
+        return rows[0] if rows else None
+
+    def iter_year_with_most_activities(self, limit=1):
+        """YearActivities rows, the year with the most activities first."""
+        totals = self._totals_by_year(lambda partition, start: np.ones(len(start)))
+        for year in sorted(totals, key=totals.get, reverse=True)[:limit]:
+            yield YearActivities(year, int(totals[year]))
+
+    # task b)
+    def year_with_most_hours(self):
+        rows = list(self.iter_year_with_most_hours())
+        self.show("Year with the most recorded hours:", rows)
+        return rows[0] if rows else None
+
+    def iter_year_with_most_hours(self, limit=1):
+        """YearHours rows, the year with the most recorded hours first."""
+        totals = self._totals_by_year(
+            lambda partition, start: (np.asarray(partition["activity_end"]) - start) / SECONDS_PER_HOUR)
+        for year in sorted(totals, key=totals.get, reverse=True)[:limit]:
+            yield YearHours(year, float(totals[year]))
+
+    # task 2.7
+    def total_distance_walked_2008(self):
+        rows = list(self.iter_total_distance_walked_2008())
+        self.show("Total distance walked in 2008 by user 112:", rows)
+        return rows[0].distance_km
+
+    def iter_total_distance_walked_2008(self):
+        start, end = datetime(2008, 1, 1), datetime(2009, 1, 1)
+        yield Distance("112", "walk", start, end, self.total_distance("112", "walk", start, end))
+
+    def total_distance(self, user_id=None, mode=None, start=None, end=None):
+        """Same as Queries.total_distance, computed from the trajectories."""
+        user_ids = [user_id] if user_id is not None else self._user_ids()
+        total_distance = 0.0
+        for user_id in user_ids:
+            if not os.path.isdir(os.path.join(self.path, user_id)):
+                continue
+            partition = self.partition(user_id)
+            selected = np.ones(len(partition["activity_id"]), dtype=bool)
+            if mode is not None:
+                selected &= partition["activity_mode"] == mode
+            if start is not None:
+                selected &= partition["activity_start"] >= datetime_to_epoch(start)
+            if end is not None:
+                selected &= partition["activity_start"] < datetime_to_epoch(end)
+            for index in np.flatnonzero(selected):
+                trajectory = self.trajectory(partition, index)
+                total_distance += geometry.total_distance(trajectory.lat, trajectory.lon)
+        return total_distance
+
+    # task 2.8
+    def top_20_altitude_gains(self):
+        rows = list(self.iter_top_20_altitude_gains())
+        self.show("Top 20 users with the highest altitude gains (meters):", rows)
+        return rows
+
+    def iter_top_20_altitude_gains(self, limit=20):
+        """UserAltitudeGain rows, highest gain first."""
+        altitude_gain_by_user = {}
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            altitude_gain_by_user[user_id] = sum(
+                geometry.altitude_gain(self.trajectory(partition, index).alt)
+                for index in range(len(partition["activity_id"]))
+            )
+        for user_id, altitude_gain in sorted(altitude_gain_by_user.items(), key=lambda x: x[1], reverse=True)[:limit]:
+            yield UserAltitudeGain(user_id, altitude_gain)
+
+    # task 2.9
+    def find_invalid_activities(self, max_gap=geometry.MAX_GAP_SECONDS, users=None):
+        rows = list(self.iter_invalid_activities(max_gap, users))
+        self.show(f"Users with invalid activities (time deviation >= {max_gap / 60:g} minutes):", rows)
+        return {row.user_id: row.invalid_count for row in rows}
+
+    def iter_invalid_activities(self, max_gap=geometry.MAX_GAP_SECONDS, users=None):
+        """UserInvalidActivities rows sorted by user id; users defaults to the users with labels."""
+        if users is None:
+            users = [user["_id"] for user in self.users if user["has_labels"]]
+        for user_id in sorted(users):
+            if not os.path.isdir(os.path.join(self.path, user_id)):
+                # A user without activities has no partition, and no invalid activities
+                continue
+            partition = self.partition(user_id)
+            invalid_count = sum(
+                not geometry.is_valid(self.trajectory(partition, index).epoch, max_gap)
+                for index in range(len(partition["activity_id"]))
+            )
+            if invalid_count:
+                yield UserInvalidActivities(user_id, invalid_count)
+
+    # task 2.10
+    def find_users_in_forbidden_city(self):
+        rows = list(self.iter_users_in_forbidden_city())
+        self.show("Users who have tracked an activity in the Forbidden City:", rows)
+        return [row.user_id for row in rows]
+
+    def iter_users_in_forbidden_city(self, radius_m=FORBIDDEN_CITY_RADIUS_M):
+        for user_id in self.users_near(*LANDMARKS["forbidden_city"], radius_m):
+            yield UserRow(user_id)
+
+    def users_near(self, lat, lon, radius_m):
+        """Sorted ids of the users with a trackpoint within radius_m meters of (lat, lon)."""
+        south, west, north, east = geometry.bounding_box(lat, lon, radius_m)
+        result = []
+        for user_id in self._user_ids():
+            partition = self.partition(user_id)
+            lats, lons = partition["lat"], partition["lon"]
+            # Cheap box test first, then the exact distance for the points inside it
+            inside = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+            if inside.any() and (geometry.calculate_distance(lats[inside], lons[inside], lat, lon)
+                                 <= radius_m / 1000).any():
+                result.append(user_id)
+        return sorted(result)
+
+    #task 2.11
+    def most_used_transport_mode(self):
+        rows = list(self.iter_most_used_transport_mode())
+        self.show("User and their most used transportation mode:", rows)
+        return rows
+
+    def iter_most_used_transport_mode(self):
+        # Ties go to the first mode by name, as with method="rollup" in Queries
+        for user_id in sorted(self._user_ids()):
+            counts = self._mode_counts(user_id)
+            if counts:
+                yield UserMode(user_id, min(counts, key=lambda m: (-counts[m], m)))
+
+    def close_connection(self):
+        self._partitions.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and query columnar snapshots.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="write a snapshot of the database")
+    export_parser.add_argument('out_dir')
+    export_parser.add_argument('--database', default=None)
+    tasks_parser = subparsers.add_parser("tasks", help="run Queries tasks against a snapshot")
+    tasks_parser.add_argument('snapshot')
+    tasks_parser.add_argument('--tasks', nargs='+', default=TASKS, choices=TASKS, metavar='TASK')
+    args = parser.parse_args()
+
+    if args.command == "export":
+        connection = DbConnector(DATABASE=args.database)
+        try:
+            export_snapshot(connection.db, args.out_dir)
+        finally:
+            connection.close_connection()
+    else:
+        program = SnapshotQueries(args.snapshot)
+        for task in args.tasks:
+            print(f"\n{task}:")
+            getattr(program, task)()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Generates a synthetic dataset in the Geolife layout:
+
+    <root>/Data/<user_id>/Trajectory/<YYYYMMDDHHMMSS>.plt
+    <root>/Data/<user_id>/labels.txt        (labeled users only)
+    <root>/labeled_ids.txt
+
+Trajectories are random walks around Beijing with one fix every few seconds
+and an occasional gap of more than five minutes, so every Queries task has
+something to find. Some trajectories start at the Forbidden City, and the
+labels of a labeled user cover a label_density share of their files.
+
+Run:
+    python synthetic.py OUT_DIR [--users N] [--files-per-user N] [--points-per-file N]
+                                [--label-density F] [--seed N]
+"""
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+import random
+
+from pltreader import EPOCH_DAY_OFFSET, SECONDS_PER_DAY, datetime_to_epoch
+from queries import LANDMARKS
+
+MODES = ["walk", "bus", "car", "taxi", "bike", "subway", "train"]
+
+BEIJING = (39.95, 116.35)
+
+PLT_HEADER = "Geolife trajectory\nWGS 84\nAltitude is in Feet\nReserved 3\n0,2,255,My Track,0,0,2,8421376\n0\n"
+
+# Share of users with a labels.txt, as in the real dataset
+LABELED_USER_SHARE = 0.4
+
+# Share of trajectories that start at the Forbidden City
+LANDMARK_SHARE = 0.05
+
+# Share of fixes followed by a gap long enough to make the activity invalid
+GAP_SHARE = 0.0005
+
+SyntheticDataset = namedtuple('SyntheticDataset', ['data_path', 'labels_path', 'users', 'files', 'points'])
+
+
+def write_plt(file_path, rng, start, points, origin):
+    lat, lon = origin
+    altitude = rng.uniform(50, 300)
+    date_time = start
+    lines = [PLT_HEADER]
+    for _ in range(points):
+        day_number = datetime_to_epoch(date_time) / SECONDS_PER_DAY + EPOCH_DAY_OFFSET
+        lines.append(f"{lat:.6f},{lon:.6f},0,{altitude:.0f},{day_number:.10f},"
+                     f"{date_time:%Y-%m-%d},{date_time:%H:%M:%S}\n")
+        lat += rng.gauss(0, 0.0001)
+        lon += rng.gauss(0, 0.0001)
+        altitude = max(0.0, altitude + rng.gauss(0, 2))
+        gap = rng.randint(360, 900) if rng.random() < GAP_SHARE else rng.randint(1, 5)
+        date_time += timedelta(seconds=gap)
+    with open(file_path, 'w') as f:
+        f.writelines(lines)
+    return date_time
+
+
+def generate(root, users=20, files_per_user=10, points_per_file=500, label_density=0.5, seed=0):
+    """Writes a synthetic dataset under root and returns a SyntheticDataset."""
+    rng = random.Random(seed)
+    data_path = os.path.join(root, "Data")
+    labels_path = os.path.join(root, "labeled_ids.txt")
+    labeled_users = []
+    files = 0
+
+    for user_index in range(users):
+        user_id = f"{user_index:03d}"
+        trajectory_folder = os.path.join(data_path, user_id, "Trajectory")
+        os.makedirs(trajectory_folder, exist_ok=True)
+        labeled = rng.random() < LABELED_USER_SHARE
+        labels = []
+
+        start = datetime(2007, 4, 1) + timedelta(days=rng.randint(0, 5 * 365), seconds=rng.randint(0, 86399))
+        for _ in range(files_per_user):
+            if rng.random() < LANDMARK_SHARE:
+                origin = LANDMARKS["forbidden_city"]
+            else:
+                origin = (BEIJING[0] + rng.uniform(-0.2, 0.2), BEIJING[1] + rng.uniform(-0.2, 0.2))
+            file_path = os.path.join(trajectory_folder, f"{start:%Y%m%d%H%M%S}.plt")
+            end = write_plt(file_path, rng, start, points_per_file, origin)
+            files += 1
+            if labeled and rng.random() < label_density:
+                labels.append((start, end, rng.choice(MODES)))
+            start = end + timedelta(hours=rng.randint(1, 72), seconds=rng.randint(0, 3599))
+
+        if labeled:
+            labeled_users.append(user_id)
+            with open(os.path.join(data_path, user_id, "labels.txt"), 'w') as f:
+                f.write("Start Time\tEnd Time\tTransportation Mode\n")
+                for label_start, label_end, mode in labels:
+                    f.write(f"{label_start:%Y/%m/%d %H:%M:%S}\t{label_end:%Y/%m/%d %H:%M:%S}\t{mode}\n")
+
+    with open(labels_path, 'w') as f:
+        f.writelines(f"{user_id}\n" for user_id in labeled_users)
+
+    return SyntheticDataset(data_path, labels_path, users, files, files * points_per_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Geolife-format dataset.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--files-per-user', type=int, default=10)
+    parser.add_argument('--points-per-file', type=int, default=500)
+    parser.add_argument('--label-density', type=float, default=0.5,
+                        help="share of a labeled user's files that get a label")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = generate(args.out_dir, args.users, args.files_per_user, args.points_per_file,
+                       args.label_density, args.seed)
+    print(f"Wrote {dataset.files} files with {dataset.points} trackpoints for {dataset.users} users "
+          f"to {dataset.data_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+In-memory cache of decoded activity trajectories.
+
+Each activity is held as compact typed arrays (PltArrays: float64 lat/lon,
+float32 alt and int64 epoch seconds) instead of a list of trackpoint dicts.
+The cache is bounded by the total size of its arrays and evicts the least
+recently used activities first. Missing activities are fetched from the
+trackpoint collection in batches, for any storage layout.
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+from geometry import to_epoch
+from layouts import ACTIVITY_FIELDS, LAYOUT_BUCKETS, LAYOUT_TIMESERIES
+from pltreader import PltArrays
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Activities fetched per query on a cache miss
+FETCH_BATCH = 100
+
+_FIELDS = {"_id": 0, "lat": 1, "lon": 1, "altitude": 1, "date_time": 1}
+
+
+def make_trajectory(lat, lon, alt, date_times):
+    return PltArrays(
+        np.asarray(lat, dtype=np.float64),
+        np.asarray(lon, dtype=np.float64),
+        np.asarray(alt, dtype=np.float32),
+        to_epoch(date_times),
+    )
+
+
+def trajectory_bytes(trajectory):
+    return sum(array.nbytes for array in trajectory)
+
+
+def fetch_trajectories(trackpoint_collection, layout, activity_ids):
+    """Trajectories of the given activities as a dict of activity_id -> PltArrays, in one query."""
+    columns = {activity_id: ([], [], [], []) for activity_id in activity_ids}
+    activity_field = ACTIVITY_FIELDS[layout]
+    query = {activity_field: {"$in": activity_ids}}
+    projection = {**_FIELDS, activity_field: 1}
+    if layout == LAYOUT_BUCKETS:
+        buckets = trackpoint_collection.find(query, projection).sort([("activity_id", 1), ("seq", 1)])
+        for bucket in buckets:
+            lat, lon, alt, date_time = columns[bucket["activity_id"]]
+            lat.extend(bucket["lat"])
+            lon.extend(bucket["lon"])
+            alt.extend(bucket["altitude"])
+            date_time.extend(bucket["date_time"])
+    else:
+        trackpoints = trackpoint_collection.find(query, projection).sort([(activity_field, 1), ("date_time", 1)])
+        for tp in trackpoints:
+            activity_id = tp["meta"]["activity_id"] if layout == LAYOUT_TIMESERIES else tp["activity_id"]
+            lat, lon, alt, date_time = columns[activity_id]
+            lat.append(tp["lat"])
+            lon.append(tp["lon"])
+            alt.append(tp["altitude"])
+            date_time.append(tp["date_time"])
+    return {activity_id: make_trajectory(*values) for activity_id, values in columns.items()}
+
+
+class TrajectoryCache:
+
+    def __init__(self, trackpoint_collection, layout, max_bytes=DEFAULT_CACHE_BYTES):
+        self.trackpoint_collection = trackpoint_collection
+        self.layout = layout
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, activity_id):
+        """Trajectory of one activity, sorted by time."""
+        return next(self.get_many([activity_id]))[1]
+
+    def get_many(self, activity_ids):
+        """Yields (activity_id, trajectory) in the given order, fetching misses in batches."""
+        activity_ids = list(activity_ids)
+        for start in range(0, len(activity_ids), FETCH_BATCH):
+            batch = activity_ids[start:start + FETCH_BATCH]
+            found = {}
+            with self._lock:
+                for activity_id in batch:
+                    trajectory = self._entries.get(activity_id)
+                    if trajectory is not None:
+                        self._entries.move_to_end(activity_id)
+                        self.hits += 1
+                        found[activity_id] = trajectory
+                missing = [activity_id for activity_id in batch if activity_id not in found]
+                self.misses += len(missing)
+
+            if missing:
+                fetched = fetch_trajectories(self.trackpoint_collection, self.layout, missing)
+                with self._lock:
+                    for activity_id, trajectory in fetched.items():
+                        self._put(activity_id, trajectory)
+                found.update(fetched)
+
+            for activity_id in batch:
+                yield activity_id, found[activity_id]
+
+    def _put(self, activity_id, trajectory):
+        size = trajectory_bytes(trajectory)
+        if size > self.max_bytes or activity_id in self._entries:
+            return
+        self._entries[activity_id] = trajectory
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= trajectory_bytes(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,217 @@
+from collections import namedtuple
+import time
+
+import bson
+from bson import ObjectId
+
+from cells import CELL_COLLECTION, DEFAULT_GRID, trackpoint_visits
+from instrumentation import (NO_INSTRUMENTATION, STAGE_CELLS, STAGE_MANIFEST, STAGE_ROLLUPS, STAGE_SIMPLIFY,
+                             STAGE_WRITE)
+from layouts import (BUCKET_SIZE, LAYOUT_BUCKETS, LAYOUT_DOCUMENTS, LAYOUT_TIMESERIES, TRACKPOINT_COLLECTIONS,
+                     make_buckets, make_measurement)
+from manifest import Manifest
+from rollups import apply_rollups
+from simplify import SIMPLIFIED_COLLECTION, simplified_document
+
+# Part of the trackpoints of one activity. offset is the position of the first
+# trackpoint in the activity; the activity is complete when done is True.
+# source is the manifest path of the file the activity comes from.
+ActivityChunk = namedtuple('ActivityChunk', ['activity', 'trackpoints', 'offset', 'done', 'source'],
+                           defaults=(None,))
+
+# Default flush limits for the write buffer
+DEFAULT_FLUSH_DOCS = 50000
+DEFAULT_FLUSH_BYTES = 16 * 1024 * 1024
+
+
+class WriteBuffer:
+    """
+    Collects activities and trackpoints from many files and writes them to
+    MongoDB in unordered insert_many batches.
+
+    ObjectIds are assigned on the client, so trackpoints can reference their
+    activity before anything has been written. The buffer is flushed when it
+    holds max_docs documents or roughly max_bytes of BSON, whichever comes first.
+    With the buckets layout the trackpoints are packed into TrackPointBucket
+    documents before they are buffered; with the timeseries layout each
+    trackpoint gets its activity and user in the meta field. Unless cells is
+    False, every chunk is also summarized into CellVisit documents on the given
+    grid. With a simplify_tolerance in meters, every chunk is simplified with
+    Douglas-Peucker into TrackPointSimplified as well, and with raw=False only
+    the simplified points are stored. After each flush the per-user rollups in
+    UserStats are incremented for the flushed activities.
+
+    Chunks with a source file are tracked in the ingest manifest: their
+    activity ids are recorded before anything is written, and a file is marked
+    done by the first flush after its IngestedFile record was added.
+    """
+
+    def __init__(self, db, max_docs=DEFAULT_FLUSH_DOCS, max_bytes=DEFAULT_FLUSH_BYTES, verbose=True,
+                 layout=LAYOUT_DOCUMENTS, bucket_size=BUCKET_SIZE, rollups=True,
+                 cells=True, grid=DEFAULT_GRID, simplify_tolerance=None, raw=True,
+                 instrumentation=NO_INSTRUMENTATION):
+        self.db = db
+        self.activity_collection = db['Activity']
+        self.trackpoint_collection = db[TRACKPOINT_COLLECTIONS[layout]]
+        self.cell_collection = db[CELL_COLLECTION]
+        self.simplified_collection = db[SIMPLIFIED_COLLECTION]
+        self.layout = layout
+        self.bucket_size = bucket_size
+        self.rollups = rollups
+        self.cells = cells
+        self.grid = grid
+        self.simplify_tolerance = simplify_tolerance
+        self.raw = raw
+        self.manifest = Manifest(db)
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.instrumentation = instrumentation
+
+        self.activities = []
+        self.trackpoints = []
+        self.cell_visits = []
+        self.simplified = []
+        self.pending_bytes = 0
+        self.activity_ids_by_file = {}
+        self.finished_files = []
+
+        # One entry per flush: docs, bytes and seconds spent writing
+        self.flushes = []
+        # Trackpoints before and after simplification
+        self.raw_points = 0
+        self.simplified_points = 0
+
+    @property
+    def pending_docs(self):
+        return len(self.activities) + len(self.trackpoints) + len(self.cell_visits) + len(self.simplified)
+
+    def add_activity(self, activity, trackpoints):
+        activity.setdefault("_id", ObjectId())
+        self.add_chunk(ActivityChunk(activity, trackpoints, 0, True))
+        return activity["_id"]
+
+    def add_chunk(self, chunk):
+        """
+        Adds the trackpoints of an ActivityChunk, and the activity itself once
+        its last chunk (done=True) arrives.
+        """
+        activity, trackpoints = chunk.activity, chunk.trackpoints
+        activity_id = activity["_id"]
+        if chunk.source is not None:
+            self.activity_ids_by_file.setdefault((chunk.source, activity["user_id"]), set()).add(activity_id)
+
+        if self.cells and trackpoints:
+            with self.instrumentation.stage(STAGE_CELLS, activity["user_id"], rows=len(trackpoints)):
+                visits = trackpoint_visits(activity_id, activity["user_id"], trackpoints, self.grid)
+            self.cell_visits.extend(visits)
+            if visits:
+                self.pending_bytes += len(bson.encode(visits[0])) * len(visits)
+
+        if self.simplify_tolerance is not None and trackpoints:
+            with self.instrumentation.stage(STAGE_SIMPLIFY, activity["user_id"], rows=len(trackpoints)):
+                simplified = simplified_document(activity_id, activity["user_id"], trackpoints,
+                                                 self.simplify_tolerance, chunk.offset)
+            self.simplified.append(simplified)
+            self.pending_bytes += len(bson.encode(simplified))
+            self.raw_points += simplified["raw_n"]
+            self.simplified_points += simplified["n"]
+
+        if self.raw:
+            self._add_trackpoints(activity_id, activity["user_id"], trackpoints, chunk.offset)
+
+        if chunk.done:
+            self.activities.append(activity)
+            self.pending_bytes += len(bson.encode(activity))
+
+        if self.pending_docs >= self.max_docs or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def _add_trackpoints(self, activity_id, user_id, trackpoints, offset):
+        """Buffers the raw trackpoints of a chunk in the storage layout."""
+        if self.layout == LAYOUT_BUCKETS:
+            buckets = make_buckets(activity_id, user_id, trackpoints, self.bucket_size, offset)
+            self.trackpoints.extend(buckets)
+            self.pending_bytes += sum(len(bson.encode(bucket)) for bucket in buckets)
+        else:
+            if self.layout == LAYOUT_TIMESERIES:
+                for tp in trackpoints:
+                    make_measurement(activity_id, user_id, tp)
+            else:
+                for tp in trackpoints:
+                    tp["activity_id"] = activity_id
+            self.trackpoints.extend(trackpoints)
+
+            # Trackpoints of a file share the same shape, so one encoded sample is enough
+            if trackpoints:
+                self.pending_bytes += len(bson.encode(trackpoints[0])) * len(trackpoints)
+
+    def add_file(self, ingested_file):
+        """Marks a file as done in the manifest once everything added before it is flushed."""
+        self.finished_files.append(ingested_file)
+
+    def flush(self):
+        if (not self.activities and not self.trackpoints and not self.cell_visits and not self.simplified
+                and not self.finished_files):
+            return
+
+        docs = self.pending_docs
+        size = self.pending_bytes
+        stage = self.instrumentation.stage
+        start = time.perf_counter()
+        with stage(STAGE_MANIFEST, rows=len(self.activity_ids_by_file)):
+            self.manifest.mark_pending(self.activity_ids_by_file)
+        with stage(STAGE_WRITE, rows=docs, nbytes=size):
+            if self.activities:
+                self.activity_collection.insert_many(self.activities, ordered=False)
+            if self.trackpoints:
+                self.trackpoint_collection.insert_many(self.trackpoints, ordered=False)
+            if self.cell_visits:
+                self.cell_collection.insert_many(self.cell_visits, ordered=False)
+            if self.simplified:
+                self.simplified_collection.insert_many(self.simplified, ordered=False)
+        if self.rollups:
+            with stage(STAGE_ROLLUPS, rows=len(self.activities)):
+                apply_rollups(self.db, self.activities)
+        with stage(STAGE_MANIFEST, rows=len(self.finished_files)):
+            self.manifest.mark_done(self.finished_files)
+        seconds = time.perf_counter() - start
+
+        self.flushes.append({"docs": docs, "bytes": size, "seconds": seconds})
+        if self.verbose and docs:
+            print(f"Flushed {docs} documents ({size / 1024 / 1024:.1f} MB) in {seconds * 1000:.0f} ms "
+                  f"({docs / seconds if seconds else 0:.0f} docs/s, "
+                  f"{size / 1024 / 1024 / seconds if seconds else 0:.1f} MB/s)")
+
+        self.activities = []
+        self.trackpoints = []
+        self.cell_visits = []
+        self.simplified = []
+        self.pending_bytes = 0
+        self.activity_ids_by_file = {}
+        self.finished_files = []
+
+    def summary(self):
+        docs = sum(f["docs"] for f in self.flushes)
+        size = sum(f["bytes"] for f in self.flushes)
+        seconds = sum(f["seconds"] for f in self.flushes)
+        return {
+            "flushes": len(self.flushes),
+            "docs": docs,
+            "bytes": size,
+            "seconds": seconds,
+            "docs_per_second": docs / seconds if seconds else 0.0,
+            "bytes_per_second": size / seconds if seconds else 0.0,
+            "raw_points": self.raw_points,
+            "simplified_points": self.simplified_points,
+        }
+
+    def close(self):
+        self.flush()
+        if self.verbose and self.flushes:
+            summary = self.summary()
+            print(f"Wrote {summary['docs']} documents in {summary['flushes']} flushes, "
+                  f"{summary['seconds']:.1f} s in MongoDB ({summary['docs_per_second']:.0f} docs/s)")
+            if self.simplified_points:
+                print(f"Simplified {self.raw_points} trackpoints to {self.simplified_points} "
+                      f"({self.raw_points / self.simplified_points:.1f}x) at {self.simplify_tolerance} m")